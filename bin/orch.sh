@@ -23,6 +23,8 @@ set -x
 
 # Conditionally set environment variables
 [ -z $PORT ] && PORT=3030
+[ -z $WORKERS ] && WORKERS=1
+[ -z $WORKER_TIMEOUT ] && WORKER_TIMEOUT=330
 
 # 1) Create a Python virtual environ
 # 2) Install the requirements from requirements.txt
@@ -64,6 +66,12 @@ function cover  () {
     coverage report -m | grep -v "v-orch"
 }
 
+# Time config generation and the event-to-reload path on synthetic clusters.
+# Pass --help for options, e.g. ./bin/orch.sh bench --sizes 100x10000 -o after.json
+function bench () {
+    python test/benchmarks.py "$@"
+}
+
 # Run either production or dev
 function run () {
     #activate_venv;
@@ -72,10 +80,17 @@ function run () {
     # NOTE: If you run this locally, then set the CONFIG_FILE correctly:
     # > export CONFIG_FILE=./etc/local_config.json
     # > ./bin/orch.sh run prod
+    # Set WORKERS to run more than one gunicorn worker.
     prod () {
         echo Running production...
         [ -z $CONFIG_FILE ] && export CONFIG_FILE=/etc/haproxy/oscar_config.json;
-        gunicorn -D -b 0.0.0.0:$PORT $MAIN_APP;
+        # The workers elect one of themselves to write the config and reload
+        # HAProxy; the first one elected on the host warm starts HAProxy.
+        export COORDINATE_WORKERS=true;
+        # Workers must outlive the longest /updateApp?wait=true, which
+        # UPDATE_MAX_WAIT caps (300 seconds by default).
+        # Workers start their orchestrator as they boot (see etc/gunicorn_config.py).
+        gunicorn -D -c etc/gunicorn_config.py -w $WORKERS -t $WORKER_TIMEOUT -b 0.0.0.0:$PORT $MAIN_APP;
     }
 
     # In development, use the Flask dev server in the server module
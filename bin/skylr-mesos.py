@@ -7,15 +7,14 @@ import json
 import os
 import shutil
 import subprocess
-from time import sleep
+import sys
 import urllib2
 
-# Installed imports.
-import paramiko
-
 # Project imports.
+from orchestration.haproxy import softReload
 from orchestration.ServiceOrchestrator import ServiceOrchestrator
 from orchestration.marathon import Marathon
+from orchestration.restart import RestartError, RollingRestart
 
 MARATHON_HOST = 'http://las-mesos1.oscar.priv:8080'
 MARATHON_JSON = 'http://las-mesos1.oscar.priv:8080/v2/tasks'
@@ -39,20 +38,22 @@ def getSkylrMarathonInstances():
 def install(marathonHost):
     print "Installing Skylr..."
 
-# TODO: Update this function to use urllib, not the Marathon library
-def restart(marathonHost):
+def restart(marathonHost, batchSize=4, concurrency=4, timeout=300):
+    """
+    Restart every Skylr task through Marathon, batchSize at a time, waiting
+    for each batch to be replaced by healthy tasks before the next.
+    """
     print "Restarting all running instances of Skylr..."
 
-    url = marathonHost or MARATHON_JSON
-    client = Marathon(url)
-    hosts = [task['host'] for task in json.loads(client.getTasks('skylr'))]
+    client = Marathon((marathonHost or MARATHON_HOST).rstrip('/') + '/v2')
+    rolling = RollingRestart(client, SKYLR_TASK_NAME, batchSize, concurrency, timeout,
+        progress=lambda line: sys.stdout.write('{0}: {1}\n'.format(datetime.datetime.now(), line)))
 
-    for host in hosts:
-        print 'Killing Skylr task on:', host
-        ssh = paramiko.SSHClient()
-        ssh.connect(host)
-        ssh.command('pkill "node app.js')
-        sleep(3)
+    try:
+        print "Restarted {0} task(s)".format(rolling.run())
+    except RestartError as e:
+        print "Rolling restart stopped: {0}".format(e)
+        sys.exit(1)
 
 def refreshConfig ():
     system = ServiceOrchestrator("conf.json")
@@ -64,19 +65,7 @@ def refreshConfig ():
 def restartLoadBalancer():
     print "{0}: Restarting HAProxy...".format(datetime.datetime.now())
 
-    pid = ""
-
-    if os.path.exists(PID_FILE):
-        proc = subprocess.Popen("cat {0}".format(PID_FILE).split(" "), stdout=subprocess.PIPE)
-        pid = proc.stdout.read()
-
-    command = "sudo haproxy -f {0} -f {1} -p {2} -D".format(CONFIG_DESTINATION, USER_CONFIG, PID_FILE)
-
-    if pid:
-        command = "sudo haproxy -f {0} -f {1} -p {2} -D -st {3}".format(CONFIG_DESTINATION, USER_CONFIG, PID_FILE, pid)
-
-    print "{0}: Restarting HAProxy: {1}".format(datetime.datetime.now(), command)
-    subprocess.call(command.split(" "))
+    softReload([CONFIG_DESTINATION, USER_CONFIG], PID_FILE)
 
 def rebalance(marathonHost):
     print "Rebalancing the load balancer..."
@@ -92,6 +81,12 @@ def main():
         help='specify a Marathon master host.')
     parser.add_argument('--restart', action='store_true', default=False, dest='restart',
         help='restart all running instances of Skylr.')
+    parser.add_argument('--batch-size', type=int, default=4, dest='batchSize',
+        help='how many instances to restart at a time (default 4).')
+    parser.add_argument('--concurrency', type=int, default=4,
+        help='how many instances of a batch to kill at once (default 4).')
+    parser.add_argument('--timeout', type=float, default=300,
+        help='seconds for each batch to come back healthy (default 300).')
     parser.add_argument('--rebalance', action='store_true', default=False, dest='rebalance',
         help='rebalance the HAProxy loadbalancer.')
 
@@ -104,7 +99,7 @@ def main():
         install(marathonHost)
 
     if args.restart:
-        restart(marathonHost)
+        restart(marathonHost, args.batchSize, args.concurrency, args.timeout)
 
     if args.rebalance:
         rebalance(marathonHost)
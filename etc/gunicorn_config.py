@@ -0,0 +1,10 @@
+"""
+**gunicorn settings** for `orch.sh run prod`.  Each worker starts its
+orchestrator as soon as it has booted, rather than on the first request it
+serves, so that the workers elect a leader, which warm starts HAProxy and
+subscribes to Marathon's event stream, without waiting for any traffic.
+"""
+
+def post_worker_init(worker):
+    import main
+    main.getSystem()
@@ -8,7 +8,11 @@ several HTTP requests pertaining to Marathon job orchestration.  For example,
 it listens for HTTP POST requests from the Marathon server itself that
 advertise a "*service_update_event*".
 
-TODO: Make this read the config file for services (e.g. oscar_config.json) every time.
+A single orchestrator serves every request, and picks up changes to the
+config file for services (e.g. oscar_config.json) as they happen.  Under
+gunicorn with several workers, set *COORDINATE_WORKERS*: every worker then
+takes events, but only the one elected leader applies them and reloads
+HAProxy.
 """
 
 # Built-in imports.
@@ -18,13 +22,21 @@ import json
 import logging
 import logging.handlers
 import os
+import threading
+import time
 
 # Installed imports.
 from flask import Flask
+from flask import Response
+from flask import jsonify
 from flask import request
 
 # Project imports.
-from orchestration.ServiceOrchestrator import ServiceOrchestrator
+from orchestration.coalescer import EventCoalescer
+from orchestration.coordinator import Coordinator
+from orchestration.eventqueue import EventQueue
+from orchestration.metrics import Counter, Gauge, registry
+from orchestration.ServiceOrchestrator import ServiceOrchestrator, membership
 
 # Logging for the whole project.
 logging.basicConfig(level=logging.INFO)
@@ -33,11 +45,166 @@ logger = logging.getLogger('main')
 # Constants
 CONFIG_FILE = os.environ.get('CONFIG_FILE', '/etc/haproxy/oscar_config.json')
 
+# Events arriving within the quiet window of each other are coalesced into a
+# single reload, but no event waits longer than the maximum delay.
+RELOAD_QUIET_WINDOW = float(os.environ.get('RELOAD_QUIET_WINDOW', 0.5))
+RELOAD_MAX_DELAY = float(os.environ.get('RELOAD_MAX_DELAY', 5.0))
+
+# Events POSTed by Marathon wait on a bounded queue for the worker; when it is
+# full, the overflow policy is one of drop_oldest, drop_newest or block.
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 1000))
+EVENT_QUEUE_OVERFLOW = os.environ.get('EVENT_QUEUE_OVERFLOW', 'drop_oldest')
+
+# The longest /updateApp?wait=true may wait for deployments, which must stay
+# below the gunicorn worker timeout (see bin/orch.sh).
+UPDATE_MAX_WAIT = float(os.environ.get('UPDATE_MAX_WAIT', 300))
+
+# With several worker processes, one is elected to apply events and reload
+# HAProxy, and the rest hand their events to it.
+COORDINATE_WORKERS = os.environ.get('COORDINATE_WORKERS', '').lower() in ('1', 'true', 'yes')
+
+# The process-wide orchestrator, created on first use.  It re-reads its config
+# file whenever that changes, so services can be added without a restart.
+system = None
+systemLock = threading.Lock()
+coordinator = None
+
+def startSystem(configFile):
+    """
+    Start an orchestrator.  With workers coordinating, only the leader's
+    runs the chores of applying events, now or once it is elected; every
+    worker keeps its Marathon hosts resolved.
+    """
+    global coordinator
+    orchestrator = ServiceOrchestrator(configFile).start()
+
+    if not COORDINATE_WORKERS:
+        return lead(orchestrator)
+
+    def elected():
+        lead(orchestrator)
+        # The first leader on the host brings HAProxy up from the snapshot,
+        # later ones catch up on anything the previous leader had not applied.
+        thread = threading.Thread(target=orchestrator.warmStartOnce, name='takeover')
+        thread.daemon = True
+        thread.start()
+
+    coordinator = Coordinator(orchestrator.configDest, reloads.submit, elected).start()
+    return orchestrator
+
+def lead(orchestrator):
+    """
+    Start the chores of the orchestrator that applies events, subscribing it
+    to Marathon's event stream if the config asks for that.
+    """
+    orchestrator.lead()
+    if orchestrator.config.get('event_stream', False):
+        orchestrator.subscribe(acceptStreamed)
+
+    return orchestrator
+
+def getSystem():
+    global system
+    if system is None:
+        with systemLock:
+            if system is None:
+                system = startSystem(CONFIG_FILE)
+
+    return system
+
+def applyEvents(events):
+    return getSystem().applyEvents(events)
+
+def submit(updateEvt):
+    """
+    Pass an accepted event to the coalescer, through the leader if the
+    workers are coordinating.
+    """
+    if coordinator is None:
+        reloads.submit(updateEvt)
+        return True
+
+    return coordinator.submit(updateEvt)
+
+def processEvent(item):
+    """
+    The event queue worker: check the event, then hand it to the coalescer.
+    """
+    ipAddr, updateEvt = item
+    if not getSystem().acceptEvent(ipAddr, updateEvt):
+        eventsRejected.inc(reason='untracked')
+    elif submit(updateEvt):
+        eventsAccepted.inc()
+    else:
+        eventsRejected.inc(reason='handoff')
+
+def acceptStreamed(updateEvt):
+    """
+    Events from the stream are already filtered down to tracked apps.
+    """
+    eventsReceived.inc(source='stream')
+    eventsAccepted.inc()
+    submit(updateEvt)
+
+reloads = EventCoalescer(applyEvents, RELOAD_QUIET_WINDOW, RELOAD_MAX_DELAY)
+events = EventQueue(processEvent, EVENT_QUEUE_SIZE, EVENT_QUEUE_OVERFLOW)
+
+# === Metrics ===
+
+eventsReceived = Counter('orchestrator_events_received_total',
+    'Marathon events received, by where they came from', ('source',))
+eventsAccepted = Counter('orchestrator_events_accepted_total',
+    'Marathon events passed on to be applied to the config')
+eventsRejected = Counter('orchestrator_events_rejected_total',
+    'Marathon events turned away, by why', ('reason',))
+
+# The gauges below are read off the orchestrator when scraped, and left out
+# until it has started.
+def trackedApps():
+    return len(system.services) if system else None
+
+def liveServers():
+    if not system or not system.deployed:
+        return None
+    return dict(((backend,), len(addrs))
+        for backend, addrs in membership(system.deployed[3]).iteritems())
+
+def sinceLastReload():
+    if not system or system.lastReloadAt is None:
+        return None
+    return time.time() - system.lastReloadAt
+
+def masterStat(name):
+    """
+    A statistic of the HAProxy master, in master-worker mode.
+    """
+    def collect():
+        if not system or not system.masterWorker:
+            return None
+        return system.master.stats()[name]
+    return collect
+
+Gauge('orchestrator_tracked_apps', 'Apps listed in the services config',
+    collect=trackedApps)
+Gauge('orchestrator_backend_live_servers', 'Live servers in each backend of the deployed config',
+    ('backend',), collect=liveServers)
+Gauge('orchestrator_seconds_since_last_reload', 'Seconds since HAProxy last reloaded successfully',
+    collect=sinceLastReload)
+Gauge('orchestrator_event_queue_depth', 'Events waiting for the event queue worker',
+    collect=lambda: events.queue.qsize())
+Gauge('orchestrator_haproxy_last_reload_seconds',
+    'Seconds the last master-worker reload took for new workers to replace the old',
+    collect=masterStat('last_reload_seconds'))
+Gauge('orchestrator_haproxy_last_drain_seconds',
+    'Seconds the old workers of the last master-worker reload took to finish and exit',
+    collect=masterStat('last_drain_seconds'))
+Gauge('orchestrator_haproxy_old_workers', 'Old HAProxy workers still draining connections',
+    collect=masterStat('old_workers'))
+
 # === Flask Application and Endpoints ===
 
 # The Flask server app.
 app = Flask(__name__)
-#system = None
 
 @app.route('/marathon', methods=['POST'])
 def marathon():
@@ -47,18 +214,74 @@ def marathon():
 
     Takes an HTTP POST from Marathon, and if it is a *status_update_event*
     message, we will rewrite the HAProxy configuration and restart HAProxy.
+    The event is only queued here, and answered with a 202, so Marathon's
+    event bus is never held up; a worker does the rest.  Bursts of events
+    are coalesced, so the rewrite happens once the burst settles rather than
+    once per event.
     """
     logger.info("Marathon Event received...")
-    updateEvt = json.loads(request.data)
+    eventsReceived.inc(source='http')
+    try:
+        updateEvt = json.loads(request.data)
+    except ValueError:
+        updateEvt = None
+
+    if not isinstance(updateEvt, dict):
+        eventsRejected.inc(reason='invalid')
+        return 'invalid event', 400
 
     if updateEvt.get('eventType') != 'status_update_event':
+        eventsRejected.inc(reason='event_type')
         return 'not status_update_event'
 
-    print 'IP ADDRESS:', request.remote_addr
-    system = ServiceOrchestrator(CONFIG_FILE)
-    ok = system.reloadHAProxy(request.remote_addr, updateEvt)
+    if not events.put((request.remote_addr, updateEvt)):
+        eventsRejected.inc(reason='queue_full')
+        return 'event queue full', 503
+
+    return 'accepted', 202
+
+@app.route('/status', methods=['GET'])
+def status():
+    """
+    Endpoint:
+        http://[host]:[port]/status
+
+    The depth of the event queue, how long events wait on it, how many
+    events each reload absorbs, and how often configs are rendered from cache.
+    With workers coordinating, which worker answered and whether it leads.
+    """
+    orchestrator = getSystem().stats()
+    if coordinator is None:
+        return jsonify(events=events.stats(), reloads=reloads.stats(),
+            orchestrator=orchestrator)
+
+    return jsonify(events=events.stats(), reloads=reloads.stats(),
+        orchestrator=orchestrator, coordinator=coordinator.stats())
 
-    return str(ok)
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Endpoint:
+        http://[host]:[port]/metrics
+
+    Counters, gauges and histograms of events, renders, Marathon calls and
+    reloads, in the Prometheus text format.
+    """
+    return Response(registry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/debug/reloads', methods=['GET'])
+def debugReloads():
+    """
+    Endpoint:
+        http://[host]:[port]/debug/reloads
+
+    The most recent config refreshes, newest first: what set each one off,
+    how it ended, and how long each of its phases took, from asking Marathon
+    to reloading HAProxy.  *?limit=* caps how many are returned.  With workers
+    coordinating, only the leader has any.
+    """
+    limit = request.args.get('limit', type=int)
+    return jsonify(traces=getSystem().tracer.recent(limit))
 
 # TODO: Should this handle an HTTP PUT?
 @app.route('/updateApp', methods=['POST'])
@@ -81,16 +304,41 @@ def updateApp():
             }
         }
 
+    The apps are updated concurrently, and the response has the result of
+    each, with the id of the Marathon deployment it started:
+
+        {
+            "ok": false,
+            "apps": {
+                "appOne": { "ok": true, "deploymentId": "5ed4c0c5-...", "version": "..." },
+                "appTwo": { "ok": false, "error": "HTTP 409: App is locked by one or more deployments." }
+            }
+        }
+
+    With *?wait=true*, the response waits until the deployments finish, or
+    until *timeout* seconds (default and at most *UPDATE_MAX_WAIT*, 300) have
+    passed, and each app's result says whether it was *deployed*.
+
     NOTE: The full [Marathon API](https://mesosphere.github.io/marathon/docs/rest-api.html#put-/v2/apps/%7Bappid%7D)
     allows more parameters to be changed, but we limit them for this API.
     """
-    newConfig = json.loads(request.data)
+    try:
+        newConfig = json.loads(request.data)
+        timeout = float(request.args.get('timeout', UPDATE_MAX_WAIT))
+    except ValueError:
+        return 'invalid request', 400
     logger.info('Method called with: {0}'.format(newConfig))
 
-    system = ServiceOrchestrator(CONFIG_FILE)
-    ok = system.updateApps(newConfig)
+    if not isinstance(newConfig, dict) or not timeout >= 0:
+        return 'invalid request', 400
 
-    return 'ok'
+    wait = request.args.get('wait', '').lower() in ('1', 'true', 'yes')
+    timeout = min(timeout, UPDATE_MAX_WAIT)
+
+    results = getSystem().updateApps(newConfig, wait, timeout)
+    ok = all(result['ok'] and result.get('deployed', True) for result in results.values())
+
+    return jsonify(ok=ok, apps=results)
 
 # === Server Startup Functions ===
 
@@ -101,10 +349,6 @@ def setupServer():
     # Set some application variables and run.
     app.debug = debug
 
-    #global system
-    #if system is None:
-    #    system = ServiceOrchestrator(CONFIG_FILE)
-
 def startServer(configFile):
     """
     Start the Flask server using some environment varils -al etc ables.
@@ -112,9 +356,11 @@ def startServer(configFile):
     setupServer()
     port = os.environ.get('PORT', 3030)
 
-    system = ServiceOrchestrator(configFile)
-    #system = ServiceOrchestrator(CONFIG_FILE)
-    system.startHaproxy()
+    global system
+    system = startSystem(configFile)
+    # With workers coordinating, the leader warm starts once it is elected.
+    if coordinator is None:
+        system.warmStart()
 
     app.run(host='0.0.0.0', port=port)
 
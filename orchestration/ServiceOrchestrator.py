@@ -8,19 +8,98 @@ the applications that it is configured to write HAProxy sections for.
 """
 
 import datetime
+import errno
+import hashlib
 import json
 import logging
+import logging.handlers
+from multiprocessing.pool import ThreadPool
 import os
 import socket
 from string import Template
-import subprocess
-
-from marathon import Marathon
+from StringIO import StringIO
+import threading
+import time
+
+import requests
+
+from fanout import ConfigFanout, makeTarget
+from marathon import EventStream, Marathon, MarathonError
+from periodic import Periodic
+from haproxy import HAProxyMaster, softReload
+from metrics import Counter, Histogram
+from publisher import ConfigPublisher, readPid
+from records import asTasks
+from renderer import ConfigScanner, compileTemplate, scan
+from resolver import HostCache
+from runtime import RuntimeAPI, RuntimeAPIError, SlotTable, slotCommands
+from snapshot import SnapshotStore
+from taskindex import TaskIndex
+from tracing import Tracer, span
+from tuning import Tuning, hostSettings
+from weights import AdaptiveWeights
 
 logger = logging.getLogger('ServiceOrchestrator')
 handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
 logger.addHandler(handler)
-ORCH_HOME = os.environ.get('ORCH_HOME', '/opt/app/orchestration')
+
+renderSeconds = Histogram('orchestrator_render_duration_seconds',
+    'Time taken to render the HAProxy config for a snapshot of the cluster')
+reloadSeconds = Histogram('orchestrator_reload_duration_seconds',
+    'Time taken to have HAProxy reload its config')
+reloadsTotal = Counter('orchestrator_reloads_total',
+    'HAProxy reloads, by whether they succeeded', ('outcome',))
+reloadsSkipped = Counter('orchestrator_reloads_skipped_total',
+    'Refreshes that needed no reload: the config was unchanged, or applied at runtime',
+    ('reason',))
+
+def digest(configText):
+    return hashlib.sha1(configText.encode('utf-8')).hexdigest()
+
+def servers(configText):
+    """
+    The servers of each backend in a config, as a dictionary of backend name
+    to {server name: address}, where the address of a disabled server slot
+    is None.
+    """
+    return scan(configText).servers
+
+def layout(configText):
+    """
+    A digest of the shape of a config: everything but the addresses and
+    state of its servers.  Configs with the same layout differ only in what
+    the runtime API can change.
+    """
+    return scan(configText).layout()
+
+def membership(backends):
+    """
+    The live server addresses of each backend in a servers() result.
+    """
+    return dict((backend, set(addr for addr in slots.values() if addr))
+        for backend, slots in backends.iteritems())
+
+def summarizeChanges(old, new):
+    """
+    A one-line summary of the backends and servers added and removed between
+    two membership() results.
+    """
+    changes = []
+
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    if added:
+        changes.append('backends added: {0}'.format(', '.join(added)))
+    if removed:
+        changes.append('backends removed: {0}'.format(', '.join(removed)))
+
+    for backend in sorted(set(new) & set(old)):
+        up = sorted(new[backend] - old[backend])
+        down = sorted(old[backend] - new[backend])
+        if up or down:
+            changes.append('{0} +[{1}] -[{2}]'.format(backend, ' '.join(up), ' '.join(down)))
+
+    return '; '.join(changes) or 'no backend membership changes'
 
 class ServiceOrchestrator(object):
 
@@ -33,11 +112,11 @@ global
     log-send-hostname
     chroot      /var/lib/haproxy
     pidfile     /var/run/haproxy.pid
-    maxconn     4000
+    maxconn     ${maxconn}
     user        haproxy
     group       haproxy
     daemon
-    stats socket /var/lib/haproxy/stats
+${threads}    stats socket ${statsSocket}
 
 defaults
     mode                    http
@@ -56,7 +135,7 @@ defaults
     timeout client          1m
     timeout http-keep-alive 10s
     timeout check           10s
-    maxconn                 3000
+    maxconn                 ${defaultMaxconn}
 
 listen stats :8082
     mode http
@@ -70,7 +149,7 @@ ${services}
 
     httpT = Template("""
 frontend http-in-${id}
-    bind :${port}
+    bind :${port}${bind}
 #    reqadd X-Forwarded-Proto:\ https
     acl is_websocket hdr(Connection)  -i Upgrade
     acl is_websocket path_beg /socket.io
@@ -91,50 +170,357 @@ ${httpServices}""")
     timeout server 600s
     option forwardfor
     option http-server-close
-    option forceclose
-    no option httpclose
+${forceclose}    no option httpclose
     cookie WEBSOCKETSERV insert indirect nocache preserve
-    appsession WEBSOCKETSERV len 52 timeout 3h request-learn
-${wsServices}
+${session}${wsServices}
 """)
 
     authT = Template("""    acl auth_ok http_auth(${authConf})
     http-request auth unless auth_ok
 """)
-    httpTask = Template("    server service-${id} ${host}:${port}\n")
-    wsTask = Template("    server service-${id} ${host}:${port} cookie service-${id} weight 1 maxconn 8192 check\n")
+    httpTask = Template("    server service-${id} ${host}:${port}${comment}\n")
+    wsTask = Template("    server service-${id} ${host}:${port} cookie service-${id} weight 1 maxconn 8192 check${comment}\n")
+
+    # How websocket sessions stick to a server: through appsession, which
+    # HAProxy 1.6 and later refuse, or through a stick table on the same
+    # cookie.  Newer versions also make forceclose an alias of the httpclose
+    # that the next line turns off, so it is left out with the stick table.
+    appsessionRules = {
+        "forceclose" : "    option forceclose\n",
+        "session" : "    appsession WEBSOCKETSERV len 52 timeout 3h request-learn\n"
+    }
+    stickTableRules = {
+        "forceclose" : "",
+        "session" : "    stick-table type string len 52 size 1m expire 3h\n"
+            "    stick on req.cook(WEBSOCKETSERV)\n"
+            "    stick store-response res.cook(WEBSOCKETSERV)\n"
+    }
+
+    # Server slots for runtime updates; empty slots are parked, disabled, on
+    # a placeholder address.
+    emptySlot = ('127.0.0.1', 1)
+    httpSlot = Template("    server service-${id} ${host}:${port}${disabled}${comment}\n")
+    wsSlot = Template("    server service-${id} ${host}:${port}${disabled} cookie service-${id} weight 1 maxconn 8192 check${comment}\n")
+
+    # The templates above, compiled once into format strings for rendering.
+    configHead, configTail = compileTemplate(configT).split('%(services)s')
+    httpF, wsF, authF = map(compileTemplate, (httpT, wsT, authT))
+    httpTaskF, wsTaskF, httpSlotF, wsSlotF = map(compileTemplate,
+        (httpTask, wsTask, httpSlot, wsSlot))
 
     def __init__(self, config, marathonHost=None):
-        with open (config) as stream:
-            self.config = json.loads(stream.read())
+        self.configFile     = config
+        self.marathonHost   = None
+        self.configStamp    = None
+        self.configLock     = threading.Lock()
+        self.refreshLock    = threading.RLock()
+        self.index          = TaskIndex()
+        self.deployed       = None
+        self.refreshCount   = 0
+        self.skippedCount   = 0
+        self.runtimeCount   = 0
+        self.lastReloadAt   = None
+        self.reloadPending  = False
+        self.slots          = SlotTable()
+        self.fragments      = {}
+        self.fragmentHits   = 0
+        self.fragmentMisses = 0
 
         if marathonHost:
             self.marathonHost = 'http://' + marathonHost + ':8080/v2'
+
+        self.loadConfig()
+
+        self.hostCache      = HostCache(self.config.get('host_ttl', 300),
+            self.config.get('resolver_pool_size', 16))
+        self.hostRefresher  = Periodic(self.hostCache.ttl, self.hostCache.refresh, 'host-refresh')
+        self.resyncer       = Periodic(self.config.get('resync_interval', 300),
+            self.reconcile, 'resync')
+        self.weighter       = Periodic(self.config.get('weights_interval', 10),
+            self.adjustWeights, 'weights')
+        self.fanoutRetrier  = Periodic(self.config.get('fanout_retry_interval', 30),
+            self.retryFanOut, 'fanout-retry')
+        self.tracer         = Tracer(self.config.get('trace_buffer_size', 100),
+            self.config.get('trace_profile_threshold'),
+            self.config.get('trace_profile_interval', 0.005))
+        self.resolveHosts()
+
+    # The settings below are read through the current config, so that a
+    # reload swaps all of them at once.
+    services    = property(lambda self: self.config['services'])
+    configDest  = property(lambda self: self.config['config_destination'])
+    usersConfig = property(lambda self: self.config['users_config_destination'])
+    pidFile     = property(lambda self: self.config['pid_file'])
+    runtimeUpdates = property(lambda self: self.config.get('runtime_updates', False))
+    masterWorker = property(lambda self: self.config.get('master_worker', False))
+    resolveTaskHosts = property(lambda self: self.config.get('resolve_task_hosts', False))
+
+    def sessionRules(self, tuning):
+        """
+        The websocket session rules for the HAProxy the config is meant for.
+        Master-worker mode, runtime updates and threads all need HAProxy 1.8
+        or later, so they get a stick table, unless *session_stickiness* is
+        set to `appsession` or `stick_table`.
+        """
+        setting = self.config.get('session_stickiness', 'auto')
+        if setting == 'auto':
+            modern = self.masterWorker or self.runtimeUpdates or tuning.nbthread
+            setting = 'stick_table' if modern else 'appsession'
+
+        return self.stickTableRules if setting == 'stick_table' else self.appsessionRules
+
+    @property
+    def master(self):
+        settings = (self.configDest, self.pidFile,
+            self.config.get('master_socket', '/var/run/haproxy-master.sock'))
+        current = getattr(self, '_master', None)
+        if current is None or (current.configFile, current.pidFile, current.masterSocket) != settings:
+            self._master = HAProxyMaster(*settings)
+
+        return self._master
+
+    @property
+    def publisher(self):
+        keep = self.config.get('config_history', 5)
+        current = getattr(self, '_publisher', None)
+        if current is None or (current.destination, current.keep) != (self.configDest, keep):
+            self._publisher = ConfigPublisher(self.configDest, keep)
+
+        return self._publisher
+
+    @property
+    def snapshots(self):
+        """
+        Where the last known tasks are kept for a warm start, if anywhere.
+        """
+        path = self.config.get('snapshot_path')
+        if path is None:
+            return None
+
+        current = getattr(self, '_snapshots', None)
+        if current is None or current.path != path:
+            self._snapshots = SnapshotStore(path)
+
+        return self._snapshots
+
+    @property
+    def fanout(self):
+        """
+        What pushes the config on to the edge targets, if there are any.
+        """
+        c = self.config
+        settings = (c.get('fanout_targets') or [], c.get('fanout_quorum'),
+            c.get('fanout_timeout', 30), c.get('fanout_pool_size', 8))
+        if not settings[0]:
+            return None
+
+        if settings != getattr(self, 'fanoutSettings', None):
+            targets, quorum, timeout, poolSize = settings
+            self._fanout = ConfigFanout([makeTarget(target) for target in targets],
+                quorum, timeout, poolSize)
+            self.fanoutSettings = settings
+
+        return self._fanout
+
+    @property
+    def runtime(self):
+        return RuntimeAPI(self.config.get('stats_socket', '/var/lib/haproxy/stats'))
+
+    @property
+    def weights(self):
+        c = self.config
+        settings = (c.get('stats_socket', '/var/lib/haproxy/stats'), c.get('weights_floor', 10),
+            c.get('weights_ceiling', 256), c.get('weights_smoothing', 0.3),
+            c.get('weights_damping', 0.5), c.get('weights_dry_run', False))
+        if settings != getattr(self, 'weightSettings', None):
+            path, floor, ceiling, smoothing, damping, dryRun = settings
+            self._weights = AdaptiveWeights(RuntimeAPI(path), floor=floor, ceiling=ceiling,
+                smoothing=smoothing, damping=damping, dryRun=dryRun)
+            self.weightSettings = settings
+
+        return self._weights
+
+    def start(self):
+        """
+        Start the background chores that every long-lived orchestrator runs,
+        even one that only takes events for another: keeping the Marathon
+        hosts that events are checked against resolved.
+        """
+        self.hostRefresher.start()
+        return self
+
+    def lead(self):
+        """
+        Start the background chores of the one orchestrator that applies
+        events: resyncs, weight adjustments and retried pushes to edges.
+        """
+        self.resyncer.start()
+        self.weighter.start()
+        self.fanoutRetrier.start()
+        return self
+
+    def subscribe(self, handler):
+        """
+        Take status updates for tracked apps from Marathon's event stream,
+        passing each to handler.  After a lost connection, the task index is
+        resynced, since events may have been missed.
+        """
+        self.events = EventStream(self.cluster, handler, self.isAppTracked,
+            onReconnect=self.reconcile,
+            readTimeout=self.config.get('event_stream_timeout', 300))
+
+        return self.events.start()
+
+    def stamp(self):
+        st = os.stat(self.configFile)
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def loadConfig(self):
+        stamp = self.stamp()
+        with open (self.configFile) as stream:
+            config = json.loads(stream.read())
+
+        # Edge targets get the config as rendered here, so it must not be
+        # tuned for this machine.
+        detected = hostSettings(config) if config.get('fanout_targets') else []
+        if detected:
+            raise ValueError('{0} must be set explicitly, not auto, with fanout_targets'.format(
+                ', '.join(detected)))
+
+        if self.marathonHost:
+            urls = [self.marathonHost]
         else:
-            self.marathonHost = 'http://' + self.config['marathon_hosts'][0] + '/v2'
+            urls = ['http://' + host + '/v2' for host in config['marathon_hosts']]
+
+        # Keep the existing client, and its warm connections, unless the
+        # Marathon settings actually changed.
+        settings = (urls, config.get('marathon_timeout'), config.get('marathon_retries'))
+        if settings != getattr(self, 'clusterSettings', None):
+            self.cluster = Marathon(urls,
+                timeout=tuple(config.get('marathon_timeout', (3.05, 10))),
+                retries=config.get('marathon_retries', 2))
+            self.clusterSettings = settings
 
-        self.cluster        = Marathon(self.marathonHost)
-        self.services       = self.config['services']
-        self.configDest     = self.config['config_destination']
-        self.usersConfig    = self.config['users_config_destination']
-        self.pidFile        = self.config['pid_file']
-        self.approvedHosts  = self.resolveHosts()
+        self.config      = config
+        self.configStamp = stamp
+
+    def checkConfig(self):
+        """
+        Reload the config file if it has changed on disk since it was last
+        read.  A file that fails to parse is logged and ignored, and the
+        previous config stays in effect.
+        """
+        try:
+            if self.stamp() == self.configStamp:
+                return False
+        except OSError as e:
+            logger.warning('Cannot stat config {0}: {1}'.format(self.configFile, e))
+            return False
+
+        with self.configLock:
+            try:
+                if self.stamp() == self.configStamp:
+                    return False
+                self.loadConfig()
+            except (IOError, OSError, ValueError, KeyError) as e:
+                logger.error('Ignoring unreadable config {0}: {1}'.format(self.configFile, e))
+                return False
+
+        logger.info('Reloaded config {0}'.format(self.configFile))
+        return True
+
+    @property
+    def approvedHosts(self):
+        return self.resolveHosts()
 
     def resolveHosts(self):
         hosts = []
 
         for host in self.config['marathon_hosts']:
             host = host.split(':')[0]
- 	    print 'host = ', host
-            hosts.append(socket.gethostbyname(host))
+            hosts.append(self.hostCache.lookup(host))
 
         return hosts
 
     def startHaproxy(self):
-        ipAddr = self.approvedHosts[0]
-        appId = self.config['services'].keys()[0]
+        """
+        Write a fresh config and start HAProxy, even if the config on disk is
+        already up to date.
+        """
+        with self.refreshLock:
+            self.refreshConfig()
+            self.restartHAProxy()
 
-        self.reloadHAProxy(ipAddr, {'appId': appId })
+    def warmStart(self):
+        """
+        Start HAProxy on the last known tasks, from the saved snapshot, and
+        reconcile with Marathon in the background, so that coming up does not
+        wait on Marathon.  Without a snapshot, this is startHaproxy().
+        Returns the reconciling thread, if there is one.
+        """
+        saved = self.snapshots.load() if self.snapshots else None
+        if saved is None:
+            return self.startHaproxy()
+
+        snapshot, savedAt, savedDigest = saved
+        logger.info('Warm start from {0} task(s) saved {1:.0f}s ago'.format(
+            sum(len(tasks) for tasks in snapshot.itervalues()), time.time() - (savedAt or 0)))
+
+        with self.refreshLock:
+            self.checkConfig()
+            self.index.replace(snapshot)
+            self.refreshSnapshot(snapshot)
+            self.restartHAProxy()
+
+        thread = threading.Thread(target=self.reconcile, name='warm-start')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def haproxyRunning(self):
+        """
+        Whether HAProxy is up: its master answers, in master-worker mode, or
+        else the process in its pidfile is alive.
+        """
+        if self.masterWorker:
+            return self.master.running()
+
+        pid = readPid(self.pidFile)
+        if pid is None:
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            # HAProxy runs as root, so another user may only be refused.
+            return e.errno == errno.EPERM
+        return True
+
+    def warmStartOnce(self):
+        """
+        warmStart(), unless HAProxy was already warm started on this host
+        since it booted and is still running, e.g. when another worker takes
+        over as leader.  Then only reconcile with Marathon.
+        """
+        marker = self.configDest + '.started'
+        try:
+            with open('/proc/sys/kernel/random/boot_id') as stream:
+                boot = stream.read().strip()
+        except IOError:
+            boot = ''
+
+        try:
+            with open(marker) as stream:
+                started = stream.read().strip() == boot
+        except IOError:
+            started = False
+
+        if started and self.haproxyRunning():
+            logger.info('HAProxy already started on this host, reconciling only')
+            return self.reconcile()
+
+        self.warmStart()
+        with open(marker, 'w') as stream:
+            stream.write(boot)
 
     def validRequest(self, ipAddr, appId):
         return self.isAppTracked(appId) and self.isApprovedHost(ipAddr)
@@ -146,156 +532,512 @@ ${wsServices}
 
     def isAppTracked(self, appId):
         tapp = appId[1:] if appId.startswith ('/') else appId
-        logger.info ("Testing is tracked for {0}".format (tapp))
-        logger.info ("services: {0}".format (self.services))
         tracked = tapp in self.services
-        logger.info ("Tracked: {0}".format (tracked))
+        logger.debug ("App {0} tracked: {1}".format (tapp, tracked))
         return tracked
 
     def gen(self):
-        apps = self.cluster.getApps()
-        services = []
+        return self.render(self.resync()[0])
+
+    def resync(self):
+        """
+        Fetch a full snapshot of the tracked apps from Marathon, and replace
+        the task index with it.  Returns the snapshot, and whether the index
+        had drifted from it.
+        """
+        with span('resync'):
+            snapshot = self.cluster.getSnapshot(self.services.keys(),
+                self.config.get('marathon_pool_size', 8))
+
+            return snapshot, self.index.replace(snapshot)
+
+    def reconcile(self):
+        """
+        The periodic full resync.  The config is only rewritten if the task
+        index turns out to have drifted from Marathon.
+        """
+        with self.tracer.trace('resync') as trace, self.refreshLock:
+            with span('check_config'):
+                self.checkConfig()
+            snapshot, drifted = self.resync()
+
+            trace.outcome = 'unchanged'
+            if drifted:
+                logger.info('Resync found the task index out of date, rewriting config')
+                trace.outcome = self.refreshAndRestart(snapshot)
+            elif self.reloadPending:
+                logger.info('Resync retrying the reload that failed')
+                trace.outcome = self.refreshAndRestart(snapshot)
+
+    def deployedConfig(self):
+        """
+        The digest, layout and backend servers of the config currently at the
+        destination, read from disk the first time and remembered after that.
+        """
+        if self.deployed is None or self.deployed[0] != self.configDest:
+            scanner = ConfigScanner()
+            if os.path.exists(self.configDest):
+                with open(self.configDest) as stream:
+                    for line in stream:
+                        scanner.write(line.decode('utf-8'))
+            scanner.close()
+
+            self.deployed = (self.configDest, scanner.digest(), scanner.layout(),
+                scanner.servers)
 
-        for app in apps:
-            appId = app['id']
+        return self.deployed[1:]
 
-            appId = appId[1:] if appId.startswith ('/') else appId
+    def render(self, snapshot):
+        """
+        Render the HAProxy config for a snapshot of the cluster, i.e. an
+        ordered dictionary of tracked appId to its running tasks.
+        """
+        output = StringIO()
+        self.renderTo(output, snapshot)
+        return output.getvalue()
 
+    def renderTo(self, output, snapshot):
+        """
+        Write the config for a snapshot to output a section at a time.  The
+        sections of each app are cached, keyed on the app's service config
+        and servers, so only the apps that changed are rendered again.  With
+        *fragment_cache* off, every app is rendered every time instead, and
+        no copy of the config is kept between renders.
+        """
+        with renderSeconds.time(), span('render'):
+            self.renderSections(output, snapshot)
+
+    def renderSections(self, output, snapshot):
+        statsSocket = self.config.get('stats_socket', '/var/lib/haproxy/stats')
+        if self.masterWorker:
+            # Lets new workers take over the listening sockets on reload.
+            statsSocket += ' expose-fd listeners'
+
+        tuning = Tuning(self.config)
+        context = tuning.context()
+        context["statsSocket"] = statsSocket
+        output.write(self.configHead % context)
+
+        fragments = {}
+        caching = self.config.get('fragment_cache', True)
+        addresses = self.resolveTasks(snapshot) if self.resolveTaskHosts else None
+        session = self.sessionRules(tuning)
+
+        for appId, tasks in snapshot.iteritems():
             if not appId in self.services:
                 logger.info ("Ignoring app {0} not in listed services".format (appId))
                 continue
 
             app = self.services[appId]
-            port = app['port']
-            backend_port = None
-            single_host = None
-
-            if 'backend_port' in app:
-                backend_port = app['backend_port']
-            if 'single_host' in app:
-                single_host = app['single_host']
-
-
-            lines = []
-            wsLines = []
-
-            if appId in self.services.keys():
-                tasks = self.cluster.getTasks(appId)
-                c = 0
-
-                if single_host:
-                        print "WARNING: Using single host for:", appId
-                        context = {
-                            "id" : "%s-%s" % ('app', appId),
-                            "host" : single_host,
-                            "port" : backend_port
-                        }
-                        lines.append(self.httpTask.substitute(context))
-                        wsLines.append(self.wsTask.substitute(context))
-                else:
-                    for task in tasks:
-                        # NOTE: The method of getting the appId below is quirky to support
-                        # two different versions of marathon. The latest uses 'appId'.
-                        aid = task.get('appId', task.get('appID', 'app'))
-                        aid = aid[1:] if aid.startswith ('/') else iad
-                        context = {
-                            "id" : "%s-%s" % (aid, c),
-                            "host" : task['host'],
-                            "port" : backend_port if backend_port else task['ports'][0]
-                        }
-
-                        lines.append(self.httpTask.substitute(context))
-                        wsLines.append(self.wsTask.substitute(context))
-                        c += 1
-
-            auth = ""
-
-            if 'authConf' in app:
-                auth = self.authT.substitute(app)
-
-            httpService = self.httpT.substitute({
-                "id" : appId,
-                "port" : port,
-                "auth" : auth,
-                "httpServices" : ''.join(lines)
-            })
+            servers = self.appServers(appId, app, tasks, addresses)
+            bind = tuning.bind(app)
+            if not caching:
+                self.fragmentMisses += 1
+                output.write(self.renderApp(appId, app, servers, bind, session))
+                continue
+
+            key = (json.dumps(app, sort_keys=True), bind, session["session"], servers)
+
+            cached = self.fragments.get(appId)
+            if cached is not None and cached[0] == key:
+                self.fragmentHits += 1
+                fragment = cached[1]
+            else:
+                self.fragmentMisses += 1
+                fragment = self.renderApp(appId, app, servers, bind, session)
+
+            fragments[appId] = (key, fragment)
+            output.write(fragment)
+
+        # Apps that are gone from the snapshot drop out of the cache here.
+        self.fragments = fragments
+
+        output.write(self.configTail % context)
+
+    def resolveTasks(self, snapshot):
+        """
+        The addresses of every host the tracked apps of snapshot run on, as
+        {host: ip}, looked up together through the host cache.
+        """
+        hosts = set()
+        for appId, tasks in snapshot.iteritems():
+            app = self.services.get(appId)
+            if app is None:
+                continue
+            if app.get('single_host'):
+                hosts.add(app['single_host'])
+            else:
+                hosts.update(task.host for task in asTasks(tasks))
+
+        return self.hostCache.lookupAll(hosts)
 
-            wsService = self.wsT.substitute({
-                "id" : appId,
+    def appServers(self, appId, app, tasks, addresses=None):
+        """
+        The servers of an app as a tuple of (id, host, port, disabled, comment),
+        where disabled is None for a plain server and a string for a server
+        slot.  Given addresses, from resolveTasks, hosts are written as their
+        IP with the hostname in the comment; a host that could not be resolved
+        is left for HAProxy to look up.  Tasks are sorted by address, so the
+        same set of tasks always renders the same config, whatever order
+        Marathon lists them in.
+        """
+        backend_port = app.get('backend_port')
+        single_host = app.get('single_host')
+
+        def address(host):
+            ip = addresses.get(host) if addresses else None
+            if ip is None or ip == host:
+                return host, ""
+            return ip, " # " + host
+
+        if single_host:
+            host, comment = address(single_host)
+            return (("%s-%s" % ('app', appId), host, backend_port, None, comment),)
+
+        addrs = []
+        comments = {}
+        tasks = asTasks(tasks)
+        for task in tasks:
+            host, comment = address(task.host)
+            addr = (host, backend_port if backend_port else task.ports[0])
+            addrs.append(addr)
+            comments[addr] = comment
+        addrs.sort()
+
+        if self.runtimeUpdates:
+            capacity = max(len(addrs),
+                app.get('max_instances', self.config.get('default_slots', 10)))
+
+            servers = []
+            for i, addr in enumerate(self.slots.assign(appId, addrs, capacity)):
+                host, port = addr or self.emptySlot
+                servers.append(("%s-%s" % (appId, i), host, port, "" if addr else " disabled",
+                    comments.get(addr, "")))
+            return tuple(servers)
+
+        # NOTE: Task records take the appId from either of the two versions
+        # of marathon, the latest of which uses 'appId' rather than 'appID'.
+        aid = (tasks[0].appId or 'app') if tasks else appId
+        aid = aid[1:] if aid.startswith ('/') else aid
+
+        return tuple(("%s-%s" % (aid, c), host, port, None, comments[(host, port)])
+            for c, (host, port) in enumerate(addrs))
+
+    def renderApp(self, appId, app, servers, bind='', session=None):
+        """
+        The frontend and backend sections of one app, with bind the options
+        for its bind line, and session its websocket session rules.
+        """
+        if app.get('single_host'):
+            logger.warning('Using single host for {0}'.format(appId))
+
+        lines = []
+        wsLines = []
+
+        for id, host, port, disabled, comment in servers:
+            context = {
+                "id" : id,
+                "host" : host,
                 "port" : port,
-                "wsServices" : ''.join(wsLines)
-            })
+                "disabled" : disabled,
+                "comment" : comment
+            }
+            if disabled is None:
+                lines.append(self.httpTaskF % context)
+                wsLines.append(self.wsTaskF % context)
+            else:
+                lines.append(self.httpSlotF % context)
+                wsLines.append(self.wsSlotF % context)
+
+        auth = ""
+
+        if 'authConf' in app:
+            auth = self.authF % app
+
+        httpService = self.httpF % {
+            "id" : appId,
+            "port" : app['port'],
+            "bind" : bind,
+            "auth" : auth,
+            "httpServices" : ''.join(lines)
+        }
+
+        wsContext = {
+            "id" : appId,
+            "port" : app['port'],
+            "wsServices" : ''.join(wsLines)
+        }
+        wsContext.update(session or self.appsessionRules)
+        wsService = self.wsF % wsContext
+
+        return '{0}{1}'.format(httpService, wsService)
+
+    def stats(self):
+        return {
+            'refreshes': self.refreshCount,
+            'skipped': self.skippedCount,
+            'runtime_updates': self.runtimeCount,
+            'reload_pending': self.reloadPending,
+            'fragments_cached': len(self.fragments),
+            'fragment_hits': self.fragmentHits,
+            'fragment_misses': self.fragmentMisses,
+            'fanout': self.fanout.stats() if self.fanout else None,
+            'master': self.master.stats() if self.masterWorker else None
+        }
+
+    def refreshConfig(self, configText=None):
+        """
+        Put the config in place, unless it is identical to the deployed one.
+        Returns True if the config changed and HAProxy needs a restart.  In
+        runtime update mode, a config whose layout is unchanged is applied
+        through the stats socket instead, and needs no restart.  Without a
+        config, one is rendered from a fresh snapshot of Marathon.
+        """
+        if configText is None:
+            return self.refreshSnapshot(self.resync()[0])
+
+        return self.deploy(scan(configText), lambda: self.publisher.publish(configText))
+
+    def refreshSnapshot(self, snapshot):
+        """
+        refreshConfig() for the config of a snapshot, which is streamed to
+        the destination as it is rendered rather than built up in memory.
+        """
+        pending = self.publisher.begin()
+        try:
+            scanner = ConfigScanner(pending)
+            self.renderTo(scanner, snapshot)
+            scanner.close()
+        except:
+            pending.discard()
+            raise
+
+        changed = self.deploy(scanner, pending.commit, pending.discard)
+        self.saveSnapshot(snapshot, scanner.digest())
+        return changed
+
+    def refreshAndRestart(self, snapshot):
+        """
+        refreshSnapshot(), and restart HAProxy if that needs it.  Returns
+        what came of it, for the trace.
+        """
+        if not self.refreshSnapshot(snapshot):
+            outcome = 'no_reload'
+        else:
+            outcome = 'reloaded' if self.restartHAProxy() else 'reload_failed'
 
-            services.append('{0}{1}'.format(httpService, wsService))
+        if self.fanOut() is False:
+            outcome += ', fanout_below_quorum'
+        return outcome
+
+    def fanOut(self):
+        """
+        Push the deployed config to the edge targets that do not have it yet.
+        Returns whether the quorum of them has it, or None without targets.
+        """
+        fanout = self.fanout
+        if fanout is None or not os.path.exists(self.configDest):
+            return None
+
+        configDigest = self.deployedConfig()[0]
+        if not fanout.behind(configDigest):
+            return True
+
+        with span('fan_out'):
+            with open(self.configDest) as stream:
+                configText = stream.read().decode('utf-8')
+            return fanout.push(configText, configDigest)
+
+    def retryFanOut(self):
+        """
+        The periodic push to edge targets that missed the deployed config.
+        """
+        if self.fanout is None:
+            return None
+
+        with self.refreshLock:
+            self.checkConfig()
+            return self.fanOut()
+
+    def saveSnapshot(self, snapshot, configDigest):
+        """
+        Keep the snapshot behind the deployed config for a warm start.  It is
+        only written when the config differs from the one last saved.
+        """
+        if self.snapshots is None:
+            return
+
+        try:
+            with span('save_snapshot'):
+                self.snapshots.save(snapshot, configDigest)
+        except (IOError, OSError) as e:
+            logger.error('Could not save snapshot to {0}: {1}'.format(self.snapshots.path, e))
+
+    def deploy(self, scanner, commit, discard=None):
+        """
+        Commit a scanned config, unless it is identical to the deployed one,
+        and work out whether HAProxy needs a restart for it.  The deployed
+        config still needs one if the last reload onto it failed.
+        """
+        newDigest = scanner.digest()
+        oldDigest, oldLayout, oldServers = self.deployedConfig()
+
+        if newDigest == oldDigest:
+            if discard:
+                discard()
+            if self.reloadPending:
+                logger.info('Config unchanged, but the last reload failed, reloading again')
+                return True
+            self.skippedCount += 1
+            reloadsSkipped.inc(reason='unchanged')
+            logger.info('Config unchanged, skipping write and restart ({0} skipped so far)'
+                .format(self.skippedCount))
+            return False
 
-        return self.configT.substitute({ "services" : "".join(services) })
+        newLayout = scanner.layout()
+        newServers = scanner.servers
+        logger.info('Config changed: {0}'.format(
+            summarizeChanges(membership(oldServers), membership(newServers))))
 
-    def refreshConfig(self):
-        configText = self.gen()
-        tmpConfig = self.writeTmpConfig(configText)
+        with span('publish'):
+            commit()
+        self.deployed = (self.configDest, newDigest, newLayout, newServers)
 
-        logger.info("Copying temp config to destination: {0}".format(self.configDest))
-        subprocess.call("cp {0} {1}".format(tmpConfig, self.configDest).split(" "))
+        if self.runtimeUpdates and newLayout == oldLayout:
+            with span('runtime_update'):
+                updated = self.updateRuntime(oldServers, newServers)
 
+            if updated:
+                self.runtimeCount += 1
+                reloadsSkipped.inc(reason='runtime_update')
+                return False
+
+        self.refreshCount += 1
         return True
 
-    def writeTmpConfig(self, configText):
+    def updateRuntime(self, oldServers, newServers):
         """
-        A method to write the temporary config file.
+        Move the running HAProxy's server slots from old to new through the
+        stats socket.  Returns False if that failed, and a reload is needed.
         """
-        tmpConfig = os.path.join(ORCH_HOME, 'haproxy.cfg')
+        try:
+            moves, enables = slotCommands(oldServers, newServers)
+            logger.info('Applying {0} runtime command(s) instead of a restart'.format(
+                len(moves) + len(enables)))
+
+            self.runtime.execute(moves)
+            self.runtime.execute(enables)
+        except (socket.error, RuntimeAPIError) as e:
+            logger.error('Runtime update failed, falling back to a reload: {0}'.format(e))
+            return False
 
-        with open(tmpConfig, "w") as output:
-            output.write(configText)
+        return True
 
-        return tmpConfig
+    def rollback(self, steps=1):
+        """
+        Put back the config from the given number of publishes ago, and
+        restart HAProxy with it.
+        """
+        with self.refreshLock:
+            self.publisher.rollback(steps)
+            self.deployed = None
+            self.restartHAProxy()
 
     def restartHAProxy(self):
+        """
+        Reload HAProxy on the deployed config without dropping connections:
+        through the master in master-worker mode, or else by starting a new
+        HAProxy that soft-stops the old one.
+        """
         logger.info("Restarting HAProxy...")
-        pid = ""
 
-        if os.path.exists(self.pidFile):
-            proc = subprocess.Popen("cat {0}".format(self.pidFile).split(" "),
-                stdout=subprocess.PIPE)
-            pid = proc.stdout.read()
+        with reloadSeconds.time(), span('reload'):
+            if self.masterWorker:
+                ok = self.master.reload()
+            else:
+                ok = softReload([self.configDest], self.pidFile) == 0
 
-#        command = "haproxy -f {0} -f {1} -p {2} -D".format(
-#            self.configDest, self.usersConfig, self.pidFile)
-        command = "sudo haproxy -f {0} -p {1} -D".format(
-            self.configDest, self.pidFile)
+        reloadsTotal.inc(outcome='ok' if ok else 'failed')
+        self.reloadPending = not ok
+        if ok:
+            self.lastReloadAt = time.time()
 
-        if pid:
-            command = "sudo haproxy -f {0} -p {1} -D -st {2}".format(
-                self.configDest, self.pidFile, pid)
+        return ok
 
-        logger.info("Restarting HAProxy with commmand: {0}".format(command))
-        subprocess.call(command.split(" "))
+    def adjustWeights(self):
+        """
+        The periodic weight adjustment, when *adaptive_weights* is on.
+        """
+        if not self.config.get('adaptive_weights', False):
+            return None
 
-        return True
+        try:
+            return self.weights.update()
+        except (socket.error, RuntimeAPIError) as e:
+            logger.warning('Could not adjust server weights: {0}'.format(e))
+            return None
 
-    def reloadHAProxy(self, ipAddr, updateEvt):
+    def acceptEvent(self, ipAddr, updateEvt):
+        """
+        Check that an event came from a Marathon host and concerns an app we
+        track, i.e. that it is worth a config rewrite.
+        """
         # NOTE: The method of getting the appId below is quirky, to support
         # two different versions of marathon. The latest uses 'appId'.
         appId = updateEvt.get('appId', updateEvt.get('appID', 'app'))
         logger.info('reloadHaproxy received event from [{0}] for appId [{1}]'.format(
             str(ipAddr), appId))
 
+        self.checkConfig()
+
         # TODO: Should probably throw an error here.
         if not self.validRequest(ipAddr, appId):
             logger.info('reloadHaproxy rejecting invalid event')
             return False
 
         logger.info('App is tracked, and host is correct, proceeding with config rewrite...')
+        return True
 
-        ok = self.refreshConfig()
-        if ok:
-            self.restartHAProxy()
+    def applyEvents(self, events):
+        """
+        Rewrite the config and restart HAProxy once on behalf of a batch of
+        accepted events.  The events are applied to the task index, and the
+        config rendered from it, without asking Marathon; only events that
+        cannot be applied as deltas, or a change of config, cost a full
+        resync.
+        """
+        logger.info('Refreshing config for {0} event(s)'.format(len(events)))
 
-        return ok
+        with self.tracer.trace('events', events) as trace, self.refreshLock:
+            with span('check_config'):
+                reloaded = self.checkConfig()
+            with span('apply_deltas'):
+                deltas = [self.index.apply(evt) for evt in events]
+
+            if reloaded or None in deltas:
+                snapshot = self.resync()[0]
+            elif any(deltas):
+                snapshot = self.index.snapshot()
+            else:
+                logger.info('Events left the live tasks unchanged, nothing to do')
+                trace.outcome = 'unchanged'
+                return True
+
+            trace.outcome = self.refreshAndRestart(snapshot)
+
+        return True
+
+    def reloadHAProxy(self, ipAddr, updateEvt):
+        if not self.acceptEvent(ipAddr, updateEvt):
+            return False
+
+        return self.applyEvents([updateEvt])
 
     def updateApp(self, appId, newConfig):
         """
-        Updates the given app with the new configuration.
+        Updates the given app with the new configuration.  Returns the result
+        as a dictionary: whether it was ok, and either Marathon's deployment
+        id and app version, or the error.
 
         Example:
             appId: "skylr"
@@ -303,19 +1045,30 @@ ${wsServices}
 
         TODO: Do we do anything to limit the hosts that can update Apps?
         """
-        ok = False
-        if self.isAppTracked(appId):
-            ok = self.cluster.updateApp(appId, newConfig)
-        else:
+        if not self.isAppTracked(appId):
             logger.info('Not a valid updateApp request for [{0}] config: [{1}]'.
                 format(appId, newConfig))
+            return { 'ok': False, 'error': 'not a tracked app' }
 
-        return ok
+        try:
+            deployment = self.cluster.updateApp(appId, newConfig) or {}
+        except (MarathonError, requests.RequestException) as e:
+            logger.error('Updating app [{0}] failed: {1}'.format(appId, e))
+            return { 'ok': False, 'error': str(e) }
+
+        return {
+            'ok': True,
+            'deploymentId': deployment.get('deploymentId'),
+            'version': deployment.get('version')
+        }
 
-    def updateApps(self, config):
+    def updateApps(self, config, wait=False, timeout=300):
         """
         Take configurations for multiple apps in a dictionary, and apply them
-        using updateApp.
+        using updateApp, several at a time.  A failed update does not hold up
+        the others.  Returns the result of each app's update by appId; with
+        wait, once its deployment has finished or the timeout has run out,
+        which is noted as deployed True or False.
 
         Example apps configuration:
             {
@@ -324,8 +1077,32 @@ ${wsServices}
                 "scannr": { "cpus": 0.5, "mem": 128, "instances": 1 }
             }
         """
-        for appId, newConfig in config.iteritems():
-            self.updateApp(appId, newConfig)
+        self.checkConfig()
+        if not config:
+            return {}
+
+        pool = ThreadPool(min(self.config.get('marathon_pool_size', 8), len(config)))
+        try:
+            results = dict(zip(config.keys(),
+                pool.map(lambda item: self.updateApp(*item), config.items())))
+        finally:
+            pool.close()
+
+        deploymentIds = [result['deploymentId'] for result in results.values()
+            if result.get('deploymentId')]
+
+        if wait and deploymentIds:
+            try:
+                running = self.cluster.waitForDeployments(deploymentIds, timeout)
+            except (MarathonError, requests.RequestException) as e:
+                logger.error('Waiting for deployments failed: {0}'.format(e))
+                running = set(deploymentIds)
+
+            for result in results.values():
+                if result.get('deploymentId'):
+                    result['deployed'] = result['deploymentId'] not in running
+
+        return results
 
 def main():
     system = ServiceOrchestrator ('/etc/haproxy/conf.json')
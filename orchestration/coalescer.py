@@ -0,0 +1,127 @@
+"""
+**Coalescer** collects bursts of Marathon events and hands them to a single
+action once things have settled down.  A scale-up of fifty instances produces
+fifty *status_update_event* messages in quick succession; rather than
+regenerating and reloading HAProxy fifty times, we wait for a quiet window
+with no new events (capped by a maximum delay) and then reload once.
+"""
+
+import logging
+import logging.handlers
+import threading
+import time
+
+logger = logging.getLogger('Coalescer')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+class EventCoalescer(object):
+    """
+    Debounce events in front of an action.
+
+    The action is called with the list of events it absorbed, once no new
+    event has arrived for *quietWindow* seconds, or once *maxDelay* seconds
+    have passed since the first pending event, whichever comes first.
+    Times are read from *clock*.
+    """
+    def __init__(self, action, quietWindow=0.5, maxDelay=5.0, clock=time.time):
+        self.action      = action
+        self.quietWindow = quietWindow
+        self.maxDelay    = maxDelay
+        self.clock       = clock
+
+        self.lock     = threading.Condition()
+        self.applying = threading.Lock()
+        self.pending  = []
+        self.firstAt  = None
+        self.lastAt   = None
+        self.thread   = None
+
+        self.eventCount   = 0
+        self.reloadCount  = 0
+        self.lastAbsorbed = 0
+
+    def submit(self, evt):
+        """
+        Queue an event; the action will run on the coalescer's thread.
+        """
+        with self.lock:
+            now = self.clock()
+            if not self.pending:
+                self.firstAt = now
+            self.pending.append(evt)
+            self.lastAt = now
+            self.eventCount += 1
+
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='coalescer')
+                self.thread.daemon = True
+                self.thread.start()
+
+            self.lock.notify()
+
+    def flush(self):
+        """
+        Run the action immediately for anything pending, in the caller's thread.
+        """
+        with self.lock:
+            batch = self.take()
+
+        if batch:
+            self.fire(batch)
+
+    def take(self):
+        batch = self.pending
+        self.pending = []
+        self.firstAt = self.lastAt = None
+        return batch
+
+    def deadline(self):
+        return min(self.lastAt + self.quietWindow, self.firstAt + self.maxDelay)
+
+    def due(self):
+        """
+        The pending events, taken off, if the clock has reached their deadline.
+        """
+        if self.pending and self.clock() >= self.deadline():
+            return self.take()
+        return None
+
+    def run(self):
+        while True:
+            with self.lock:
+                batch = self.due()
+                while batch is None:
+                    if self.pending:
+                        self.lock.wait(max(0, self.deadline() - self.clock()))
+                    else:
+                        self.lock.wait()
+                    batch = self.due()
+
+            self.fire(batch)
+
+    def fire(self, batch):
+        with self.applying:
+            logger.info('Reloading once for {0} coalesced event(s)'.format(len(batch)))
+            try:
+                self.action(batch)
+            except Exception:
+                logger.exception('Coalesced reload failed')
+
+            self.reloadCount += 1
+            self.lastAbsorbed = len(batch)
+
+    def stats(self):
+        """
+        How many events came in, how many reloads they cost, and how many
+        events the most recent reload absorbed.
+        """
+        with self.lock:
+            pending = len(self.pending)
+
+        return {
+            'events': self.eventCount,
+            'reloads': self.reloadCount,
+            'last_absorbed': self.lastAbsorbed,
+            'pending': pending
+        }
@@ -0,0 +1,198 @@
+"""
+**Coordinator** lets several server processes, such as gunicorn workers,
+share one HAProxy.  Any worker can take Marathon's events, but only one of
+them, the leader, writes the config and reloads HAProxy.
+
+The leader is whichever worker holds an exclusive *flock* on a lock file
+next to the config.  The kernel drops the lock when its holder exits, so
+the other workers (followers) keep trying for it, and one of them takes
+over if the leader dies.  The leader listens on a unix datagram socket,
+and followers send it every event they accept, one JSON datagram each; a
+datagram arrives whole or not at all, and the leader's coalescer folds
+events from every worker into the same reloads.
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import logging.handlers
+import os
+import socket
+import threading
+
+from periodic import Periodic
+
+logger = logging.getLogger('Coordinator')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+# The largest event that is handed off; Marathon's status updates are a
+# fraction of this.
+MAX_EVENT = 65536
+
+class Coordinator(object):
+    def __init__(self, path, deliver, onElected=None, interval=5, timeout=1.0):
+        """
+        path is the base of the lock file and socket, e.g. the config
+        destination.  The leader passes each event it is handed to deliver,
+        and calls onElected once, when it becomes the leader.  Followers try
+        for the lock every interval seconds, and give up on a hand-off after
+        timeout seconds.
+        """
+        self.lockPath   = path + '.lock'
+        self.socketPath = path + '.events'
+        self.deliver    = deliver
+        self.onElected  = onElected
+        self.timeout    = timeout
+
+        self.lock       = threading.Lock()
+        self.lockFile   = None
+        self.listener   = None
+        self.sender     = None
+        self.elector    = Periodic(interval, self.elect, 'elect')
+
+        self.forwarded  = 0
+        self.received   = 0
+        self.failed     = 0
+
+    isLeader = property(lambda self: self.lockFile is not None)
+
+    def start(self):
+        """
+        Try to become the leader now, and keep trying in the background.
+        """
+        if not self.elect():
+            self.elector.start()
+        return self
+
+    def elect(self):
+        """
+        Take the lock if it is free.  Returns whether this worker leads.
+        """
+        with self.lock:
+            if self.isLeader:
+                return True
+
+            lockFile = open(self.lockPath, 'a')
+            try:
+                fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                lockFile.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                    raise
+                return False
+
+            self.lockFile = lockFile
+            self.listen()
+
+        logger.info('Worker {0} is now the leader'.format(os.getpid()))
+        self.elector.stop()
+        if self.onElected:
+            self.onElected()
+        return True
+
+    def listen(self):
+        # Only the lock holder gets here, so a socket left behind is stale.
+        try:
+            os.unlink(self.socketPath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.listener.bind(self.socketPath)
+        os.chmod(self.socketPath, 0600)
+
+        thread = threading.Thread(target=self.receive, args=(self.listener,), name='handoff')
+        thread.daemon = True
+        thread.start()
+
+    def receive(self, listener):
+        while True:
+            data = listener.recv(MAX_EVENT)
+            if not data and listener is not self.listener:
+                # Shut down by resign().
+                listener.close()
+                return
+
+            try:
+                evt = json.loads(data)
+            except ValueError:
+                logger.warning('Ignoring a malformed event from a worker')
+                continue
+
+            self.received += 1
+            try:
+                self.deliver(evt)
+            except Exception:
+                logger.exception('Failed to deliver an event from a worker')
+
+    def resign(self):
+        """
+        Stop leading, so that another worker can take over, e.g. on shutdown.
+        """
+        with self.lock:
+            if not self.isLeader:
+                return
+
+            listener, self.listener = self.listener, None
+            try:
+                os.unlink(self.socketPath)
+            except OSError:
+                pass
+            # Wakes up the receiving thread, which closes the socket.
+            listener.shutdown(socket.SHUT_RDWR)
+
+            self.lockFile.close()
+            self.lockFile = None
+
+        logger.info('Worker {0} has stopped leading'.format(os.getpid()))
+
+    def submit(self, evt):
+        """
+        Deliver an event here if this worker leads, or hand it to the leader.
+        A follower that cannot reach the leader tries to take over instead.
+        Returns whether the event went anywhere.
+        """
+        if self.isLeader:
+            self.deliver(evt)
+            return True
+
+        if self.forward(evt):
+            return True
+
+        if self.elect():
+            self.deliver(evt)
+            return True
+
+        self.failed += 1
+        return False
+
+    def forward(self, evt):
+        data = json.dumps(evt)
+        if len(data) > MAX_EVENT:
+            logger.error('Event of {0} bytes is too big to hand off'.format(len(data)))
+            return False
+
+        try:
+            with self.lock:
+                if self.sender is None:
+                    self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    self.sender.settimeout(self.timeout)
+                self.sender.sendto(data, self.socketPath)
+        except socket.error as e:
+            logger.warning('Failed to hand an event to the leader: {0}'.format(e))
+            return False
+
+        self.forwarded += 1
+        return True
+
+    def stats(self):
+        return {
+            'leader': self.isLeader,
+            'pid': os.getpid(),
+            'forwarded': self.forwarded,
+            'received': self.received,
+            'failed': self.failed
+        }
@@ -0,0 +1,117 @@
+"""
+**EventQueue** separates taking in events from processing them.  Producers
+put events on a bounded queue and return at once; a single worker thread
+drains the queue in order.  When the queue is full, the overflow policy
+decides what gives: the new event (*drop_newest*), the oldest queued one
+(*drop_oldest*), or the producer, which waits up to a timeout (*block*).
+"""
+
+import logging
+import logging.handlers
+import Queue
+import threading
+import time
+
+logger = logging.getLogger('EventQueue')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+POLICIES = ('drop_newest', 'drop_oldest', 'block')
+
+class EventQueue(object):
+    def __init__(self, handler, maxsize=1000, overflow='drop_oldest', blockTimeout=1.0):
+        if overflow not in POLICIES:
+            raise ValueError('Unknown overflow policy: {0}'.format(overflow))
+
+        self.handler      = handler
+        self.overflow     = overflow
+        self.blockTimeout = blockTimeout
+        self.queue        = Queue.Queue(maxsize)
+        self.lock         = threading.Lock()
+        self.thread       = None
+
+        self.enqueued     = 0
+        self.dropped      = 0
+        self.processed    = 0
+        self.totalWait    = 0.0
+        self.lastWait     = 0.0
+        self.maxWait      = 0.0
+
+    def put(self, item):
+        """
+        Queue an item for the worker.  Returns False if it was dropped.
+        """
+        self.ensureWorker()
+        entry = (time.time(), item)
+
+        try:
+            if self.overflow == 'block':
+                self.queue.put(entry, timeout=self.blockTimeout)
+            elif self.overflow == 'drop_newest':
+                self.queue.put_nowait(entry)
+            else:
+                self.putDroppingOldest(entry)
+        except Queue.Full:
+            self.dropped += 1
+            logger.warning('Event queue full, dropped an event ({0} so far)'.format(self.dropped))
+            return False
+
+        self.enqueued += 1
+        return True
+
+    def putDroppingOldest(self, entry):
+        while True:
+            try:
+                return self.queue.put_nowait(entry)
+            except Queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                    logger.warning('Event queue full, dropped the oldest event ({0} so far)'
+                        .format(self.dropped))
+                except Queue.Empty:
+                    pass
+
+    def ensureWorker(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='event-queue')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            enqueuedAt, item = self.queue.get()
+            wait = time.time() - enqueuedAt
+
+            self.lastWait = wait
+            self.maxWait = max(self.maxWait, wait)
+            self.totalWait += wait
+
+            try:
+                self.handler(item)
+            except Exception:
+                logger.exception('Event handler failed')
+            finally:
+                self.processed += 1
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Wait until every queued item has been processed.
+        """
+        self.queue.join()
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'capacity': self.queue.maxsize,
+            'overflow': self.overflow,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'processed': self.processed,
+            'last_wait_seconds': self.lastWait,
+            'max_wait_seconds': self.maxWait,
+            'mean_wait_seconds': self.totalWait / self.processed if self.processed else 0.0
+        }
@@ -0,0 +1,198 @@
+"""
+**ConfigFanout** pushes the config that one orchestrator renders to several
+HAProxy edge nodes, so that only one orchestrator asks Marathon for tasks.
+Each edge is a *target*, reached through a transport:
+
+ * **directory**: the config is published atomically to a path, e.g. on a
+   mount of the edge or a local directory, and an optional command reloads
+   the edge on it.
+ * **command**: the config is piped to a command, e.g. an ssh that writes
+   it into place and reloads HAProxy, which must exit 0.
+
+Targets are pushed to concurrently, each within a timeout.  A push counts
+when a target has taken the config; the fan-out succeeds when at least
+*quorum* targets have the current config.  A target that failed keeps the
+config it had, and is pushed to again until it catches up, while targets
+that are already up to date are left alone.
+"""
+
+import logging
+import logging.handlers
+from multiprocessing.pool import ThreadPool
+import subprocess
+import threading
+import time
+
+from metrics import Counter, Histogram
+from publisher import ConfigPublisher
+from tracing import bind, span
+
+logger = logging.getLogger('ConfigFanout')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+pushesTotal = Counter('orchestrator_fanout_pushes_total',
+    'Config pushes to edge targets, by target and outcome', ('target', 'outcome'))
+pushSeconds = Histogram('orchestrator_fanout_push_seconds',
+    'Time taken to push a config to an edge target and reload it', ('target',))
+quorumFailures = Counter('orchestrator_fanout_quorum_failures_total',
+    'Fan-outs that left fewer than the quorum of targets on the current config')
+
+class PushError(Exception):
+    pass
+
+def run(command, timeout, input=None):
+    """
+    Run command, feeding it input, and kill it after timeout seconds.  Raises
+    a PushError unless it exits 0.
+    """
+    process = subprocess.Popen(command, stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    killer = threading.Timer(timeout, process.kill)
+    killer.start()
+    try:
+        output = process.communicate(input)[0]
+    finally:
+        timedOut = not killer.is_alive() and process.returncode != 0
+        killer.cancel()
+
+    if timedOut:
+        raise PushError('{0} timed out after {1}s'.format(command[0], timeout))
+    if process.returncode != 0:
+        raise PushError('{0} exited {1}: {2}'.format(command[0], process.returncode,
+            output.strip()[-200:]))
+
+class DirectoryTarget(object):
+    def __init__(self, name, path, reload=None, keep=5):
+        """
+        Publishes to path, keeping keep previous configs, and then runs the
+        reload command, a list of arguments, if there is one.
+        """
+        self.name      = name
+        self.publisher = ConfigPublisher(path, keep)
+        self.reload    = reload
+
+    def push(self, configText, timeout):
+        self.publisher.publish(configText)
+        if self.reload:
+            run(self.reload, timeout)
+
+class CommandTarget(object):
+    def __init__(self, name, command):
+        """
+        Pipes the config to command, a list of arguments.
+        """
+        self.name    = name
+        self.command = command
+
+    def push(self, configText, timeout):
+        run(self.command, timeout, configText.encode('utf-8'))
+
+# The transports, by the type named in a target's settings.
+TRANSPORTS = {
+    'directory': DirectoryTarget,
+    'command': CommandTarget
+}
+
+def makeTarget(settings):
+    """
+    A target from its settings, e.g. {"type": "directory", "name": "edge1",
+    "path": "/mnt/edge1/haproxy.cfg", "reload": ["ssh", "edge1", "..."]}.
+    """
+    settings = dict(settings)
+    kind = settings.pop('type', 'directory')
+    if kind not in TRANSPORTS:
+        raise ValueError('Unknown fan-out transport {0}'.format(kind))
+
+    return TRANSPORTS[kind](**dict((str(key), value) for key, value in settings.items()))
+
+class ConfigFanout(object):
+    def __init__(self, targets, quorum=None, timeout=30, poolSize=8):
+        """
+        Pushes to targets, up to poolSize at a time, giving each timeout
+        seconds.  quorum is how many targets must take a config, by default
+        all of them.
+        """
+        self.targets  = targets
+        self.quorum   = len(targets) if quorum is None else min(quorum, len(targets))
+        self.timeout  = timeout
+        self.poolSize = poolSize
+        self.pushed   = {}
+        self.busy     = set()
+        self.results  = {}
+        self.lock     = threading.Lock()
+
+    def behind(self, configDigest):
+        """
+        The targets that do not have the config with configDigest yet.
+        """
+        return [target for target in self.targets if self.pushed.get(target.name) != configDigest]
+
+    def pushOne(self, target, configText, configDigest):
+        with self.lock:
+            if target.name in self.busy:
+                return { 'ok': False, 'error': 'previous push still running' }
+            self.busy.add(target.name)
+
+        start = time.time()
+        try:
+            with span('push {0}'.format(target.name)), pushSeconds.time(target=target.name):
+                target.push(configText, self.timeout)
+        except Exception as e:
+            logger.error('Pushing config to {0} failed: {1}'.format(target.name, e))
+            result = { 'ok': False, 'error': str(e) }
+        else:
+            with self.lock:
+                self.pushed[target.name] = configDigest
+            result = { 'ok': True }
+        finally:
+            with self.lock:
+                self.busy.discard(target.name)
+
+        result['seconds'] = round(time.time() - start, 3)
+        return result
+
+    def push(self, configText, configDigest):
+        """
+        Push the config to every target that does not have it yet.  Returns
+        whether the quorum of targets now has it.
+        """
+        pending = self.behind(configDigest)
+        if pending:
+            logger.info('Pushing config to {0} of {1} target(s)'.format(
+                len(pending), len(self.targets)))
+
+            pool = ThreadPool(min(self.poolSize, len(pending)))
+            pushOne = bind(self.pushOne)
+            calls = [(target, pool.apply_async(pushOne, (target, configText, configDigest)))
+                for target in pending]
+            pool.close()
+
+            # A target that hangs past its timeout, e.g. on a dead mount, is
+            # reported as such and left to finish on its own.
+            deadline = time.time() + self.timeout + 1
+            for target, call in calls:
+                try:
+                    result = call.get(max(0, deadline - time.time()))
+                except Exception:
+                    result = { 'ok': False, 'error': 'timed out after {0}s'.format(self.timeout),
+                        'seconds': self.timeout }
+
+                pushesTotal.inc(target=target.name, outcome='ok' if result['ok'] else 'failed')
+                result.update(digest=configDigest, at=time.time())
+                self.results[target.name] = result
+
+        current = len(self.targets) - len(self.behind(configDigest))
+        if current < self.quorum:
+            quorumFailures.inc()
+            logger.error('Only {0} of {1} target(s) have the current config, quorum is {2}'
+                .format(current, len(self.targets), self.quorum))
+            return False
+
+        return True
+
+    def stats(self):
+        return {
+            'quorum': self.quorum,
+            'targets': dict((target.name, self.results.get(target.name)) for target in self.targets)
+        }
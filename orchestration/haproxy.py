@@ -0,0 +1,233 @@
+"""
+**HAProxy** starts and reloads the load balancer itself.
+
+By default a reload starts a new HAProxy with *-sf*, which takes over the
+listeners and lets the old process finish its connections, rather than *-st*,
+which cuts them off.  In master-worker mode the orchestrator instead keeps a
+single long-running HAProxy master, and reloads it through the master CLI:
+the master starts new workers, hands them the listening sockets (with
+*expose-fd listeners*), and soft-stops the old ones, so no connection is
+dropped.  How long each reload takes, and how long the old workers take to
+drain, is tracked by a single background thread: closely until the new
+workers are up, and then every few seconds until the old ones are gone.
+"""
+
+import logging
+import logging.handlers
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+
+from publisher import readPid
+from runtime import RuntimeAPI
+
+logger = logging.getLogger('HAProxy')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+# Reloads whose old workers are still being waited on, beyond which the
+# oldest are no longer tracked.
+MAX_TRACKED = 16
+
+def softReload(configFiles, pidFile, binary='haproxy'):
+    """
+    Start HAProxy on the given configs, soft-stopping the one in the pidfile.
+    """
+    command = ['sudo', binary]
+    for configFile in configFiles:
+        command += ['-f', configFile]
+    command += ['-p', pidFile, '-D']
+
+    pid = readPid(pidFile)
+    if pid:
+        command += ['-sf', str(pid)]
+
+    logger.info('Reloading HAProxy with command: {0}'.format(' '.join(command)))
+    return subprocess.call(command)
+
+def parseProcs(text):
+    """
+    The current and old worker pids from the master CLI's *show proc*.
+    """
+    current, old = [], []
+    workers = current
+
+    for line in text.splitlines():
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == '#':
+            workers = old if 'old' in words else current
+            continue
+        if words[0].startswith('#'):
+            continue
+        if len(words) > 1 and words[1] == 'worker':
+            workers.append(int(words[0]))
+
+    return current, old
+
+class HAProxyMaster(object):
+    def __init__(self, configFile, pidFile, masterSocket, binary='haproxy',
+            reloadTimeout=30, drainTimeout=3600, pollInterval=0.1, drainInterval=5):
+        self.configFile    = configFile
+        self.pidFile       = pidFile
+        self.masterSocket  = masterSocket
+        self.binary        = binary
+        self.reloadTimeout = reloadTimeout
+        self.drainTimeout  = drainTimeout
+        self.pollInterval  = pollInterval
+        self.drainInterval = drainInterval
+
+        # The socket may carry bind options, e.g. "/path,mode,660".
+        self.cli = RuntimeAPI(masterSocket.split(',')[0])
+
+        self.reloadCount       = 0
+        self.failedCount       = 0
+        self.lastReloadSeconds = None
+        self.lastDrainSeconds  = None
+        self.oldWorkers        = 0
+
+        self.trackLock = threading.Lock()
+        self.tracked   = []
+        self.tracker   = None
+
+    def procs(self):
+        return parseProcs(self.cli.send('show proc'))
+
+    def running(self):
+        try:
+            self.procs()
+        except socket.error:
+            return False
+        return True
+
+    def start(self):
+        command = ['sudo', self.binary, '-W', '-S', self.masterSocket,
+            '-f', self.configFile, '-p', self.pidFile]
+
+        logger.info('Starting HAProxy master: {0}'.format(' '.join(command)))
+        return subprocess.call(command)
+
+    def reload(self):
+        """
+        Reload the workers, starting the master first if it is not running.
+        The reload and the draining of the old workers are timed by track().
+        """
+        try:
+            before, _ = self.procs()
+        except socket.error:
+            logger.info('HAProxy master is not running')
+            return self.start() == 0
+
+        start = time.time()
+        try:
+            response = self.cli.send('reload')
+        except socket.error as e:
+            # Older masters drop the connection on reload, or have no reload
+            # command; the signal does the same thing.
+            logger.warning('Master CLI reload failed ({0}), signalling the master'.format(e))
+            response = ''
+            pid = readPid(self.pidFile)
+            if pid is None:
+                self.failedCount += 1
+                return False
+            try:
+                os.kill(pid, signal.SIGUSR2)
+            except OSError as e:
+                # A stale pidfile, or a master we may not signal.
+                logger.error('Cannot signal HAProxy master {0}: {1}'.format(pid, e))
+                self.failedCount += 1
+                return False
+
+        if 'Success=0' in response:
+            self.failedCount += 1
+            logger.error('HAProxy reload failed: {0}'.format(response.strip()))
+            return False
+
+        self.reloadCount += 1
+        self.track(set(before), start)
+
+        return True
+
+    def track(self, before, start):
+        """
+        Have the tracker thread time the reload that started at start, to
+        replace the workers in before, starting the thread if need be.
+        """
+        with self.trackLock:
+            self.tracked.append({ 'before': before, 'start': start, 'reloaded': None })
+            del self.tracked[:-MAX_TRACKED]
+
+            if self.tracker is None:
+                self.tracker = threading.Thread(target=self.watch, name='haproxy-tracker')
+                self.tracker.daemon = True
+                self.tracker.start()
+
+    def watch(self):
+        """
+        Poll the master until every tracked reload has finished draining, or
+        timed out: every pollInterval while a reload waits for its new
+        workers, and every drainInterval while old workers drain.
+        """
+        while True:
+            with self.trackLock:
+                if not self.tracked:
+                    self.tracker = None
+                    return
+                tracked = list(self.tracked)
+
+            try:
+                procs = self.procs()
+            except socket.error:
+                procs = None
+
+            done = set(id(reload) for reload in tracked if self.check(reload, procs, time.time()))
+            with self.trackLock:
+                self.tracked = [reload for reload in self.tracked if id(reload) not in done]
+                waiting = any(reload['reloaded'] is None for reload in self.tracked)
+
+            time.sleep(self.pollInterval if waiting else self.drainInterval)
+
+    def check(self, reload, procs, now):
+        """
+        Update a tracked reload from the master's workers, if known.  Returns
+        whether it is finished with.
+        """
+        elapsed = now - reload['start']
+
+        if procs is not None:
+            current, old = set(procs[0]), set(procs[1])
+            self.oldWorkers = len(old)
+
+            if reload['reloaded'] is None and current and not reload['before'] & current:
+                reload['reloaded'] = now
+                self.lastReloadSeconds = elapsed
+                logger.info('HAProxy reloaded in {0:.3f}s'.format(elapsed))
+
+            if reload['reloaded'] is not None and not reload['before'] & old:
+                self.lastDrainSeconds = elapsed
+                logger.info('Old HAProxy workers drained in {0:.3f}s'.format(elapsed))
+                return True
+
+        if reload['reloaded'] is None and elapsed > self.reloadTimeout:
+            logger.warning('HAProxy reload still not done after {0}s'.format(self.reloadTimeout))
+            self.failedCount += 1
+            return True
+
+        if elapsed > self.drainTimeout:
+            logger.warning('Old HAProxy workers still draining after {0}s'.format(self.drainTimeout))
+            return True
+
+        return False
+
+    def stats(self):
+        return {
+            'reloads': self.reloadCount,
+            'failed': self.failedCount,
+            'last_reload_seconds': self.lastReloadSeconds,
+            'last_drain_seconds': self.lastDrainSeconds,
+            'old_workers': self.oldWorkers
+        }
@@ -1,37 +1,248 @@
 """
 A python module for making calls to **Marathon**.
+
+The client keeps a pooled keep-alive session, so repeated calls reuse their
+connections.  Each call has connect and read timeouts, and is retried with a
+jittered exponential backoff.  Given several Marathon masters, the client
+fails over to the next one when a master stops answering, and remembers the
+failure for a while so it does not keep trying a dead leader first.
 """
 
+from collections import OrderedDict
 import json
 import logging
+import logging.handlers
+from multiprocessing.pool import ThreadPool
+import random
+import re
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import Histogram
+from records import Task, iterItems
+from tracing import bind, span
 
 logger = logging.getLogger('Marathon')
 handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
 logger.addHandler(handler)
 
+# Bytes read at a time from a streamed listing.
+CHUNK_SIZE = 262144
+
+requestSeconds = Histogram('orchestrator_marathon_request_duration_seconds',
+    'Time taken by calls to the Marathon API, failover and retries included',
+    ('method', 'endpoint'))
+
+class MarathonError(Exception):
+    """
+    Marathon refused a call, with the HTTP status and Marathon's message.
+    """
+    def __init__(self, status, message):
+        Exception.__init__(self, 'HTTP {0}: {1}'.format(status, message))
+        self.status = status
+
+def endpointOf(path):
+    """
+    The API endpoint of a path, with the app and task ids taken out, e.g.
+    /apps/{id}/tasks for /apps/skylr/tasks.
+    """
+    parts = path.split('?')[0].strip('/').split('/')
+    if parts[0] == 'apps' and len(parts) > 1:
+        if parts[-1] == 'tasks' and len(parts) > 2:
+            return '/apps/{id}/tasks'
+        if 'tasks' in parts[2:-1]:
+            return '/apps/{id}/tasks/{taskId}'
+        return '/apps/{id}'
+
+    return '/' + parts[0]
+
 class Marathon(object):
-    def __init__(self, url):
-        self.url = url
+    def __init__(self, url, timeout=(3.05, 10), retries=2, backoff=0.2,
+            deadFor=30, poolSize=10):
+        """
+        url is the /v2 base URL of a Marathon master, or a list of them.
+        timeout is a (connect, read) pair in seconds, retries the number of
+        extra rounds through the masters, backoff the base delay between
+        rounds, and deadFor how long a failed master is tried last.
+        """
+        self.urls     = [url] if isinstance(url, basestring) else list(url)
+        self.timeout  = timeout
+        self.retries  = retries
+        self.backoff  = backoff
+        self.deadFor  = deadFor
+
+        self.lock     = threading.Lock()
+        self.current  = 0
+        self.deadUntil = {}
+
+        self.session  = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.urls), pool_maxsize=poolSize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @property
+    def url(self):
+        """
+        The master currently believed to be healthy.
+        """
+        return self.urls[self.current]
 
-    def getApps(self):
+    def candidates(self):
+        """
+        The masters in the order to try them: starting from the last one that
+        answered, healthy masters first, then the recently failed ones.
+        """
+        now = time.time()
+        ordered = self.urls[self.current:] + self.urls[:self.current]
+        alive = [url for url in ordered if self.deadUntil.get(url, 0) <= now]
+        dead = [url for url in ordered if self.deadUntil.get(url, 0) > now]
+
+        return alive + dead
+
+    def markDead(self, url, reason):
+        logger.warning('Marathon master {0} failed: {1}'.format(url, reason))
+        with self.lock:
+            self.deadUntil[url] = time.time() + self.deadFor
+
+    def markAlive(self, url):
+        with self.lock:
+            self.deadUntil.pop(url, None)
+            self.current = self.urls.index(url)
+
+    def request(self, method, path, **kwargs):
+        """
+        Make a call against the first master that answers, timing it.
+        """
+        endpoint = endpointOf(path)
+        with requestSeconds.time(method=method, endpoint=endpoint), \
+                span('marathon {0} {1}'.format(method, endpoint)):
+            return self.failover(method, path, **kwargs)
+
+    def failover(self, method, path, **kwargs):
+        """
+        Make a call against the first master that answers.  Connection
+        errors, timeouts and 5xx responses move on to the next master; once
+        every master has failed, the round is retried after a jittered
+        backoff.  If nothing works, the last 5xx response is returned, or the
+        last error raised.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        error = None
+        response = None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+            for url in self.candidates():
+                try:
+                    response = self.session.request(method, url + path, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    self.markDead(url, e)
+                    error = e
+                    continue
+
+                if response.status_code >= 500:
+                    self.markDead(url, 'HTTP {0}'.format(response.status_code))
+                    continue
+
+                self.markAlive(url)
+                return response
+
+        if response is not None:
+            return response
+
+        raise error
+
+    def getApps(self, embed=None):
         """
         Calls the Marathon API that [lists all available apps.](https://mesosphere.github.io/marathon/docs/rest-api.html#get-/v2/apps)
+        Passing embed="apps.tasks" asks Marathon to include each app's tasks.
         """
-        url = "{0}/apps".format(self.url)
-        req = requests.get(url, headers={'Accept': 'application/json'})
+        return list(self.iterApps(embed))
 
-        return json.loads(req.content)['apps']
+    def iterApps(self, embed=None):
+        """
+        getApps(), an app at a time as the listing is read.
+        """
+        params = {'embed': embed} if embed else None
+        return self.iterListing('/apps', 'apps', params=params)
 
     def getTasks(self, appId):
         """
         Calls the Marathon API that [lists all running tasks for an application.](https://mesosphere.github.io/marathon/docs/rest-api.html#get-/v2/apps/%7Bappid%7D/tasks)
         """
-        url = "{0}/apps/{1}/tasks".format(self.url, appId)
-        req = requests.get(url, headers={'Accept': 'application/json'})
+        return list(self.iterTasks(appId))
+
+    def iterTasks(self, appId):
+        """
+        getTasks(), a task at a time as the listing is read.
+        """
+        return self.iterListing("/apps/{0}/tasks".format(appId), 'tasks')
+
+    def getTaskRecords(self, appId):
+        """
+        The tasks of an app, cut down to Task records.
+        """
+        return [Task.fromDict(task) for task in self.iterTasks(appId)]
 
-        return json.loads(req.content)['tasks']
+    def iterListing(self, path, key, params=None):
+        """
+        The items of a listing such as {"apps": [...]}, decoded one at a
+        time while the response streams in.
+        """
+        req = self.request('GET', path, params=params, headers={'Accept': 'application/json'},
+            stream=True)
+        try:
+            for item in iterItems(req.iter_content(CHUNK_SIZE), key):
+                yield item
+        finally:
+            req.close()
+
+    def getSnapshot(self, appIds, poolSize=8):
+        """
+        Fetch the running tasks of the given apps in as few round trips as
+        possible.  The tasks come embedded in a single /v2/apps call where
+        Marathon supports it; older Marathons ignore the embed parameter, in
+        which case the tasks of each tracked app are fetched concurrently on
+        a pool of at most poolSize threads.
+
+        Returns an ordered dictionary of appId (without the leading slash) to
+        its list of tasks, in Marathon's app order, for the tracked apps that
+        Marathon knows about.  The listing is read an app at a time, and only
+        a Task record of each task of a tracked app is kept, so the rest of
+        what Marathon says about its apps never piles up in memory.
+        """
+        wanted = set(appIds)
+        snapshot = OrderedDict()
+        missing = []
+
+        for app in self.iterApps(embed='apps.tasks'):
+            appId = app['id']
+            appId = appId[1:] if appId.startswith('/') else appId
+
+            if appId not in wanted:
+                continue
+
+            tasks = app.get('tasks')
+            if tasks is None:
+                snapshot[appId] = None
+                missing.append(appId)
+            else:
+                snapshot[appId] = [Task.fromDict(task) for task in tasks]
+
+        if missing:
+            pool = ThreadPool(min(poolSize, len(missing)))
+            try:
+                for appId, tasks in zip(missing, pool.map(bind(self.getTaskRecords), missing)):
+                    snapshot[appId] = tasks
+            finally:
+                pool.close()
+
+        return snapshot
 
     def updateApp(self, appId, newConfig):
         """
@@ -44,13 +255,251 @@ class Marathon(object):
         logger.info('Attempting to update app [{0}] with new configuration: [{1}]'
             .format(appId, newConfig))
 
-        url = "{0}/apps/{1}".format(self.url, appId)
+        path = "/apps/{0}".format(appId)
         headers = {
             'Accept': 'application/json',
             'Content-Type': 'application/json'
         }
-        req = requests.put(url, data=json.dumps(newConfig), headers=headers)
+        req = self.request('PUT', path, data=json.dumps(newConfig), headers=headers)
+
+        return self.parse(req)
+
+    def getApp(self, appId):
+        """
+        Calls the Marathon API that [describes one app](https://mesosphere.github.io/marathon/docs/rest-api.html#get-/v2/apps/%7Bappid%7D),
+        including its tasks and their health check results.
+        """
+        path = "/apps/{0}".format(appId)
+        req = self.request('GET', path, params={'embed': 'app.tasks'},
+            headers={'Accept': 'application/json'})
+
+        return self.parse(req)['app']
+
+    def killTask(self, appId, taskId, scale=False):
+        """
+        Calls the Marathon API that [kills a task of an app](https://mesosphere.github.io/marathon/docs/rest-api.html#delete-/v2/apps/%7Bappid%7D/tasks/%7Btaskid%7D).
+        Unless scale is set, Marathon starts another task in its place.
+        """
+        path = "/apps/{0}/tasks/{1}".format(appId, taskId)
+        req = self.request('DELETE', path, params={'scale': 'true' if scale else 'false'},
+            headers={'Accept': 'application/json'})
+
+        return self.parse(req)
+
+    def getDeployments(self):
+        """
+        Calls the Marathon API that [lists the deployments in progress.](https://mesosphere.github.io/marathon/docs/rest-api.html#get-/v2/deployments)
+        """
+        req = self.request('GET', '/deployments', headers={'Accept': 'application/json'})
+
+        return self.parse(req)
+
+    def waitForDeployments(self, deploymentIds, timeout=300, interval=1.0):
+        """
+        Wait for the given deployments to finish.  A single listing of the
+        deployments in progress covers them all, so they are watched together
+        rather than one at a time.  Returns the set of deployment ids still
+        running when the timeout ran out.
+        """
+        pending = set(deploymentIds)
+        deadline = time.time() + timeout
+
+        while pending:
+            running = set(deployment['id'] for deployment in self.getDeployments())
+            pending &= running
+            if not pending or time.time() >= deadline:
+                break
+            time.sleep(min(interval, max(0, deadline - time.time())))
+
+        return pending
+
+    def parse(self, req):
+        """
+        The JSON body of a response, or a MarathonError if the call failed.
+        """
+        try:
+            body = json.loads(req.content)
+        except ValueError:
+            body = None
+
+        if req.status_code >= 400:
+            message = body.get('message') if isinstance(body, dict) else None
+            raise MarathonError(req.status_code, message or req.content.strip())
+
+        return body
+
+def splitLines(chunks):
+    """
+    The lines in an iterable of chunks of text, each as soon as the chunk
+    that ends it has come in.
+    """
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r')
+
+    if pending:
+        yield pending.rstrip('\r')
+
+def httpChunks(fp):
+    """
+    The chunks of a chunked HTTP body, read from fp as each one arrives.
+    """
+    while True:
+        line = fp.readline()
+        if not line:
+            return
+
+        size = int(line.split(';')[0], 16)
+        if size == 0:
+            # The blank line that ends the (trailer-less) body.
+            fp.readline()
+            return
+
+        chunk = fp.read(size)
+        fp.readline()
+        yield chunk
+
+def streamLines(response):
+    """
+    The lines of a streamed response, each as it arrives.  iter_lines() only
+    hands a line over once its chunk size has been read, so it takes a byte
+    per call to not hold events back; the connection's buffered file gives
+    whole lines, or whole HTTP chunks, per call instead.
+    """
+    connection = response.raw._fp
+    if connection.chunked:
+        return splitLines(httpChunks(connection.fp))
+    if connection.length is None:
+        return splitLines(iter(connection.fp.readline, ''))
+
+    # A body of known length is not a live stream; it can be read in bulk.
+    return response.iter_lines(CHUNK_SIZE)
+
+class EventStream(object):
+    """
+    A subscriber to Marathon's [event stream](https://mesosphere.github.io/marathon/docs/event-bus.html),
+    an alternative to having Marathon POST each event to the orchestrator.
+
+    Only *status_update_event* messages for tracked apps are passed to the
+    handler; everything else is dropped before its JSON is parsed.  A lost
+    connection is retried with backoff, and since events may have been missed
+    in the meantime, onReconnect is called once the stream is back.
+    """
+    EVENT_TYPE = 'status_update_event'
+    APP_ID = re.compile(r'"appI[dD]"\s*:\s*"([^"]*)"')
+
+    def __init__(self, client, handler, isTracked, onReconnect=None,
+            readTimeout=300, backoff=1, maxBackoff=30):
+        self.client      = client
+        self.handler     = handler
+        self.isTracked   = isTracked
+        self.onReconnect = onReconnect
+        self.readTimeout = readTimeout
+        self.backoff     = backoff
+        self.maxBackoff  = maxBackoff
+
+        self.stopped     = threading.Event()
+        self.thread      = None
+        self.response    = None
+        self.connections = 0
+        self.received    = 0
+        self.dispatched  = 0
+        self.malformed   = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='marathon-events')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.response is not None:
+            self.response.close()
+
+    def connect(self):
+        response = self.client.request('GET', '/events',
+            params={'event_type': self.EVENT_TYPE},
+            headers={'Accept': 'text/event-stream', 'Accept-Encoding': 'identity'},
+            timeout=(self.client.timeout[0], self.readTimeout), stream=True)
+        response.raise_for_status()
+
+        return response
+
+    def run(self):
+        delay = self.backoff
+
+        while not self.stopped.is_set():
+            try:
+                self.response = self.connect()
+                self.connections += 1
+                logger.info('Subscribed to Marathon events at {0}'.format(self.client.url))
+
+                if self.connections > 1 and self.onReconnect:
+                    self.onReconnect()
+
+                delay = self.backoff
+                self.consume(streamLines(self.response))
+            except Exception as e:
+                if self.stopped.is_set():
+                    break
+                logger.warning('Marathon event stream failed: {0}'.format(e))
+            finally:
+                if self.response is not None:
+                    self.response.close()
+
+            self.stopped.wait(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, self.maxBackoff)
+
+    def consume(self, lines):
+        """
+        Read server-sent events from an iterable of lines.
+        """
+        eventType = None
+        data = []
+
+        for line in lines:
+            if self.stopped.is_set():
+                return
+
+            if not line:
+                if data:
+                    self.dispatch(eventType, '\n'.join(data))
+                eventType = None
+                data = []
+                continue
+
+            field, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+
+            if field == 'event':
+                eventType = value
+            elif field == 'data' and eventType in (None, self.EVENT_TYPE):
+                data.append(value)
+
+    def dispatch(self, eventType, raw):
+        self.received += 1
+
+        if eventType is None and self.EVENT_TYPE not in raw:
+            return
+
+        match = self.APP_ID.search(raw)
+        if not match or not self.isTracked(match.group(1)):
+            return
+
+        try:
+            evt = json.loads(raw)
+        except ValueError as e:
+            # One bad event is no reason to drop the stream and resync.
+            self.malformed += 1
+            logger.warning('Skipping malformed Marathon event ({0}): {1}'.format(e, raw[:200]))
+            return
 
-        print req.content
+        if evt.get('eventType') != self.EVENT_TYPE:
+            return
 
-        return;
+        self.dispatched += 1
+        self.handler(evt)
@@ -0,0 +1,181 @@
+"""
+**Metrics** are counters, gauges and histograms kept in process, and exposed
+in the [Prometheus text format](https://prometheus.io/docs/instrumenting/exposition_formats/).
+Recording a value costs a lock and a dictionary update, so instruments can
+stay on in the hot path.  Gauges may instead be given a function, which is
+only called when the metrics are scraped.
+
+Metrics are declared once, at module level, next to the code they measure,
+and all of them land in the module's **registry**.
+"""
+
+import bisect
+import threading
+import time
+
+# Seconds; from a fast render up to a slow Marathon or a long reload.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+def formatLabels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(u'{0}="{1}"'.format(name, value))
+    return u'{' + u','.join(pairs) + u'}'
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.lock    = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """
+        Every metric, in the Prometheus text format.
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+
+        return u'\n'.join(lines) + u'\n'
+
+registry = Registry()
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=registry):
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock   = threading.Lock()
+
+        if registry is not None:
+            registry.register(self)
+
+    def key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+
+        return [u'{0}{1} {2}'.format(self.name, formatLabels(self.labels, key), formatValue(value))
+            for key, value in values]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+class Gauge(Metric):
+    """
+    A value that goes up and down.  Given collect, a function returning
+    either a number, or a dictionary of label value tuples to numbers, the
+    gauge is read from that when scraped instead.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), collect=None, registry=registry):
+        Metric.__init__(self, name, help, labels, registry)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self):
+        if self.collect is not None:
+            values = self.collect()
+            if values is None:
+                values = {}
+            elif not isinstance(values, dict):
+                values = { (): values }
+            with self.lock:
+                self.values = values
+
+        return Metric.samples(self)
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels    = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS, registry=registry):
+        Metric.__init__(self, name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        n = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket, the overflow, and the sum.
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[n] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """
+        A context manager that observes how long its block takes.
+        """
+        return Timer(self, labels)
+
+    def count(self, **labels):
+        counts = self.values.get(self.key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, list(counts)) for key, counts in self.values.items())
+
+        names = self.labels + ('le',)
+        lines = []
+
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                lines.append(u'{0}_bucket{1} {2}'.format(self.name,
+                    formatLabels(names, key + (formatValue(bound),)), total))
+
+            labels = formatLabels(self.labels, key)
+            lines.append(u'{0}_sum{1} {2}'.format(self.name, labels, formatValue(counts[-1])))
+            lines.append(u'{0}_count{1} {2}'.format(self.name, labels, total))
+
+        return lines
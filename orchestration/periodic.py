@@ -0,0 +1,41 @@
+"""
+**Periodic** runs a function on a fixed interval in a daemon thread.  The
+orchestrator uses it for background chores that must stay off the request
+path, such as re-resolving the Marathon hosts.
+"""
+
+import logging
+import logging.handlers
+import threading
+
+logger = logging.getLogger('Periodic')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+class Periodic(object):
+    def __init__(self, interval, func, name=None):
+        self.interval = interval
+        self.func     = func
+        self.name     = name or getattr(func, '__name__', 'periodic')
+        self.stopped  = threading.Event()
+        self.thread   = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return self
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.func()
+            except Exception:
+                logger.exception('Periodic task {0} failed'.format(self.name))
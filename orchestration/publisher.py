@@ -0,0 +1,146 @@
+"""
+**Publisher** puts a rendered HAProxy config in place without spawning any
+helper processes.  The config is written to a temporary file in the same
+directory as its destination, flushed to disk and renamed over the old one,
+so a reload can never read a half-written file.  A config can also be
+streamed into place as it is rendered, without ever being held in memory.
+The previous configs are kept alongside as *destination.1* to
+*destination.N* for instant rollback.
+"""
+
+import logging
+import logging.handlers
+import os
+import shutil
+import tempfile
+
+from metrics import Histogram
+
+logger = logging.getLogger('Publisher')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+publishSeconds = Histogram('orchestrator_config_publish_seconds',
+    'Time taken to flush a config to disk and move it into place')
+
+def readPid(pidFile):
+    """
+    The pid in a pidfile, or None if there is no (valid) pidfile.
+    """
+    try:
+        with open(pidFile) as stream:
+            return int(stream.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+
+class ConfigPublisher(object):
+    def __init__(self, destination, keep=5):
+        self.destination = destination
+        self.directory   = os.path.dirname(os.path.abspath(destination))
+        self.keep        = keep
+
+    def backup(self, n):
+        return '{0}.{1}'.format(self.destination, n)
+
+    def publish(self, configText):
+        """
+        Atomically replace the destination with configText.
+        """
+        pending = self.begin()
+        try:
+            pending.write(configText)
+        except:
+            pending.discard()
+            raise
+
+        pending.commit()
+
+    def begin(self):
+        """
+        A PendingConfig, to write a new config to a piece at a time, and then
+        either commit in place of the destination or discard.
+        """
+        return PendingConfig(self)
+
+    def rotate(self):
+        """
+        Shift the kept configs along by one, and keep the current one as
+        destination.1.
+        """
+        if not self.keep or not os.path.exists(self.destination):
+            return
+
+        for n in range(self.keep - 1, 0, -1):
+            if os.path.exists(self.backup(n)):
+                os.rename(self.backup(n), self.backup(n + 1))
+
+        if os.path.exists(self.backup(1)):
+            os.unlink(self.backup(1))
+
+        try:
+            os.link(self.destination, self.backup(1))
+        except OSError:
+            shutil.copy2(self.destination, self.backup(1))
+
+    def syncDirectory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def history(self):
+        """
+        The kept configs, most recent first.
+        """
+        return [self.backup(n) for n in range(1, self.keep + 1)
+            if os.path.exists(self.backup(n))]
+
+    def rollback(self, steps=1):
+        """
+        Publish the config from the given number of publishes ago, and return
+        its text.  The config being replaced is kept like any other.
+        """
+        with open(self.backup(steps)) as stream:
+            configText = stream.read().decode('utf-8')
+
+        logger.info('Rolling {0} back {1} step(s)'.format(self.destination, steps))
+        self.publish(configText)
+
+        return configText
+
+class PendingConfig(object):
+    def __init__(self, publisher):
+        self.publisher = publisher
+        fd, self.path  = tempfile.mkstemp(dir=publisher.directory,
+            prefix='.{0}.'.format(os.path.basename(publisher.destination)))
+        self.output    = os.fdopen(fd, 'w')
+
+    def write(self, text):
+        self.output.write(text.encode('utf-8'))
+
+    def commit(self):
+        """
+        Flush the config to disk and rename it over the destination.
+        """
+        publisher = self.publisher
+        with publishSeconds.time():
+            try:
+                self.output.flush()
+                os.fsync(self.output.fileno())
+                self.output.close()
+                os.chmod(self.path, 0644)
+
+                publisher.rotate()
+                os.rename(self.path, publisher.destination)
+            except:
+                self.discard()
+                raise
+
+            publisher.syncDirectory()
+        logger.info('Published config to {0}'.format(publisher.destination))
+
+    def discard(self):
+        self.output.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,154 @@
+"""
+**Records** keep Marathon's listings small.  Marathon describes each app and
+task at length (command, environment, labels, health check results, version
+stamps), while a config is rendered from no more than each task's id, host,
+ports and app id.  A **Task** keeps just those, in slots, and still reads
+like the dictionary it came from, so the rest of the code cannot tell the
+difference.
+
+Listings are parsed one item at a time as the response comes in, with
+**iterItems**, so that the whole of a many megabyte listing is never held
+as text, or as dictionaries, at once.
+"""
+
+import json
+import re
+
+# Where the array of a listing such as {"apps": [...]} starts.
+PREFIX = re.compile(r'\s*\{\s*"(?P<key>[^"\\]+)"\s*:\s*\[')
+SEPARATORS = re.compile(r'[\s,]*')
+
+# A body that has not reached its array within this much text is parsed the
+# ordinary way.
+MAX_PREFIX = 4096
+
+decoder = json.JSONDecoder()
+
+class Task(object):
+    __slots__ = ('id', 'host', 'ports', 'appId')
+
+    def __init__(self, id, host, ports=(), appId=None):
+        self.id    = id
+        self.host  = host
+        self.ports = tuple(ports)
+        self.appId = appId
+
+    @classmethod
+    def fromDict(cls, task):
+        return cls(task['id'], task.get('host'), task.get('ports') or (),
+            task.get('appId', task.get('appID')))
+
+    def keys(self):
+        return [key for key in self.__slots__ if getattr(self, key) is not None]
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def asDict(self):
+        task = dict(self.items())
+        task['ports'] = list(self.ports)
+        return task
+
+    def __eq__(self, other):
+        if isinstance(other, Task):
+            return (self.id, self.host, self.ports, self.appId) == \
+                (other.id, other.host, other.ports, other.appId)
+        return isinstance(other, dict) and self.asDict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Task({0!r})'.format(self.asDict())
+
+def asTasks(tasks):
+    """
+    The tasks as Task records, keeping those that already are.
+    """
+    return [task if isinstance(task, Task) else Task.fromDict(task) for task in tasks]
+
+def iterItems(chunks, key):
+    """
+    The items of the array under key in a JSON body such as {"apps": [...]},
+    decoded one at a time from chunks of the body as they arrive.  A body of
+    any other shape is decoded whole, as json.loads(body)[key].
+    """
+    chunks = iter(chunks)
+    state = { 'done': False }
+
+    # The text is kept as UTF-8, which the decoder reads as it is, so that a
+    # character split between chunks needs no special care.
+    def read():
+        try:
+            return next(chunks)
+        except StopIteration:
+            state['done'] = True
+            return ''
+
+    text = ''
+    while True:
+        match = PREFIX.match(text)
+        if match or state['done'] or len(text) > MAX_PREFIX:
+            break
+        text += read()
+
+    if not match or match.group('key') != key:
+        rest = [text]
+        while not state['done']:
+            rest.append(read())
+        for item in json.loads(''.join(rest))[key]:
+            yield item
+        return
+
+    pos = match.end()
+    while True:
+        pos = SEPARATORS.match(text, pos).end()
+
+        if pos < len(text):
+            if text[pos] == ']':
+                return
+
+            try:
+                item, pos = decoder.raw_decode(text, pos)
+            except ValueError:
+                if state['done']:
+                    raise
+            else:
+                yield item
+                continue
+        elif state['done']:
+            raise ValueError('Unterminated array under "{0}"'.format(key))
+
+        # Read at least as much again as is pending before trying again, so
+        # a large item is only attempted a few times.
+        pending = [text[pos:]]
+        size = len(pending[0])
+        wanted = max(size * 2, 1)
+        while size < wanted and not state['done']:
+            chunk = read()
+            pending.append(chunk)
+            size += len(chunk)
+
+        text = ''.join(pending)
+        pos = 0
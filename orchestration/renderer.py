@@ -0,0 +1,88 @@
+"""
+**Renderer** holds the pieces for writing HAProxy configs as a stream.  The
+templates are compiled once into plain format strings, which fill in much
+faster than *string.Template* does, and a config is written section by
+section to its destination through a **ConfigScanner**, which takes its
+digest, layout and backend servers on the way past, so the whole config
+is never assembled in memory.
+"""
+
+import hashlib
+
+def compileTemplate(template):
+    """
+    The %-format string that fills in the same as a string.Template.
+    """
+    def convert(match):
+        name = match.group('named') or match.group('braced')
+        if name is not None:
+            return '%({0})s'.format(name)
+        if match.group('escaped') is not None:
+            return template.delimiter
+        raise ValueError('Invalid placeholder in template: {0}'.format(match.group()))
+
+    return template.pattern.sub(convert, template.template.replace('%', '%%'))
+
+class ConfigScanner(object):
+    """
+    Passes a config on to output, if given, while taking the digest and
+    layout of the config, and the servers of each backend, a line at a time.
+    """
+    def __init__(self, output=None):
+        self.output     = output
+        self.text       = hashlib.sha1()
+        self.shape      = hashlib.sha1()
+        self.servers    = {}
+        self.backend    = None
+        self.partial    = ''
+        self.lines      = 0
+
+    def write(self, chunk):
+        if self.output is not None:
+            self.output.write(chunk)
+
+        self.text.update(chunk.encode('utf-8'))
+
+        lines = (self.partial + chunk).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.scan(line)
+
+    def close(self):
+        if self.partial:
+            self.scan(self.partial)
+            self.partial = ''
+
+        return self
+
+    def scan(self, line):
+        # Servers may carry their hostname in a trailing comment.
+        words = line.split('#', 1)[0].split()
+
+        # The layout leaves out the addresses and state of the servers.
+        shape = ' '.join(words[:2]) if words[:1] == ['server'] else line
+        self.shape.update(('\n' if self.lines else '') + shape.encode('utf-8'))
+        self.lines += 1
+
+        if not words:
+            return
+        if words[0] == 'backend':
+            self.backend = self.servers.setdefault(words[1], {})
+        elif words[0] in ('frontend', 'listen', 'global', 'defaults'):
+            self.backend = None
+        elif words[0] == 'server' and self.backend is not None and len(words) > 2:
+            self.backend[words[1]] = None if 'disabled' in words[3:] else words[2]
+
+    def digest(self):
+        return self.text.hexdigest()
+
+    def layout(self):
+        return self.shape.hexdigest()
+
+def scan(configText):
+    """
+    A closed ConfigScanner that has read the whole of configText.
+    """
+    scanner = ConfigScanner()
+    scanner.write(configText)
+    return scanner.close()
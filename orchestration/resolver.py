@@ -0,0 +1,133 @@
+"""
+**Resolver** keeps a small TTL cache of hostname to IP address lookups, so
+that blocking `socket.gethostbyname` calls stay off the request path.  A
+lookup only blocks the first time a host is seen; after that the cached
+address is returned and a background refresh keeps it current.  If a
+refresh fails, the last known address is kept.
+
+Many hosts can be resolved at once with **lookupAll**, which sends the
+misses out on a small thread pool, so a config naming a hundred agents waits
+about as long as the slowest of them rather than all of them in turn.
+"""
+
+import logging
+import logging.handlers
+from multiprocessing.pool import ThreadPool
+import socket
+import threading
+import time
+
+logger = logging.getLogger('Resolver')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+def isAddress(host):
+    """
+    Whether host is already a literal IPv4 or IPv6 address.
+    """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+class HostCache(object):
+    def __init__(self, ttl=300, poolSize=16):
+        self.ttl      = ttl
+        self.poolSize = poolSize
+        self.lock     = threading.Lock()
+        self.entries  = {}
+        self.failures = {}
+
+    def lookup(self, host):
+        """
+        Return the address for host, resolving it only on a cache miss.
+        """
+        entry = self.entries.get(host)
+        if entry:
+            return entry[0]
+
+        return self.resolve(host)
+
+    def resolve(self, host):
+        """
+        Resolve host now and cache the result, falling back to the last
+        known address if resolution fails.
+        """
+        try:
+            ip = socket.gethostbyname(host)
+        except socket.error as e:
+            entry = self.entries.get(host)
+            if entry is None:
+                raise
+
+            logger.warning('Failed to resolve {0} ({1}), keeping {2}'.format(host, e, entry[0]))
+            return entry[0]
+
+        with self.lock:
+            self.entries[host] = (ip, time.time())
+            self.failures.pop(host, None)
+
+        return ip
+
+    def tryResolve(self, host):
+        try:
+            return self.resolve(host)
+        except socket.error as e:
+            logger.warning('Failed to resolve {0} ({1})'.format(host, e))
+            with self.lock:
+                self.failures[host] = time.time()
+            return None
+
+    def resolveAll(self, hosts):
+        """
+        Resolve hosts now, concurrently, as {host: ip}; hosts that cannot be
+        resolved and were never known map to None.
+        """
+        hosts = list(hosts)
+        if len(hosts) < 2:
+            return dict((host, self.tryResolve(host)) for host in hosts)
+
+        pool = ThreadPool(min(self.poolSize, len(hosts)))
+        try:
+            return dict(zip(hosts, pool.map(self.tryResolve, hosts)))
+        finally:
+            pool.close()
+
+    def lookupAll(self, hosts):
+        """
+        The address of each of hosts as {host: ip}, resolving the ones not
+        cached all at once.  Literal addresses are passed through unchanged.
+        Hosts that cannot be resolved map to None, and are not tried again
+        until the TTL is up.
+        """
+        now = time.time()
+        addresses = {}
+        misses = []
+
+        for host in set(hosts):
+            entry = self.entries.get(host)
+            if entry:
+                addresses[host] = entry[0]
+            elif isAddress(host):
+                addresses[host] = host
+            elif now - self.failures.get(host, 0) < self.ttl:
+                # Failed recently; not worth blocking on again until the TTL is up.
+                addresses[host] = None
+            else:
+                misses.append(host)
+
+        if misses:
+            addresses.update(self.resolveAll(misses))
+
+        return addresses
+
+    def refresh(self):
+        """
+        Re-resolve every entry older than the TTL.
+        """
+        now = time.time()
+        self.resolveAll(host for host, (ip, resolvedAt) in self.entries.items()
+            if now - resolvedAt >= self.ttl)
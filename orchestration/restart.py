@@ -0,0 +1,139 @@
+"""
+**RollingRestart** restarts the tasks of a Marathon app a batch at a time.
+The tasks of a batch are killed, several at once, without scaling the app
+down, so Marathon starts a replacement for each.  The next batch only goes
+once every task of the batch is gone and the app is back to its full count
+of healthy tasks, so the app never runs more than a batch short.  A batch
+that does not come back healthy in time stops the restart, leaving the
+rest of the app alone.
+"""
+
+import logging
+import logging.handlers
+from multiprocessing.pool import ThreadPool
+import time
+
+import requests
+
+from marathon import MarathonError
+
+logger = logging.getLogger('RollingRestart')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+class RestartError(Exception):
+    pass
+
+def isHealthy(app, task):
+    """
+    A task is healthy once it has started and, if the app has health
+    checks, passes all of them.
+    """
+    if not task.get('startedAt'):
+        return False
+    if not app.get('healthChecks'):
+        return True
+
+    results = task.get('healthCheckResults') or []
+    return len(results) >= len(app['healthChecks']) and all(r.get('alive') for r in results)
+
+class RollingRestart(object):
+    def __init__(self, client, appId, batchSize=1, concurrency=4, timeout=300,
+            interval=2.0, progress=None):
+        """
+        client is a Marathon client.  batchSize tasks are restarted at a
+        time, with up to concurrency kill calls at once.  Each batch has
+        timeout seconds to come back healthy, checked every interval
+        seconds.  progress, if given, is called with a line for every step.
+        """
+        self.client      = client
+        self.appId       = appId
+        self.batchSize   = max(1, batchSize)
+        self.concurrency = max(1, concurrency)
+        self.timeout     = timeout
+        self.interval    = interval
+        self.progress    = progress or logger.info
+
+    def report(self, message):
+        self.progress('{0}: {1}'.format(self.appId, message))
+
+    def batches(self, tasks):
+        """
+        The tasks in batches, oldest first.
+        """
+        tasks = sorted(tasks, key=lambda task: task.get('startedAt') or '')
+        ids = [task['id'] for task in tasks]
+        return [ids[n:n + self.batchSize] for n in range(0, len(ids), self.batchSize)]
+
+    def kill(self, taskIds):
+        """
+        Kill the tasks of a batch, concurrently.  Returns the ids of the
+        ones that could not be killed.
+        """
+        def killOne(taskId):
+            try:
+                self.client.killTask(self.appId, taskId)
+                return None
+            except (MarathonError, requests.RequestException) as e:
+                self.report('failed to kill {0}: {1}'.format(taskId, e))
+                return taskId
+
+        pool = ThreadPool(min(self.concurrency, len(taskIds)))
+        try:
+            return [taskId for taskId in pool.map(killOne, taskIds) if taskId]
+        finally:
+            pool.close()
+
+    def waitHealthy(self, killed, instances):
+        """
+        Wait until the killed tasks are gone and the app has instances
+        healthy tasks.  Returns whether that happened within the timeout.
+        """
+        deadline = time.time() + self.timeout
+        killed = set(killed)
+
+        while True:
+            app = self.client.getApp(self.appId)
+            tasks = app.get('tasks') or []
+            lingering = [task for task in tasks if task['id'] in killed]
+            healthy = [task for task in tasks if task['id'] not in killed and isHealthy(app, task)]
+
+            if not lingering and len(healthy) >= instances:
+                return True
+            if time.time() >= deadline:
+                self.report('gave up waiting: {0}/{1} healthy, {2} old task(s) still running'
+                    .format(len(healthy), instances, len(lingering)))
+                return False
+
+            time.sleep(min(self.interval, max(0, deadline - time.time())))
+
+    def run(self):
+        """
+        Restart every task of the app.  Returns how many were restarted,
+        and raises a RestartError if a batch failed.
+        """
+        started = time.time()
+        app = self.client.getApp(self.appId)
+        instances = app.get('instances', len(app.get('tasks') or []))
+        batches = self.batches(app.get('tasks') or [])
+
+        self.report('restarting {0} task(s) in {1} batch(es) of up to {2}'.format(
+            sum(len(batch) for batch in batches), len(batches), self.batchSize))
+
+        restarted = 0
+        for n, batch in enumerate(batches):
+            self.report('batch {0}/{1}: killing {2}'.format(n + 1, len(batches), ', '.join(batch)))
+
+            failed = self.kill(batch)
+            if failed:
+                raise RestartError('could not kill {0} task(s) of batch {1}'.format(len(failed), n + 1))
+
+            if not self.waitHealthy(batch, instances):
+                raise RestartError('batch {0} did not come back healthy within {1}s'.format(
+                    n + 1, self.timeout))
+
+            restarted += len(batch)
+            self.report('batch {0}/{1}: healthy, {2}/{3} task(s) restarted in {4:.0f}s'.format(
+                n + 1, len(batches), restarted, sum(len(b) for b in batches), time.time() - started))
+
+        return restarted
@@ -0,0 +1,136 @@
+"""
+**Runtime** talks to a running HAProxy over its stats socket, so that backend
+membership can change without a restart.  Each tracked backend is rendered
+with a fixed number of server slots; tasks come and go by pointing a slot at
+a new address and enabling it, or by putting it into maintenance.  Only a
+change in the shape of the config, i.e. frontends, ports or slot capacity,
+still needs a full reload.
+
+HAProxy only takes IP addresses for a slot, so a change to a task known by
+hostname, as Marathon reports them unless *resolve_task_hosts* is on, also
+needs a reload.  A slot is only enabled once all of the new addresses have
+taken.
+"""
+
+import logging
+import logging.handlers
+import socket
+
+from resolver import isAddress
+
+logger = logging.getLogger('Runtime')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+# The only responses from the stats socket, other than none at all, that mean
+# a command took: those to a changed, or unchanged, server address.
+SUCCESSES = ('IP changed from', 'no need to change the addr')
+
+class RuntimeAPIError(Exception):
+    pass
+
+class RuntimeAPI(object):
+    def __init__(self, path, timeout=5, batchSize=50):
+        self.path      = path
+        self.timeout   = timeout
+        self.batchSize = batchSize
+
+    def send(self, line):
+        """
+        Send one line to the socket and return the whole response.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            sock.sendall(line + '\n')
+
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            sock.close()
+
+        return ''.join(chunks)
+
+    def execute(self, commands):
+        """
+        Run the commands, batchSize at a time, one connection per batch.
+        Raises RuntimeAPIError if HAProxy answers any of them with anything
+        but a known success.
+        """
+        responses = []
+
+        for i in range(0, len(commands), self.batchSize):
+            batch = commands[i:i + self.batchSize]
+            response = self.send(';'.join(batch))
+
+            for line in response.splitlines():
+                if line.strip() and not line.startswith(SUCCESSES):
+                    raise RuntimeAPIError('HAProxy rejected [{0}]: {1}'.format(
+                        '; '.join(batch), response.strip()))
+
+            responses.append(response)
+
+        return responses
+
+def slotCommands(old, new):
+    """
+    The commands that take the servers of each backend from old to new, both
+    dictionaries of backend to {server name: address, or None if disabled},
+    in two steps: those that park or move slots, and then those that enable
+    the moved slots, to be run only if the first step took.  Raises
+    RuntimeAPIError if a new address is not an IP address.
+    """
+    moves, enables = [], []
+
+    for backend in sorted(new):
+        before = old.get(backend, {})
+        for name in sorted(new[backend]):
+            addr = new[backend][name]
+            if addr == before.get(name):
+                continue
+
+            server = '{0}/{1}'.format(backend, name)
+            if addr is None:
+                moves.append('set server {0} state maint'.format(server))
+            else:
+                host, port = addr.rsplit(':', 1)
+                if not isAddress(host.strip('[]')):
+                    raise RuntimeAPIError('{0} is not an IP address, see resolve_task_hosts'
+                        .format(host))
+                moves.append('set server {0} addr {1} port {2}'.format(server, host, port))
+                enables.append('set server {0} state ready'.format(server))
+
+    return moves, enables
+
+class SlotTable(object):
+    """
+    Sticky assignment of backend servers to each app's slots, so that a task
+    keeps its slot (and its websocket cookie) for as long as it lives.
+    """
+    def __init__(self):
+        self.apps = {}
+
+    def assign(self, appId, servers, capacity):
+        """
+        Place the (host, port) servers of an app into capacity slots, keeping
+        existing servers where they are.  Returns the slot list, with None for
+        empty slots.
+        """
+        wanted = set(servers)
+        slots = [s if s in wanted else None for s in self.apps.get(appId, [])[:capacity]]
+        slots += [None] * (capacity - len(slots))
+
+        placed = set(slots)
+        free = (i for i, s in enumerate(slots) if s is None)
+        for server in servers:
+            if server not in placed:
+                slots[next(free)] = server
+                placed.add(server)
+
+        self.apps[appId] = slots
+        return slots
@@ -0,0 +1,91 @@
+"""
+**SnapshotStore** keeps the last known tasks of the tracked apps on disk, so
+that the orchestrator can bring HAProxy up after a restart without waiting
+for Marathon, and reconcile with Marathon once it answers.  A snapshot is
+saved whenever a refresh puts a new config in place, along with the digest
+of that config.  It is stored as gzipped JSON, each task cut down to its
+id, host, ports and app id, and replaced atomically like the config itself.
+"""
+
+from collections import OrderedDict
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import tempfile
+import time
+
+from records import Task, asTasks
+
+logger = logging.getLogger('SnapshotStore')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+VERSION = 1
+
+def pack(snapshot):
+    """
+    The apps of a snapshot as [appId, tasks] pairs, in order, with each task
+    as [id, host, ports, appId].
+    """
+    return [[appId, [[task.id, task.host, list(task.ports), task.appId] for task in asTasks(tasks)]]
+        for appId, tasks in snapshot.iteritems()]
+
+def unpack(apps):
+    snapshot = OrderedDict()
+    for appId, tasks in apps:
+        snapshot[appId] = [Task(taskId, host, ports, taskAppId)
+            for taskId, host, ports, taskAppId in tasks]
+    return snapshot
+
+class SnapshotStore(object):
+    def __init__(self, path):
+        self.path      = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.digest    = None
+
+    def save(self, snapshot, digest):
+        """
+        Replace the stored snapshot, unless it was saved for the same config.
+        """
+        if digest == self.digest:
+            return False
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory,
+            prefix='.{0}.'.format(os.path.basename(self.path)))
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                output = gzip.GzipFile(fileobj=stream, mode='wb')
+                json.dump({ 'version': VERSION, 'saved_at': time.time(), 'digest': digest,
+                    'apps': pack(snapshot) }, output, separators=(',', ':'))
+                output.close()
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.rename(tmp, self.path)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+        self.digest = digest
+        return True
+
+    def load(self):
+        """
+        The stored snapshot, when it was saved, and the digest of its config,
+        or None if there is no usable snapshot.
+        """
+        try:
+            with gzip.open(self.path, 'rb') as stream:
+                saved = json.load(stream)
+            if saved.get('version') != VERSION:
+                raise ValueError('unknown version {0}'.format(saved.get('version')))
+            snapshot = unpack(saved['apps'])
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            if os.path.exists(self.path):
+                logger.warning('Ignoring unreadable snapshot {0}: {1}'.format(self.path, e))
+            return None
+
+        self.digest = saved.get('digest')
+        return snapshot, saved.get('saved_at'), self.digest
@@ -0,0 +1,110 @@
+"""
+**TaskIndex** is an in-memory index of the tracked apps and their live tasks.
+It is seeded from a full Marathon snapshot and then kept current by applying
+each *status_update_event* as a constant time delta, so that the HAProxy
+config can be rendered without asking Marathon for the whole cluster on
+every event.  Tasks are held as slotted Task records, since the index lives
+as long as the orchestrator.  A periodic full snapshot replaces the index to repair any
+drift, e.g. from events lost while the orchestrator was down.
+"""
+
+from collections import OrderedDict
+import threading
+
+from records import Task
+
+# Marathon task states, as far as the load balancer is concerned.
+RUNNING = frozenset(['TASK_RUNNING'])
+PENDING = frozenset(['TASK_STAGING', 'TASK_STARTING'])
+GONE    = frozenset(['TASK_FINISHED', 'TASK_FAILED', 'TASK_KILLING', 'TASK_KILLED',
+    'TASK_LOST', 'TASK_ERROR', 'TASK_DROPPED', 'TASK_GONE', 'TASK_GONE_BY_OPERATOR',
+    'TASK_UNREACHABLE', 'TASK_UNKNOWN'])
+
+def normalize(appId):
+    return appId[1:] if appId.startswith('/') else appId
+
+def record(task):
+    """
+    Keep only what the config is rendered from, so that comparisons are not
+    thrown off by version stamps or health check results.
+    """
+    return task if isinstance(task, Task) else Task.fromDict(task)
+
+def unordered(apps):
+    """
+    The apps as plain dictionaries, to compare regardless of the order in
+    which Marathon listed them, or events delivered their tasks.
+    """
+    return dict((appId, dict(tasks)) for appId, tasks in apps.iteritems())
+
+class TaskIndex(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.apps = None
+
+    @property
+    def primed(self):
+        return self.apps is not None
+
+    def replace(self, snapshot):
+        """
+        Replace the index with a full snapshot of appId to task list.
+        Returns True if that changed anything; the same tasks in another
+        order leave the index as it is.
+        """
+        apps = OrderedDict()
+        for appId, tasks in snapshot.iteritems():
+            apps[appId] = OrderedDict((task.id, task) for task in map(record, tasks))
+
+        with self.lock:
+            changed = self.apps is None or unordered(self.apps) != unordered(apps)
+            if changed:
+                self.apps = apps
+
+        return changed
+
+    def apply(self, evt):
+        """
+        Apply a *status_update_event* to the index.  Returns True if the set
+        of live tasks changed, False if it did not, and None if the event
+        cannot be applied as a delta (the index has not been seeded yet, or
+        the event lacks the fields or carries a status we do not know), in
+        which case the caller should fall back to a full resync.
+        """
+        status = evt.get('taskStatus')
+        taskId = evt.get('taskId')
+        appId = evt.get('appId', evt.get('appID'))
+
+        if not self.primed or not taskId or not appId:
+            return None
+
+        appId = normalize(appId)
+
+        with self.lock:
+            tasks = self.apps.get(appId)
+
+            if status in RUNNING:
+                task = Task(taskId, evt['host'], evt.get('ports') or (),
+                    evt.get('appId', evt.get('appID')))
+                if tasks is None:
+                    tasks = self.apps[appId] = OrderedDict()
+                if tasks.get(taskId) == task:
+                    return False
+                tasks[taskId] = task
+                return True
+
+            if status in GONE:
+                return tasks is not None and tasks.pop(taskId, None) is not None
+
+            if status in PENDING:
+                return False
+
+        return None
+
+    def snapshot(self):
+        """
+        A copy of the index in the same shape as Marathon.getSnapshot().
+        """
+        with self.lock:
+            return OrderedDict((appId, tasks.values())
+                for appId, tasks in self.apps.iteritems())
@@ -0,0 +1,240 @@
+"""
+**Tracing** times the phases of each config refresh: checking the config,
+asking Marathon, rendering, publishing and reloading HAProxy.  A trace is
+started for each batch of events (or resync), tagged with the events that
+triggered it, and each phase inside it is a *span*.  Spans find their trace
+through the current thread, so code anywhere below a trace can time itself
+with `with span('name'):`, which costs next to nothing when nothing is
+being traced.
+
+The most recent traces are kept in a fixed-size ring buffer.  Optionally, a
+trace can be sampled by a profiler thread while it runs; if it turns out to
+be slower than a threshold, its hottest stacks are kept with it.
+"""
+
+import collections
+from contextlib import contextmanager
+import itertools
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger('Tracing')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+# How many of the events behind a trace are listed in it.
+MAX_EVENTS = 20
+
+# How many frames of a sampled stack, and how many stacks, are kept.
+MAX_FRAMES = 30
+TOP_STACKS = 10
+
+context = threading.local()
+
+def current():
+    return getattr(context, 'trace', None)
+
+class Span(object):
+    def __init__(self, name):
+        self.name  = name
+        self.trace = None
+
+    def __enter__(self):
+        self.trace = current()
+        if self.trace is not None:
+            self.depth = getattr(context, 'depth', 0)
+            context.depth = self.depth + 1
+            self.start = time.time()
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if self.trace is not None:
+            context.depth = self.depth
+            self.trace.record(self.name, self.start, time.time(), self.depth,
+                excType.__name__ if excType else None)
+
+def span(name):
+    """
+    A context manager timing its block as a phase of the current trace.
+    """
+    return Span(name)
+
+def bind(func):
+    """
+    func, made to record its spans in the caller's trace from whichever
+    thread it is run on, e.g. that of a pool.
+    """
+    trace = current()
+    if trace is None:
+        return func
+
+    depth = getattr(context, 'depth', 0)
+
+    def bound(*args, **kwargs):
+        previous = current(), getattr(context, 'depth', 0)
+        context.trace, context.depth = trace, depth
+        try:
+            return func(*args, **kwargs)
+        finally:
+            context.trace, context.depth = previous
+
+    return bound
+
+def summarize(evt):
+    return {
+        'appId': evt.get('appId', evt.get('appID')),
+        'taskId': evt.get('taskId'),
+        'taskStatus': evt.get('taskStatus')
+    }
+
+class Trace(object):
+    def __init__(self, id, trigger, events=()):
+        self.id         = id
+        self.trigger    = trigger
+        self.events     = [summarize(evt) for evt in events[:MAX_EVENTS]]
+        self.eventCount = len(events)
+        self.startedAt  = time.time()
+        self.duration   = None
+        self.outcome    = None
+        self.profile    = None
+        self.spans      = []
+        self.lock       = threading.Lock()
+
+    def record(self, name, start, end, depth, error=None):
+        span = {
+            'name': name,
+            'start': round(start - self.startedAt, 6),
+            'duration': round(end - start, 6),
+            'depth': depth
+        }
+        if error:
+            span['error'] = error
+
+        with self.lock:
+            self.spans.append(span)
+
+    def asDict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+
+        trace = {
+            'id': self.id,
+            'trigger': self.trigger,
+            'started_at': self.startedAt,
+            'duration': self.duration,
+            'outcome': self.outcome,
+            'events': self.events,
+            'event_count': self.eventCount,
+            'spans': spans
+        }
+        if self.profile is not None:
+            trace['profile'] = self.profile
+
+        return trace
+
+class Sampler(object):
+    """
+    Samples the stack of one thread every interval seconds, until stopped.
+    """
+    def __init__(self, threadId, interval):
+        self.threadId = threadId
+        self.interval = interval
+        self.counts   = collections.defaultdict(int)
+        self.samples  = 0
+        self.stopped  = threading.Event()
+        self.thread   = threading.Thread(target=self.run, name='sampler')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame is not None and len(stack) < MAX_FRAMES:
+                code = frame.f_code
+                stack.append('{0} ({1}:{2})'.format(code.co_name,
+                    os.path.basename(code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def top(self, n=TOP_STACKS):
+        """
+        The n most sampled stacks, outermost frame first.
+        """
+        stacks = sorted(self.counts.items(), key=lambda item: -item[1])[:n]
+        return {
+            'interval': self.interval,
+            'samples': self.samples,
+            'stacks': [{ 'stack': stack, 'samples': count } for stack, count in stacks]
+        }
+
+class Tracer(object):
+    def __init__(self, size=100, profileThreshold=None, profileInterval=0.005):
+        """
+        Keeps the last size traces.  With a profileThreshold in seconds,
+        each trace is sampled every profileInterval seconds, and the stacks
+        are kept for those that take longer than the threshold.
+        """
+        self.traces           = collections.deque(maxlen=size)
+        self.ids              = itertools.count(1)
+        self.profileThreshold = profileThreshold
+        self.profileInterval  = profileInterval
+        self.lock             = threading.Lock()
+
+    @contextmanager
+    def trace(self, trigger, events=()):
+        """
+        Trace the block, on this thread, as set off by trigger and events.
+        The trace is handed to the block, which can set its outcome.
+        """
+        with self.lock:
+            trace = Trace(next(self.ids), trigger, events)
+
+        sampler = None
+        if self.profileThreshold is not None:
+            sampler = Sampler(threading.current_thread().ident, self.profileInterval).start()
+
+        previous = current(), getattr(context, 'depth', 0)
+        context.trace, context.depth = trace, 0
+        try:
+            yield trace
+        except Exception as e:
+            trace.outcome = 'error: {0}'.format(e)
+            raise
+        finally:
+            context.trace, context.depth = previous
+            trace.duration = round(time.time() - trace.startedAt, 6)
+            if sampler is not None:
+                sampler.stop()
+                if trace.duration >= self.profileThreshold:
+                    trace.profile = sampler.top()
+                    logger.warning('Slow {0} refresh took {1:.3f}s: {2}'.format(trigger,
+                        trace.duration, ', '.join('{name} {duration:.3f}s'.format(**span)
+                            for span in trace.asDict()['spans'] if span['depth'] == 0)))
+
+            with self.lock:
+                self.traces.append(trace)
+
+    def recent(self, limit=None):
+        """
+        The most recent traces, newest first.
+        """
+        with self.lock:
+            traces = list(self.traces)
+
+        traces.reverse()
+        return [trace.asDict() for trace in traces[:limit]]
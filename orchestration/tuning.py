@@ -0,0 +1,109 @@
+"""
+**Tuning** works out the process settings for HAProxy's global section from
+the machine it runs on: how many threads to run and which cores to pin them
+to, and how many connections the file descriptor limit allows.  Each setting
+can be given in the JSON config as a number, as *auto* to have it detected,
+or left out to keep HAProxy's single-threaded defaults.
+"""
+
+import multiprocessing
+import resource
+
+# File descriptors kept back for HAProxy's own use (logs, sockets, checks).
+RESERVED_FDS = 1000
+
+# Used when the fd limit is unlimited.
+MAX_FDS = 1048576
+
+DEFAULT_MAXCONN = 4000
+DEFAULT_DEFAULT_MAXCONN = 3000
+
+def cpuCount():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def fdLimit():
+    """
+    The most file descriptors HAProxy can raise its limit to.  It is started
+    as root, so that is the hard limit rather than the soft one.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = hard if hard != resource.RLIM_INFINITY else MAX_FDS
+    return max(soft, limit)
+
+def connectionLimit(fds):
+    """
+    Every proxied connection holds two descriptors, one on each side.
+    """
+    return max(DEFAULT_MAXCONN, (fds - RESERVED_FDS) // 2)
+
+def hostSettings(config):
+    """
+    The settings of config that are worked out from this machine, and so do
+    not fit a config that is rendered for other machines.  The cpu map is
+    one of them whenever threads are on, as it depends on the core count.
+    """
+    settings = [key for key in ('nbthread', 'maxconn') if config.get(key) == 'auto']
+    if config.get('nbthread') and config.get('cpu_map', 'auto') == 'auto':
+        settings.append('cpu_map')
+    return settings
+
+class Tuning(object):
+    def __init__(self, config, cpus=None, fds=None):
+        """
+        config is the orchestrator's config.  cpus and fds override what is
+        detected, mainly for tests.
+        """
+        self.cpus = cpus or cpuCount()
+        self.fds  = fds or fdLimit()
+
+        nbthread = config.get('nbthread')
+        self.nbthread = self.cpus if nbthread == 'auto' else nbthread
+
+        cpuMap = config.get('cpu_map', 'auto')
+        self.cpuMap = cpuMap if cpuMap != 'auto' else bool(self.nbthread and self.nbthread > 1)
+
+        maxconn = config.get('maxconn', DEFAULT_MAXCONN)
+        self.maxconn = connectionLimit(self.fds) if maxconn == 'auto' else maxconn
+
+        defaultMaxconn = config.get('default_maxconn', DEFAULT_DEFAULT_MAXCONN)
+        self.defaultMaxconn = self.maxconn * 3 // 4 if defaultMaxconn == 'auto' else defaultMaxconn
+
+        self.bindOptions = config.get('bind_options', '')
+
+    def threads(self):
+        """
+        The threading lines of the global section, pinning thread N to core
+        N-1 when the cpu map is on, or as the cpu_map setting says.
+        """
+        if not self.nbthread:
+            return ''
+
+        lines = ['    nbthread {0}\n'.format(self.nbthread)]
+        if self.cpuMap is True:
+            # One thread per core; with more threads than cores, there is
+            # nothing sensible to pin them to.
+            if self.nbthread <= self.cpus:
+                lines.append('    cpu-map auto:1/1-{0} 0-{1}\n'.format(
+                    self.nbthread, self.nbthread - 1))
+        elif self.cpuMap:
+            lines.append('    cpu-map {0}\n'.format(self.cpuMap))
+
+        return ''.join(lines)
+
+    def bind(self, service):
+        """
+        The options for a service's bind line: its own bind_options, if it
+        has any, or else those of the whole config.
+        """
+        options = service.get('bind_options', self.bindOptions)
+        return ' ' + options if options else ''
+
+    def context(self):
+        return {
+            "threads" : self.threads(),
+            "maxconn" : self.maxconn,
+            "defaultMaxconn" : self.defaultMaxconn
+        }
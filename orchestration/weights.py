@@ -0,0 +1,145 @@
+"""
+**Weights** adapt the share of traffic each backend server gets to how well
+it is coping.  Every so often the per-server statistics are read from the
+HAProxy stats socket, and each server is given a cost: its average response
+time, plus a penalty for requests queued on it, its share of errors since the
+last look, and how close it is to its session limit.  The costs are smoothed
+over time, and each server's weight is pushed towards its backend's mean cost
+over its own, so a slow or overloaded agent sheds traffic to its idle
+neighbours.  Weights only move part of the way each round (damping), and are
+kept between a floor and a ceiling, so one bad sample cannot starve a server.
+"""
+
+import csv
+import logging
+import logging.handlers
+
+logger = logging.getLogger('Weights')
+handler = logging.handlers.SysLogHandler(address='/dev/log', facility=19)
+logger.addHandler(handler)
+
+# Servers in these states are left alone; HAProxy is not sending them traffic.
+IDLE = ('DOWN', 'MAINT', 'DRAIN', 'NOLB')
+
+def number(row, field):
+    try:
+        return float(row.get(field) or 0)
+    except ValueError:
+        return 0.0
+
+def parseStats(text):
+    """
+    The server rows of *show stat* CSV output, as dictionaries by field.
+    """
+    lines = text.strip().splitlines()
+    if not lines:
+        return []
+
+    header = lines[0].lstrip('# ').rstrip(',').split(',')
+    rows = csv.DictReader(lines[1:], fieldnames=header)
+
+    return [row for row in rows if row['svname'] not in ('FRONTEND', 'BACKEND')]
+
+class AdaptiveWeights(object):
+    def __init__(self, runtime, base=100, floor=10, ceiling=256, smoothing=0.3,
+            damping=0.5, queuePenalty=10.0, errorPenalty=1000.0, dryRun=False):
+        """
+        runtime is the RuntimeAPI of the stats socket.  A server at its
+        backend's mean cost is worth base; smoothing is the weight of each
+        new sample in the running average of costs, and damping how far a
+        weight moves towards its target each round.  The cost of a server is
+        its response time in ms, plus queuePenalty ms per queued request and
+        errorPenalty ms at a 100% error rate.
+        """
+        self.runtime      = runtime
+        self.base         = base
+        self.floor        = floor
+        self.ceiling      = ceiling
+        self.smoothing    = smoothing
+        self.damping      = damping
+        self.queuePenalty = queuePenalty
+        self.errorPenalty = errorPenalty
+        self.dryRun       = dryRun
+
+        self.costs    = {}
+        self.counters = {}
+
+    def cost(self, key, row):
+        """
+        The cost of one server in this sample, folded into its running average.
+        """
+        requests = number(row, 'stot')
+        errors = number(row, 'econ') + number(row, 'eresp') + number(row, 'hrsp_5xx')
+
+        before = self.counters.get(key)
+        self.counters[key] = (requests, errors)
+        errorRate = 0.0
+        if before and requests > before[0]:
+            errorRate = min(1.0, max(0.0, (errors - before[1]) / (requests - before[0])))
+
+        sample = max(number(row, 'rtime'), 1.0)
+        sample += self.queuePenalty * number(row, 'qcur')
+        sample += self.errorPenalty * errorRate
+        if number(row, 'slim'):
+            sample *= 1 + number(row, 'scur') / number(row, 'slim')
+
+        cost = self.costs.get(key)
+        cost = sample if cost is None else self.smoothing * sample + (1 - self.smoothing) * cost
+        self.costs[key] = cost
+        return cost
+
+    def targets(self, rows):
+        """
+        The new weight of each live server, as {(backend, server): weight}.
+        """
+        backends = {}
+        live = set()
+
+        for row in rows:
+            if row.get('status', '').split(' ')[0] in IDLE:
+                continue
+
+            # The address is part of the key, since a runtime slot can be
+            # pointed at a different task.
+            key = (row['pxname'], row['svname'], row.get('addr'))
+            live.add(key)
+            backends.setdefault(row['pxname'], []).append(
+                (row['svname'], number(row, 'weight'), self.cost(key, row)))
+
+        # Forget servers that have gone.
+        for key in set(self.costs) - live:
+            del self.costs[key]
+            self.counters.pop(key, None)
+
+        weights = {}
+        for backend, servers in backends.iteritems():
+            mean = sum(cost for _, _, cost in servers) / len(servers)
+            for server, current, cost in servers:
+                target = self.base * mean / cost
+                weight = current + self.damping * (target - current)
+                weights[(backend, server)] = int(round(max(self.floor, min(self.ceiling, weight))))
+
+        return weights
+
+    def update(self):
+        """
+        Read the statistics and push the weights that changed.  Returns the
+        changed weights; in dry-run mode they are only logged.
+        """
+        rows = parseStats(self.runtime.send('show stat'))
+        current = dict(((row['pxname'], row['svname']), number(row, 'weight')) for row in rows)
+
+        changes = dict((server, weight) for server, weight in self.targets(rows).iteritems()
+            if weight != current.get(server))
+
+        commands = ['set weight {0}/{1} {2}'.format(backend, server, weight)
+            for (backend, server), weight in sorted(changes.items())]
+
+        if self.dryRun:
+            for command in commands:
+                logger.info('Dry run, not sending: {0}'.format(command))
+        elif commands:
+            logger.info('Adjusting {0} server weight(s)'.format(len(commands)))
+            self.runtime.execute(commands)
+
+        return changes
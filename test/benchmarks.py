@@ -0,0 +1,586 @@
+#!/usr/bin/env python
+"""
+**Orchestration Benchmarks** time config generation and the path from a
+Marathon event to a reload, on synthetic clusters served by a local fake
+Marathon.  Nothing outside a temporary directory is touched, and HAProxy is
+never actually restarted.
+
+Each cluster size runs in a fresh process, so that its peak memory can be
+told apart from the others'.  For every size, the following are timed:
+
+ * *render_cold*: rendering the config with an empty fragment cache.
+ * *gen*: ServiceOrchestrator.gen(), i.e. fetching the cluster from
+   Marathon and rendering it, with the cache warm.
+ * *refresh*: refreshConfig() after one task has moved, which fetches,
+   renders and publishes the config.
+ * *marathon*: a POST of a new task to /marathon through the Flask test
+   client, up to the end of the reload it causes.
+
+Every size is run a second time with *fragment_cache* off, so that the peak
+memory and times of rendering without the cache can be set against it.
+
+The parsing of the cluster's /v2/apps listing, with everything Marathon
+says about each app and task, is also compared between decoding the whole
+body into dictionaries (*full*) and streaming it into Task records
+(*stream*), each in a process of its own, by time and by how far it raises
+the peak memory above that of holding the body.
+
+With --haproxy, and an haproxy binary on the PATH, HAProxy itself is run on
+a config rendered by the orchestrator, in front of a local HTTP backend, and
+its throughput compared between the default and the core-aware tuning.
+
+To run (from the command line):
+
+./bin/orch.sh bench                                  # the default sizes
+./bin/orch.sh bench --sizes 10x100,100x10000 -n 50   # apps x tasks, repeats
+./bin/orch.sh bench -o after.json --compare before.json
+./bin/orch.sh bench --sizes 10x100 --haproxy --duration 30
+
+Results are written as JSON (see --output), with the commit they were taken
+at, and can be compared against an earlier run with --compare.
+"""
+
+# Built-in imports
+import argparse
+import BaseHTTPServer
+import datetime
+from distutils.spawn import find_executable
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# Installed imports
+from mock import patch
+
+# Hack to get test file in its own directory.
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# The test module sets up the environment for main, and has the fake Marathon.
+from orch_tests import FakeMarathon
+import main
+from orchestration.marathon import CHUNK_SIZE
+from orchestration.records import Task, iterItems
+from orchestration.ServiceOrchestrator import ServiceOrchestrator
+from orchestration.taskindex import TaskIndex
+from orchestration.tuning import Tuning
+
+DEFAULT_SIZES = '10x100,100x1000,100x10000,1000x50000'
+
+# === Synthetic Clusters ===
+
+def service(n):
+    """
+    The service config of app n.  Every third app is password protected,
+    every fourth has a fixed backend port, and every tenth is a single host.
+    """
+    config = { 'port': 10000 + n }
+    if n % 3 == 0:
+        config['authConf'] = 'site_users'
+    if n % 4 == 0:
+        config['backend_port'] = 8080
+    if n % 10 == 0:
+        config['single_host'] = 'app{0}.example.com'.format(n)
+    return config
+
+def task(appId, n):
+    return {
+        'id': '{0}.{1}'.format(appId, n),
+        'appId': '/' + appId,
+        'host': '10.{0}.{1}.{2}'.format(n / 65536 % 256, n / 256 % 256, n % 256),
+        'ports': [ 31000 + n % 1000 ],
+        'startedAt': '2015-01-01T00:00:00.000Z',
+        'stagedAt': '2015-01-01T00:00:00.000Z',
+        'version': '2015-01-01T00:00:00.000Z'
+    }
+
+def cluster(apps, tasks):
+    """
+    The services, and Marathon's /v2/apps listing, of a cluster with the
+    given numbers of apps and tasks, the tasks spread evenly over the apps.
+    """
+    services = {}
+    listing = []
+
+    for a in range(apps):
+        appId = 'app{0}'.format(a)
+        count = tasks / apps + (1 if a < tasks % apps else 0)
+        services[appId] = service(a)
+        listing.append({
+            'id': '/' + appId,
+            'instances': count,
+            'tasks': [ task(appId, a * tasks + t) for t in range(count) ]
+        })
+
+    return services, listing
+
+def verbose(listing):
+    """
+    The listing with as much again about each app and task as Marathon
+    reports, none of which the config needs.
+    """
+    apps = []
+    for app in listing:
+        app = dict(app, cmd='python -m http.server $PORT0', cpus=0.5, mem=512, disk=0,
+            env={ 'APP_ENV': 'production', 'LOG_LEVEL': 'info' },
+            labels={ 'team': 'bench', 'HAPROXY_GROUP': 'external' },
+            healthChecks=[{ 'path': '/health', 'protocol': 'HTTP', 'intervalSeconds': 10 }],
+            versionInfo={ 'lastScalingAt': '2015-01-01T00:00:00.000Z',
+                'lastConfigChangeAt': '2015-01-01T00:00:00.000Z' })
+        app['tasks'] = [dict(task, slaveId='20150101-000000-1-5050-1-S{0}'.format(n % 100),
+            state='TASK_RUNNING', ipAddresses=[{ 'ipAddress': task['host'], 'protocol': 'IPv4' }],
+            healthCheckResults=[{ 'alive': True, 'consecutiveFailures': 0, 'taskId': task['id'],
+                'firstSuccess': '2015-01-01T00:00:00.000Z', 'lastSuccess': '2015-01-01T00:00:00.000Z' }])
+            for n, task in enumerate(app['tasks'])]
+        apps.append(app)
+
+    return apps
+
+def parseFull(body):
+    """
+    How listings were parsed before: the whole body into dictionaries, kept.
+    """
+    return dict((app['id'], app['tasks']) for app in json.loads(body)['apps'])
+
+def parseStream(body):
+    chunks = (body[n:n + CHUNK_SIZE] for n in range(0, len(body), CHUNK_SIZE))
+    return dict((app['id'], [Task.fromDict(task) for task in app['tasks']])
+        for app in iterItems(chunks, 'apps'))
+
+def parseIndex(body):
+    """
+    A streamed listing, held the way the orchestrator holds it for good: in
+    the task index.
+    """
+    index = TaskIndex()
+    index.replace(parseStream(body))
+    return index
+
+def runParse(listingFile, mode, repeat):
+    """
+    Time one way of parsing a cluster's listing.  Runs in its own process,
+    which has held nothing bigger than the listing before it starts.
+    """
+    with open(listingFile) as stream:
+        body = stream.read()
+    parse = { 'full': parseFull, 'stream': parseStream, 'index': parseIndex }[mode]
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Kept until the next parse, as the orchestrator keeps a snapshot.
+    kept = [None]
+    def run():
+        kept[0] = None
+        kept[0] = parse(body)
+
+    seconds = timed(run, repeat)
+    return {
+        'body_kb': len(body) / 1024,
+        'seconds': seconds,
+        'peak_rss_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    }
+
+# === Measurements ===
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * len(ordered) + 0.5)) - 1)]
+
+def summarize(samples):
+    return {
+        'samples': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': percentile(samples, 50),
+        'p90': percentile(samples, 90),
+        'p99': percentile(samples, 99),
+        'max': max(samples)
+    }
+
+def timed(func, repeat, before=None):
+    samples = []
+    for i in range(repeat):
+        if before:
+            before(i)
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+
+    return summarize(samples)
+
+def runScenario(apps, tasks, repeat, fragmentCache=True):
+    """
+    Benchmark one cluster size.  Runs in its own process.
+    """
+    # Quieten the orchestrator's progress messages while timing.
+    logging.disable(logging.WARNING)
+    sys.stdout = open(os.devnull, 'w')
+
+    services, listing = cluster(apps, tasks)
+    marathon = FakeMarathon({ '/v2/apps?embed=apps.tasks': { 'apps': listing } })
+    workDir = tempfile.mkdtemp()
+
+    configFile = os.path.join(workDir, 'config.json')
+    with open(configFile, 'w') as stream:
+        json.dump({
+            'marathon_hosts': [ marathon.url.split('/')[2] ],
+            'services': services,
+            'config_destination': os.path.join(workDir, 'haproxy.cfg'),
+            'users_config_destination': os.path.join(workDir, 'users.cfg'),
+            'pid_file': os.path.join(workDir, 'haproxy.pid'),
+            'fragment_cache': fragmentCache
+        }, stream)
+
+    try:
+        with patch('subprocess.call') as call:
+            call.return_value = 0
+            system = main.system = ServiceOrchestrator(configFile)
+            system.gen()
+
+            client = main.app.test_client()
+            snapshot = system.index.snapshot()
+            event = {}
+
+            def coldCache(i):
+                system.fragments = {}
+
+            def moveTask(i):
+                appId = 'app{0}'.format(i % apps)
+                listing[i % apps]['tasks'][0:1] = [ task(appId, apps * tasks + i) ]
+
+            def newTask(i):
+                event.update(task('app1', apps * tasks + repeat + i),
+                    eventType='status_update_event', taskId='app1.new-{0}'.format(i),
+                    taskStatus='TASK_RUNNING')
+
+            def postEvent():
+                # Posted from the fake Marathon's address, so it is approved.
+                client.post('/marathon', data=json.dumps(event),
+                    environ_base={ 'REMOTE_ADDR': '127.0.0.1' })
+                main.events.join()
+                main.reloads.flush()
+
+            timings = {
+                'render_cold': timed(lambda: system.render(snapshot), repeat, coldCache),
+                'gen': timed(system.gen, repeat),
+                'refresh': timed(system.refreshConfig, repeat, moveTask),
+                'marathon': timed(postEvent, repeat, newTask)
+            }
+            reloads = call.call_count
+    finally:
+        marathon.close()
+        shutil.rmtree(workDir)
+
+    return {
+        'apps': apps,
+        'tasks': tasks,
+        'repeat': repeat,
+        'reloads': reloads,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'timings': timings
+    }
+
+# === HAProxy Throughput ===
+
+# The process tunings compared by --haproxy: HAProxy's single-threaded
+# defaults, and everything detected from the machine.  Both use the stick
+# table that a current HAProxy needs in place of appsession.
+TUNINGS = [
+    ('default', { 'session_stickiness': 'stick_table' }),
+    ('auto', { 'nbthread': 'auto', 'maxconn': 'auto', 'default_maxconn': 'auto' })
+]
+
+# Global settings that need root.
+UNPRIVILEGED = ('chroot', 'user', 'group', 'daemon', 'pidfile')
+
+class Backend(BaseHTTPServer.HTTPServer):
+    """
+    A trivial HTTP backend, served by several forked processes sharing one
+    listening socket, so that it is not what limits the throughput.
+    """
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write('ok')
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self, processes):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), self.Handler)
+        self.port = self.server_address[1]
+        self.workers = [multiprocessing.Process(target=self.serve_forever)
+            for i in range(processes)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+        self.server_close()
+
+def freePort():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def localConfig(configText, workDir):
+    """
+    A rendered config made runnable by an ordinary user, in the foreground.
+    """
+    lines = []
+    for line in configText.splitlines():
+        words = line.split()
+        if words[:1] and words[0] in UNPRIVILEGED:
+            continue
+        if words[:2] == ['stats', 'socket']:
+            line = '    stats socket {0}'.format(os.path.join(workDir, 'stats'))
+        if words[:2] == ['listen', 'stats']:
+            line = 'listen stats 127.0.0.1:{0}'.format(freePort())
+        lines.append(line)
+
+    return '\n'.join(lines) + '\n'
+
+def load(port, duration):
+    """
+    Make HTTP/1.0 requests to the port, one after another, for duration
+    seconds.  Returns how many got an answer.
+    """
+    done = 0
+    deadline = time.time() + duration
+
+    while time.time() < deadline:
+        sock = socket.create_connection(('127.0.0.1', port))
+        try:
+            sock.sendall('GET / HTTP/1.0\r\nHost: bench\r\n\r\n')
+            response = ''
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                response += chunk
+        finally:
+            sock.close()
+
+        if response.startswith('HTTP/1.') and ' 200 ' in response.split('\r\n', 1)[0]:
+            done += 1
+
+    return done
+
+def loadWorker(args):
+    return load(*args)
+
+def runHAProxy(binary, name, tuning, duration, clients):
+    """
+    Requests per second through HAProxy, with a config rendered by the
+    orchestrator under the given tuning, to a local backend.
+    """
+    logging.disable(logging.WARNING)
+    sys.stdout = open(os.devnull, 'w')
+
+    workDir = tempfile.mkdtemp()
+    backend = Backend(max(2, multiprocessing.cpu_count()))
+    proxy = None
+    frontend = freePort()
+
+    config = dict(tuning, marathon_hosts=[ '127.0.0.1:8080' ],
+        services={ 'bench': { 'port': frontend, 'single_host': '127.0.0.1',
+            'backend_port': backend.port } },
+        config_destination=os.path.join(workDir, 'haproxy.cfg'),
+        users_config_destination=os.path.join(workDir, 'users.cfg'),
+        pid_file=os.path.join(workDir, 'haproxy.pid'))
+    configFile = os.path.join(workDir, 'config.json')
+    with open(configFile, 'w') as stream:
+        json.dump(config, stream)
+
+    try:
+        system = ServiceOrchestrator(configFile)
+        with open(system.configDest, 'w') as stream:
+            stream.write(localConfig(system.render({ 'bench': [] }), workDir))
+
+        check = subprocess.Popen([binary, '-c', '-f', system.configDest],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = check.communicate()[0]
+        if check.returncode != 0:
+            return { 'tuning': name, 'error': output.strip() }
+
+        proxy = subprocess.Popen([binary, '-db', '-f', system.configDest],
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+        deadline = time.time() + 5
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', frontend)).close()
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    return { 'tuning': name, 'error': 'HAProxy did not start listening' }
+                time.sleep(0.05)
+
+        # Client processes rather than threads, so the load is not held
+        # back by the interpreter lock.
+        pool = multiprocessing.Pool(clients)
+        try:
+            done = sum(pool.map(loadWorker, [(frontend, duration)] * clients))
+        finally:
+            pool.terminate()
+
+        return {
+            'tuning': name,
+            'settings': Tuning(config).context(),
+            'clients': clients,
+            'requests_per_second': done / float(duration)
+        }
+    finally:
+        if proxy is not None:
+            proxy.terminate()
+            proxy.wait()
+        backend.close()
+        shutil.rmtree(workDir)
+
+def benchmarkHAProxy(duration, clients):
+    binary = find_executable('haproxy')
+    if binary is None:
+        print 'No haproxy binary on the PATH, skipping the throughput benchmark'
+        return []
+
+    results = []
+    for name, tuning in TUNINGS:
+        pool = multiprocessing.Pool(1)
+        try:
+            results.append(pool.apply(runHAProxy, (binary, name, tuning, duration, clients)))
+        finally:
+            pool.terminate()
+
+    return results
+
+# === Reporting ===
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def report(results, baseline=None):
+    before = {}
+    if baseline:
+        before = dict(((r['apps'], r['tasks']), r) for r in baseline['results'])
+
+    for result in results:
+        print '{apps} apps x {tasks} tasks, peak RSS {peak_rss_kb} KB'.format(**result)
+        old = before.get((result['apps'], result['tasks']))
+
+        for name in sorted(result['timings']):
+            t = result['timings'][name]
+            line = '    {0:12} p50 {1:8.4f}s  p90 {2:8.4f}s  p99 {3:8.4f}s  max {4:8.4f}s'.format(
+                name, t['p50'], t['p90'], t['p99'], t['max'])
+            if old and name in old['timings']:
+                line += '  ({0:+.0%} p50)'.format(t['p50'] / old['timings'][name]['p50'] - 1)
+            print line
+
+        uncached = result.get('uncached')
+        if uncached:
+            print '    without the fragment cache: peak RSS {0} KB, refresh p50 {1:.4f}s, marathon p50 {2:.4f}s'.format(
+                uncached['peak_rss_kb'], uncached['timings']['refresh']['p50'],
+                uncached['timings']['marathon']['p50'])
+
+        for mode, parse in sorted(result.get('parse', {}).items()):
+            print '    parse {0:6} p50 {1:8.4f}s  peak RSS +{2} KB  ({3} KB listing)'.format(
+                mode, parse['seconds']['p50'], parse['peak_rss_growth_kb'], parse['body_kb'])
+
+def reportHAProxy(results):
+    for result in results:
+        if 'error' in result:
+            print 'HAProxy ({0}): failed, {1}'.format(result['tuning'], result['error'])
+        else:
+            print 'HAProxy ({tuning}): {requests_per_second:.0f} requests/s from {clients} clients'.format(
+                **result)
+
+def runBenchmarks():
+    parser = argparse.ArgumentParser(description='Benchmark the orchestrator')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+        help='comma separated cluster sizes as APPSxTASKS (default: %(default)s)')
+    parser.add_argument('-n', '--repeat', type=int, default=20,
+        help='samples per measurement (default: %(default)s)')
+    parser.add_argument('-o', '--output', default='benchmarks.json',
+        help='where to write the results as JSON (default: %(default)s)')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--haproxy', action='store_true',
+        help='also compare HAProxy throughput with and without core-aware tuning')
+    parser.add_argument('--duration', type=float, default=10,
+        help='seconds of load per HAProxy tuning (default: %(default)s)')
+    parser.add_argument('--clients', type=int, default=2 * multiprocessing.cpu_count(),
+        help='client processes loading HAProxy (default: %(default)s)')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(n) for n in size.split('x')) for size in args.sizes.split(',')]
+    results = []
+
+    for apps, tasks in sizes:
+        # A fresh process per size, so each has its own peak memory.
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(runScenario, (apps, tasks, args.repeat))
+        finally:
+            pool.terminate()
+
+        pool = multiprocessing.Pool(1)
+        try:
+            uncached = pool.apply(runScenario, (apps, tasks, args.repeat, False))
+        finally:
+            pool.terminate()
+        result['uncached'] = dict((key, uncached[key]) for key in ('peak_rss_kb', 'timings'))
+
+        listingFile = tempfile.mktemp(suffix='.json')
+        with open(listingFile, 'w') as stream:
+            json.dump({ 'apps': verbose(cluster(apps, tasks)[1]) }, stream)
+
+        result['parse'] = {}
+        try:
+            for mode in ('full', 'stream', 'index'):
+                pool = multiprocessing.Pool(1)
+                try:
+                    result['parse'][mode] = pool.apply(runParse, (listingFile, mode, args.repeat))
+                finally:
+                    pool.terminate()
+        finally:
+            os.unlink(listingFile)
+
+        results.append(result)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as stream:
+            baseline = json.load(stream)
+
+    report(results, baseline)
+
+    throughput = benchmarkHAProxy(args.duration, args.clients) if args.haproxy else []
+    reportHAProxy(throughput)
+
+    with open(args.output, 'w') as stream:
+        json.dump({
+            'commit': commit(),
+            'python': platform.python_version(),
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'results': results,
+            'haproxy': throughput
+        }, stream, indent=2, sort_keys=True)
+
+    print 'Results written to {0}'.format(args.output)
+
+if __name__ == '__main__':
+    runBenchmarks()
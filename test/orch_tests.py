@@ -31,23 +31,58 @@ Future tests:
 """
 
 # Built-in imports
+import BaseHTTPServer
+from collections import OrderedDict
+from distutils.spawn import find_executable
+import errno
 import json
+from multiprocessing.pool import ThreadPool
 import os
+import shutil
+import signal
+import socket
+import SocketServer
+import subprocess
+from string import Template
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 # Installed imports
-from mock import call, patch
+from mock import MagicMock, call, patch
+import requests
 
 # Hack to get test file in its own directory.
 lib_path = os.path.join(os.path.dirname(__file__), '..')
 sys.path.append(lib_path)
 
 os.environ['CONFIG_FILE'] = './etc/test_config.json'
-SKYLR_HOME = os.environ.get('SKYLR_HOME', '/mnt/skylr/app/skylr')
+# Keep the coalescer from firing on its own; the tests flush it explicitly.
+os.environ['RELOAD_QUIET_WINDOW'] = '60'
+os.environ['RELOAD_MAX_DELAY'] = '60'
 
 import main
-from orchestration.ServiceOrchestrator import ServiceOrchestrator
+from orchestration.coalescer import EventCoalescer
+from orchestration.coordinator import Coordinator
+from orchestration.eventqueue import EventQueue
+from orchestration.fanout import CommandTarget, ConfigFanout, DirectoryTarget
+from orchestration.haproxy import HAProxyMaster, softReload
+from orchestration.marathon import EventStream, Marathon, endpointOf
+from orchestration.metrics import Counter, Gauge, Histogram, Registry
+from orchestration.publisher import ConfigPublisher, readPid
+from orchestration.records import Task, iterItems
+from orchestration.renderer import ConfigScanner, compileTemplate
+from orchestration.resolver import HostCache
+from orchestration.restart import RestartError, RollingRestart, isHealthy
+from orchestration.runtime import RuntimeAPI, SlotTable
+from orchestration.snapshot import SnapshotStore
+from orchestration.taskindex import TaskIndex
+from orchestration.tracing import Tracer, bind, span
+from orchestration.tuning import Tuning
+from orchestration.weights import AdaptiveWeights, parseStats
+from orchestration.ServiceOrchestrator import ServiceOrchestrator, digest, layout, membership, reloadsTotal, servers, summarizeChanges
 
 # === ServiceTestCase ===
 class ServiceTestCase(unittest.TestCase):
@@ -60,33 +95,30 @@ class ServiceTestCase(unittest.TestCase):
         self.configDest = "/tmp/haproxy.test.cfg"
         self.usersConfig = "/etc/haproxy/haproxy_users.cfg"
         self.pidFile = "/tmp/haproxy_test.pid"
-        self.tmpConfig =  os.path.join(SKYLR_HOME, 'haproxy.cfg')
 
     def tearDown(self):
         pass
 
     @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.isApprovedHost')
-    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.writeTmpConfig')
-    @patch('orchestration.marathon.Marathon.getTasks')
-    @patch('orchestration.marathon.Marathon.getApps')
+    @patch('orchestration.publisher.ConfigPublisher.begin')
+    @patch('orchestration.marathon.Marathon.iterTasks')
+    @patch('orchestration.marathon.Marathon.iterApps')
     @patch('subprocess.call')
-    def test_marathon(self, subCall, getApps, getTasks, writeTmpConfig, isApprovedHost):
+    def test_marathon(self, subCall, iterApps, iterTasks, begin, isApprovedHost):
         """
         This test exercises pretty much the whole marathon service call, without
         writing anything to the filesystem, or restarting HAProxy.
         """
         # Set some mock return values
-        getApps.return_value = sample_marathon_apps
-        getTasks.return_value = sample_marathon_tasks
+        iterApps.return_value = sample_marathon_apps
+        iterTasks.return_value = sample_marathon_tasks
         isApprovedHost.return_value = True
-        writeTmpConfig.return_value = self.tmpConfig
+        pending = begin.return_value = MemoryConfig()
 
-        # Build some mock calls to subprocess.call() (which usually copies
-        # files and restarts HAProxy)
-        command1 = "cp {0} {1}".format(self.tmpConfig, self.configDest)
-        command2 = "haproxy -f {0} -f {1} -p {2} -D".format(
-            self.configDest, self.usersConfig, self.pidFile)
-        call_list = [call(command1.split(" ")), call(command2.split(" "))]
+        # Build the mock call to subprocess.call() (which usually restarts
+        # HAProxy); the config itself is published without a subprocess.
+        command = "sudo haproxy -f {0} -p {1} -D".format(
+            self.configDest, self.pidFile)
 
         # Call the Flask service at the '/marathon' endpoint.
         rv = self.app.post('/marathon', data=json.dumps({
@@ -97,11 +129,15 @@ class ServiceTestCase(unittest.TestCase):
             'ports': [ 31351 ],
             'eventType': 'status_update_event'
         }))
+        main.events.join()
+        main.reloads.flush()
 
         # Assertions
-        self.assertEqual(rv.data, 'True')
-        writeTmpConfig.assert_called_once_with(sample_config_text)
-        subCall.assert_has_calls(call_list)
+        self.assertEqual(rv.status_code, 202)
+        self.assertEqual(rv.data, 'accepted')
+        self.assertEqual(pending.text(), sample_config_text)
+        self.assertTrue(pending.committed)
+        subCall.assert_called_once_with(command.split(" "))
 
     @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.reloadHAProxy')
     @patch('subprocess.call')
@@ -147,14 +183,1764 @@ class ServiceTestCase(unittest.TestCase):
         }
         call1 = call("skylr", update["skylr"])
         call2 = call("extension", update["extension"])
+        updateApp.return_value = { 'deploymentId': 'd-1', 'version': 'v-1' }
 
         rv = self.app.post('/updateApp', data=json.dumps(update))
+        result = json.loads(rv.data)
 
         # Assertions
-        self.assertEqual(rv.data, 'ok')
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['apps']['skylr'], { 'ok': True, 'deploymentId': 'd-1', 'version': 'v-1' })
+        self.assertEqual(result['apps']['scannr'], { 'ok': False, 'error': 'not a tracked app' })
         self.assertEqual(updateApp.call_count, 2)
         updateApp.assert_has_calls([call1, call2], any_order=True)
 
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.updateApps')
+    def test_updateApp_invalid(self, updateApps):
+        """
+        Bad bodies and timeouts are turned away, and long waits are capped.
+        """
+        update = json.dumps({ "skylr": { "instances": 3 } })
+        self.assertEqual(self.app.post('/updateApp', data='{not json').status_code, 400)
+        self.assertEqual(self.app.post('/updateApp?wait=true&timeout=soon', data=update).status_code, 400)
+        self.assertEqual(self.app.post('/updateApp?wait=true&timeout=-1', data=update).status_code, 400)
+        self.assertFalse(updateApps.called)
+
+        updateApps.return_value = {}
+        self.assertEqual(self.app.post('/updateApp?wait=true&timeout=3600', data=update).status_code, 200)
+        updateApps.assert_called_once_with({ "skylr": { "instances": 3 } }, True, main.UPDATE_MAX_WAIT)
+
+    def test_marathon_invalid(self):
+        """
+        Bodies that are not JSON objects are turned away without queueing.
+        """
+        enqueued = main.events.stats()['enqueued']
+
+        self.assertEqual(self.app.post('/marathon', data='{ not json').status_code, 400)
+        self.assertEqual(self.app.post('/marathon', data='[]').status_code, 400)
+        self.assertEqual(main.events.stats()['enqueued'], enqueued)
+
+    def test_status(self):
+        rv = self.app.get('/status')
+
+        stats = json.loads(rv.data)
+        self.assertEqual(sorted(stats), ['events', 'orchestrator', 'reloads'])
+        self.assertEqual(stats['events']['overflow'], 'drop_oldest')
+
+    def test_metrics(self):
+        rejected = main.eventsRejected.value(reason='invalid')
+        self.app.post('/marathon', data='not json')
+
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn('orchestrator_events_rejected_total{reason="invalid"} %r' % float(rejected + 1),
+            rv.data.splitlines())
+        self.assertIn('# TYPE orchestrator_render_duration_seconds histogram', rv.data)
+
+    def test_master_stats(self):
+        system = main.getSystem()
+        system.config['master_worker'] = True
+        try:
+            master = json.loads(self.app.get('/status').data)['orchestrator']['master']
+            self.assertEqual(master['reloads'], 0)
+            self.assertIn('orchestrator_haproxy_old_workers 0.0',
+                self.app.get('/metrics').data.splitlines())
+        finally:
+            del system.config['master_worker']
+
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.refreshSnapshot')
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.resync')
+    def test_debug_reloads(self, resync, refreshSnapshot):
+        resync.return_value = ({}, True)
+        refreshSnapshot.return_value = False
+        main.getSystem().applyEvents([{ 'eventType': 'status_update_event', 'appId': '/skylr',
+            'taskId': 'skylr.9', 'taskStatus': 'TASK_RUNNING', 'host': '10.17.1.9' }])
+
+        rv = self.app.get('/debug/reloads?limit=1')
+        traces = json.loads(rv.data)['traces']
+
+        self.assertEqual(len(traces), 1)
+        self.assertEqual(traces[0]['trigger'], 'events')
+        self.assertEqual(traces[0]['outcome'], 'no_reload')
+        self.assertEqual(traces[0]['events'],
+            [{ 'appId': '/skylr', 'taskId': 'skylr.9', 'taskStatus': 'TASK_RUNNING' }])
+        self.assertEqual([span['name'] for span in traces[0]['spans']],
+            ['check_config', 'apply_deltas'])
+
+
+# === EventQueueTestCase ===
+class EventQueueTestCase(unittest.TestCase):
+    """
+    The queue should hand events to its worker in order, and apply its
+    overflow policy when full.
+    """
+    def setUp(self):
+        self.release = threading.Event()
+        self.handled = []
+
+    def handler(self, item):
+        self.release.wait(5)
+        self.handled.append(item)
+
+    def fill(self, overflow):
+        events = EventQueue(self.handler, maxsize=2, overflow=overflow, blockTimeout=0.01)
+        results = [events.put(0)]
+
+        # Wait for the worker to take the first item and block on it.
+        while events.stats()['depth']:
+            time.sleep(0.001)
+
+        results += [events.put(i) for i in range(1, 5)]
+        self.release.set()
+        events.join()
+        return events, results
+
+    def test_drop_oldest(self):
+        events, results = self.fill('drop_oldest')
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(self.handled, [0, 3, 4])
+        self.assertEqual(events.stats()['dropped'], 2)
+
+    def test_drop_newest(self):
+        events, results = self.fill('drop_newest')
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(self.handled, [0, 1, 2])
+
+    def test_block(self):
+        events, results = self.fill('block')
+        self.assertEqual(results, [True, True, True, False, False])
+        stats = events.stats()
+        self.assertEqual((stats['processed'], stats['depth']), (3, 0))
+        self.assertTrue(stats['max_wait_seconds'] > 0)
+
+
+# === CoalescerTestCase ===
+class CoalescerTestCase(unittest.TestCase):
+    """
+    Bursts of events should cost a single reload.
+    """
+    def setUp(self):
+        self.batches = []
+
+    def test_flush(self):
+        coalescer = EventCoalescer(self.batches.append, quietWindow=60, maxDelay=60)
+        for i in range(5):
+            coalescer.submit({'taskId': i})
+        coalescer.flush()
+
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(len(self.batches[0]), 5)
+        self.assertEqual(coalescer.stats()['last_absorbed'], 5)
+        self.assertEqual(coalescer.stats()['reloads'], 1)
+
+    def test_quiet_window(self):
+        done = threading.Event()
+        def action(batch):
+            self.batches.append(batch)
+            done.set()
+
+        coalescer = EventCoalescer(action, quietWindow=0.05, maxDelay=1.0)
+        for i in range(3):
+            coalescer.submit({'taskId': i})
+        done.wait(2)
+
+        self.assertEqual([len(b) for b in self.batches], [3])
+
+    @patch('orchestration.coalescer.threading.Thread')
+    def test_max_delay(self, Thread):
+        # The batches are taken by hand, on a clock that only moves when told.
+        clock = [0]
+        coalescer = EventCoalescer(self.batches.append, quietWindow=2, maxDelay=3,
+            clock=lambda: clock[0])
+
+        for i in range(9):
+            coalescer.submit({ 'taskId': i })
+            clock[0] += 1
+            batch = coalescer.due()
+            if batch:
+                self.batches.append(batch)
+
+        # The steady trickle never goes quiet, but the cap still forces reloads.
+        self.assertEqual([len(batch) for batch in self.batches], [3, 3, 3])
+
+        coalescer.submit({})
+        clock[0] += 1
+        self.assertEqual(coalescer.due(), None)
+        clock[0] += 1
+        self.assertEqual(coalescer.due(), [{}])
+
+
+# === ConfigTestCase ===
+class ConfigTestCase(unittest.TestCase):
+    """
+    A long-lived orchestrator should follow edits to its config file.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.configFile = os.path.join(self.dir, 'config.json')
+        with open('./etc/test_config.json') as stream:
+            self.config = json.load(stream)
+        self.writeConfig()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeConfig(self):
+        with open(self.configFile, 'w') as stream:
+            json.dump(self.config, stream)
+        # Make sure the change is visible even on coarse mtime filesystems.
+        mtime = os.stat(self.configFile).st_mtime + 1
+        os.utime(self.configFile, (mtime, mtime))
+
+    def test_reload_on_change(self):
+        system = ServiceOrchestrator(self.configFile)
+        self.assertFalse(system.isAppTracked('scannr'))
+        self.assertFalse(system.checkConfig())
+
+        self.config['services']['scannr'] = { 'port': 4003 }
+        self.writeConfig()
+
+        self.assertTrue(system.checkConfig())
+        self.assertTrue(system.isAppTracked('/scannr'))
+
+    def test_bad_config_is_ignored(self):
+        system = ServiceOrchestrator(self.configFile)
+        with open(self.configFile, 'w') as stream:
+            stream.write('{ not json')
+
+        self.assertFalse(system.checkConfig())
+        self.assertTrue(system.isAppTracked('skylr'))
+
+    @patch('socket.gethostbyname')
+    def test_host_cache(self, gethostbyname):
+        gethostbyname.return_value = '10.0.0.1'
+        cache = HostCache(ttl=0)
+        self.assertEqual(cache.lookup('marathon1'), '10.0.0.1')
+        self.assertEqual(cache.lookup('marathon1'), '10.0.0.1')
+        self.assertEqual(gethostbyname.call_count, 1)
+
+        # A failed refresh keeps the last known address.
+        gethostbyname.side_effect = socket.gaierror('no such host')
+        cache.refresh()
+        self.assertEqual(cache.lookup('marathon1'), '10.0.0.1')
+
+    @patch('socket.gethostbyname')
+    def test_lookup_all(self, gethostbyname):
+        addresses = { 'agent1': '10.0.0.1', 'agent2': '10.0.0.2' }
+        def resolve(host):
+            if host not in addresses:
+                raise socket.gaierror('no such host')
+            return addresses[host]
+        gethostbyname.side_effect = resolve
+
+        cache = HostCache(ttl=60)
+        self.assertEqual(cache.lookupAll(['agent1', 'agent2', 'gone', '10.0.0.9', 'agent1']),
+            { 'agent1': '10.0.0.1', 'agent2': '10.0.0.2', 'gone': None, '10.0.0.9': '10.0.0.9' })
+        # Counted from the list of calls, as call_count is not thread-safe.
+        self.assertEqual(len(gethostbyname.call_args_list), 3)
+
+        # Hits and recent failures are answered without resolving again.
+        cache.lookupAll(['agent1', 'agent2', 'gone'])
+        self.assertEqual(len(gethostbyname.call_args_list), 3)
+
+
+# === MarathonTestCase ===
+class MarathonTestCase(unittest.TestCase):
+    """
+    Exercises the Marathon client without a Marathon server.
+    """
+    def setUp(self):
+        self.client = Marathon('http://localhost:8080/v2')
+
+    @patch('orchestration.marathon.Marathon.iterTasks')
+    @patch('orchestration.marathon.Marathon.iterApps')
+    def test_snapshot_embedded(self, iterApps, iterTasks):
+        iterApps.return_value = [
+            { 'id': '/skylr', 'tasks': sample_marathon_tasks },
+            { 'id': '/untracked', 'tasks': [] },
+            { 'id': '/chronos', 'tasks': [] }
+        ]
+
+        snapshot = self.client.getSnapshot(['skylr', 'chronos'])
+
+        iterApps.assert_called_once_with(embed='apps.tasks')
+        self.assertFalse(iterTasks.called)
+        self.assertEqual(snapshot.keys(), ['skylr', 'chronos'])
+
+        # Only what the config needs is kept of each task.
+        self.assertEqual(snapshot['skylr'], [{ 'id': task['id'], 'host': task['host'],
+            'ports': task['ports'] } for task in sample_marathon_tasks])
+        self.assertFalse(hasattr(snapshot['skylr'][0], '__dict__'))
+
+    @patch('orchestration.marathon.Marathon.iterTasks')
+    @patch('orchestration.marathon.Marathon.iterApps')
+    def test_snapshot_fallback(self, iterApps, iterTasks):
+        iterApps.return_value = [{ 'id': 'skylr' }, { 'id': 'chronos' }, { 'id': 'other' }]
+        iterTasks.side_effect = lambda appId: [{ 'id': appId + '.1', 'host': '10.17.1.1',
+            'ports': [ 31000 ], 'version': '2014-10-07T19:30:08.080Z' }]
+
+        snapshot = self.client.getSnapshot(['skylr', 'chronos'], poolSize=2)
+
+        self.assertEqual(iterTasks.call_count, 2)
+        self.assertEqual(snapshot.items(), [
+            ('skylr', [{ 'id': 'skylr.1', 'host': '10.17.1.1', 'ports': [ 31000 ] }]),
+            ('chronos', [{ 'id': 'chronos.1', 'host': '10.17.1.1', 'ports': [ 31000 ] }])
+        ])
+
+
+# === RecordsTestCase ===
+class RecordsTestCase(unittest.TestCase):
+    """
+    Listings should be decoded an item at a time, into compact records that
+    still read like dictionaries.
+    """
+    def test_iter_items(self):
+        body = json.dumps({ 'apps': sample_marathon_apps + [{ 'id': u'/caf\xe9', 'tasks': [] }] })
+        for size in (1, 5, 64, len(body)):
+            chunks = [body[n:n + size] for n in range(0, len(body), size)]
+            self.assertEqual(list(iterItems(chunks, 'apps')), json.loads(body)['apps'])
+
+        # Bodies of other shapes are decoded whole.
+        self.assertEqual(list(iterItems([' {"version": 1, "tasks": [{}]}'], 'tasks')), [{}])
+        self.assertRaises(KeyError, list, iterItems(['{"message": "no"}'], 'apps'))
+        self.assertRaises(ValueError, list, iterItems(['{"apps": [{"id": "/a"}, {"id'], 'apps'))
+
+    def test_task(self):
+        task = Task.fromDict(dict(sample_marathon_tasks[0], appId='/skylr'))
+
+        self.assertEqual(task['host'], '10.17.1.15')
+        self.assertEqual(task['ports'][0], 31443)
+        self.assertEqual(task.get('appID', task.get('appId')), '/skylr')
+        self.assertRaises(KeyError, lambda: task['version'])
+        self.assertEqual(task, { 'id': sample_marathon_tasks[0]['id'], 'host': '10.17.1.15',
+            'ports': [ 31443 ], 'appId': '/skylr' })
+
+    def test_snapshot_streamed(self):
+        marathon = FakeMarathon({ '/v2/apps?embed=apps.tasks': { 'apps': [
+            { 'id': '/skylr', 'instances': 2, 'env': { 'A': 'b' }, 'tasks': sample_marathon_tasks },
+            { 'id': '/untracked', 'tasks': [] }
+        ] } })
+        try:
+            snapshot = Marathon(marathon.url, retries=0).getSnapshot(['skylr'])
+        finally:
+            marathon.close()
+
+        self.assertEqual(snapshot.keys(), ['skylr'])
+        self.assertEqual([task['host'] for task in snapshot['skylr']], ['10.17.1.15', '10.17.1.16'])
+        self.assertTrue(all(isinstance(task, Task) for task in snapshot['skylr']))
+
+
+# === UpdateAppsTestCase ===
+class UpdateAppsTestCase(unittest.TestCase):
+    """
+    Apps are updated concurrently, each with its own result.
+    """
+    def setUp(self):
+        self.marathon = FakeMarathon({
+            'PUT /v2/apps/skylr': { 'deploymentId': 'd-1', 'version': 'v-1' },
+            'PUT /v2/apps/extension': (409, { 'message': 'App is locked by one or more deployments.' }),
+            '/v2/deployments': []
+        })
+        self.client = Marathon(self.marathon.url, retries=0)
+
+    def tearDown(self):
+        self.marathon.close()
+
+    def test_update_and_wait(self):
+        system = ServiceOrchestrator('./etc/test_config.json')
+        system.cluster = self.client
+
+        results = system.updateApps({
+            'skylr': { 'instances': 3 },
+            'extension': { 'instances': 2 }
+        }, wait=True)
+
+        self.assertEqual(results['skylr'],
+            { 'ok': True, 'deploymentId': 'd-1', 'version': 'v-1', 'deployed': True })
+        self.assertEqual(results['extension'], { 'ok': False,
+            'error': 'HTTP 409: App is locked by one or more deployments.' })
+        self.assertEqual(sorted(self.marathon.paths),
+            ['/v2/deployments', 'PUT /v2/apps/extension', 'PUT /v2/apps/skylr'])
+
+    def test_wait_timeout(self):
+        polls = []
+        def deployments():
+            polls.append(time.time())
+            return [{ 'id': 'd-1' }, { 'id': 'd-3' }] if len(polls) < 3 else [{ 'id': 'd-1' }]
+        self.marathon.routes['/v2/deployments'] = deployments
+
+        running = self.client.waitForDeployments(['d-1', 'd-2', 'd-3'], timeout=0.2, interval=0.01)
+
+        self.assertEqual(running, set(['d-1']))
+        self.assertTrue(len(polls) > 3)
+
+
+# === RestartTestCase ===
+class RestartTestCase(unittest.TestCase):
+    """
+    A rolling restart kills a batch at a time, and waits for Marathon to
+    replace it with healthy tasks before going on.
+    """
+    def setUp(self):
+        self.tasks = [{ 'id': 'skylr.{0}'.format(n), 'startedAt': '2016-01-0{0}'.format(n),
+            'healthCheckResults': [{ 'alive': True }] } for n in range(1, 6)]
+        self.started = []
+        self.lock = threading.Lock()
+        self.marathon = FakeMarathon({ '/v2/apps/skylr?embed=app.tasks': self.app })
+        for task in self.tasks:
+            self.marathon.routes['DELETE /v2/apps/skylr/tasks/{0}?scale=false'.format(task['id'])] = \
+                lambda taskId=task['id']: self.kill(taskId)
+        self.client = Marathon(self.marathon.url, retries=0)
+        self.lines = []
+
+    def tearDown(self):
+        self.marathon.close()
+
+    def app(self):
+        # Replacements pass their health checks from the second poll on.
+        for task in self.tasks:
+            task['polls'] = task.get('polls', 0) + 1
+            if task['polls'] > 1:
+                task['healthCheckResults'] = [{ 'alive': True }]
+        return { 'app': { 'id': '/skylr', 'instances': 5, 'healthChecks': [{ 'protocol': 'HTTP' }],
+            'tasks': [dict((k, v) for k, v in task.items() if k != 'polls') for task in self.tasks] } }
+
+    def kill(self, taskId):
+        replacement = { 'id': taskId + '.new', 'startedAt': '2016-02-01', 'healthCheckResults': [] }
+        with self.lock:
+            self.tasks = [task for task in self.tasks if task['id'] != taskId] + [replacement]
+            self.started.append(replacement['id'])
+        return { 'task': { 'id': taskId } }
+
+    def test_batches(self):
+        rolling = RollingRestart(self.client, 'skylr', batchSize=2, concurrency=2,
+            timeout=5, interval=0.01, progress=self.lines.append)
+
+        self.assertEqual(rolling.run(), 5)
+        self.assertEqual(sorted(task['id'] for task in self.tasks),
+            ['skylr.{0}.new'.format(n) for n in range(1, 6)])
+        kills = [path for path in self.marathon.paths if path.startswith('DELETE')]
+        self.assertEqual(len(kills), 5)
+        # No batch is killed before the one before it is healthy again.
+        self.assertEqual(sum(1 for line in self.lines if 'healthy, ' in line), 3)
+        self.assertTrue(self.lines[-1].startswith('skylr: batch 3/3: healthy, 5/5'))
+
+    def test_unhealthy_batch_stops(self):
+        self.app = lambda: { 'app': { 'instances': 5, 'healthChecks': [{}], 'tasks': self.tasks } }
+        self.marathon.routes['/v2/apps/skylr?embed=app.tasks'] = self.app
+        rolling = RollingRestart(self.client, 'skylr', batchSize=2, timeout=0.1, interval=0.01,
+            progress=self.lines.append)
+
+        self.assertRaises(RestartError, rolling.run)
+        self.assertEqual(sorted(self.started), ['skylr.1.new', 'skylr.2.new'])
+
+    def test_is_healthy(self):
+        self.assertFalse(isHealthy({}, { 'id': 'a' }))
+        self.assertTrue(isHealthy({}, { 'id': 'a', 'startedAt': 'x' }))
+        self.assertFalse(isHealthy({ 'healthChecks': [{}] }, { 'id': 'a', 'startedAt': 'x' }))
+        self.assertFalse(isHealthy({ 'healthChecks': [{}] },
+            { 'id': 'a', 'startedAt': 'x', 'healthCheckResults': [{ 'alive': False }] }))
+
+
+# === FailoverTestCase ===
+class FailoverTestCase(unittest.TestCase):
+    """
+    The client should move past a dead master and remember that it is dead.
+    """
+    def setUp(self):
+        self.client = Marathon(['http://m1:8080/v2', 'http://m2:8080/v2'],
+            timeout=(1, 2), retries=1, backoff=0)
+        self.calls = []
+
+    def respond(self, method, url, **kwargs):
+        self.calls.append((url, kwargs['timeout']))
+        if url.startswith('http://m1'):
+            raise requests.ConnectionError('connection refused')
+
+        response = MagicMock()
+        response.status_code = 200
+        response.iter_content.return_value = [ json.dumps({ 'apps': sample_marathon_apps }) ]
+        return response
+
+    def test_failover(self):
+        with patch.object(self.client.session, 'request', side_effect=self.respond):
+            self.assertEqual(self.client.getApps(), sample_marathon_apps)
+            self.assertEqual(self.client.url, 'http://m2:8080/v2')
+
+            # The second call goes straight to the healthy master.
+            self.client.getApps()
+
+        self.assertEqual(self.calls, [
+            ('http://m1:8080/v2/apps', (1, 2)),
+            ('http://m2:8080/v2/apps', (1, 2)),
+            ('http://m2:8080/v2/apps', (1, 2))
+        ])
+
+    def test_all_masters_down(self):
+        error = requests.ConnectionError('connection refused')
+        with patch.object(self.client.session, 'request', side_effect=error) as request:
+            self.assertRaises(requests.ConnectionError, self.client.getApps)
+
+        # Two masters, tried once and then retried once more.
+        self.assertEqual(request.call_count, 4)
+
+
+# === TaskIndexTestCase ===
+class TaskIndexTestCase(unittest.TestCase):
+    """
+    Status updates should be applied to the index as deltas.
+    """
+    def event(self, taskId, status, host='10.17.1.20', port=31500):
+        return {
+            'eventType': 'status_update_event',
+            'appId': '/skylr',
+            'taskId': taskId,
+            'taskStatus': status,
+            'host': host,
+            'ports': [ port ]
+        }
+
+    def test_deltas(self):
+        index = TaskIndex()
+        self.assertEqual(index.apply(self.event('skylr.new', 'TASK_RUNNING')), None)
+
+        index.replace({ 'skylr': sample_marathon_tasks })
+        self.assertTrue(index.apply(self.event('skylr.new', 'TASK_RUNNING')))
+        self.assertFalse(index.apply(self.event('skylr.new', 'TASK_RUNNING')))
+        self.assertFalse(index.apply(self.event('skylr.next', 'TASK_STAGING')))
+        self.assertTrue(index.apply(self.event(sample_marathon_tasks[0]['id'], 'TASK_KILLED')))
+        self.assertFalse(index.apply(self.event('skylr.unknown', 'TASK_LOST')))
+        self.assertEqual(index.apply(self.event('skylr.new', 'TASK_SOMETHING_ELSE')), None)
+
+        tasks = index.snapshot()['skylr']
+        self.assertEqual([task.host for task in tasks], ['10.17.1.16', '10.17.1.20'])
+        self.assertTrue(all(isinstance(task, Task) for task in tasks))
+
+    def test_replace_ignores_volatile_fields(self):
+        index = TaskIndex()
+        self.assertTrue(index.replace({ 'skylr': sample_marathon_tasks }))
+
+        tasks = [dict(task, version='later') for task in sample_marathon_tasks]
+        self.assertFalse(index.replace({ 'skylr': tasks }))
+
+    def test_replace_ignores_order(self):
+        index = TaskIndex()
+        index.replace(OrderedDict([ ('skylr', sample_marathon_tasks[:1]), ('chronos', []) ]))
+        self.assertTrue(index.apply(self.event('skylr.new', 'TASK_RUNNING')))
+
+        # Marathon lists the task added by the event first.
+        new = dict(sample_marathon_tasks[0], id='skylr.new', host='10.17.1.20', ports=[ 31500 ],
+            appId='/skylr')
+        self.assertFalse(index.replace(OrderedDict([ ('chronos', []),
+            ('skylr', [new, sample_marathon_tasks[0]]) ])))
+        self.assertTrue(index.replace({ 'skylr': [new], 'chronos': [] }))
+
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.restartHAProxy')
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.refreshSnapshot')
+    @patch('orchestration.marathon.Marathon.getSnapshot')
+    def test_render_from_index(self, getSnapshot, refreshSnapshot, restartHAProxy):
+        getSnapshot.return_value = { 'skylr': sample_marathon_tasks }
+        refreshSnapshot.return_value = True
+        system = ServiceOrchestrator('./etc/test_config.json')
+
+        system.applyEvents([{ 'appId': 'skylr' }])
+        self.assertEqual(getSnapshot.call_count, 1)
+
+        system.applyEvents([self.event('skylr.new', 'TASK_RUNNING')])
+        self.assertEqual(getSnapshot.call_count, 1)
+        hosts = [task['host'] for task in refreshSnapshot.call_args[0][0]['skylr']]
+        self.assertTrue('10.17.1.20' in hosts)
+        self.assertEqual(restartHAProxy.call_count, 2)
+
+        # A repeated event changes nothing, so nothing is reloaded.
+        system.applyEvents([self.event('skylr.new', 'TASK_RUNNING')])
+        self.assertEqual(restartHAProxy.call_count, 2)
+
+
+# === NoopRefreshTestCase ===
+class NoopRefreshTestCase(unittest.TestCase):
+    """
+    Identical configs should not be written or trigger restarts.
+    """
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.deployedConfig')
+    @patch('orchestration.publisher.ConfigPublisher.publish')
+    def test_skip_identical(self, publish, deployedConfig):
+        deployedConfig.return_value = (None, None, {})
+        system = ServiceOrchestrator('./etc/test_config.json')
+
+        self.assertTrue(system.refreshConfig(sample_config_text))
+        deployedConfig.side_effect = lambda: system.deployed[1:]
+        self.assertFalse(system.refreshConfig(sample_config_text))
+
+        self.assertEqual(publish.call_count, 1)
+        self.assertEqual((system.refreshCount, system.skippedCount), (1, 1))
+
+    @patch('orchestration.ServiceOrchestrator.softReload')
+    def test_retry_failed_reload(self, softReload):
+        # An identical config is reloaded again until a reload succeeds.
+        workDir = tempfile.mkdtemp()
+        try:
+            system = ServiceOrchestrator('./etc/test_config.json')
+            system.config.update(config_destination=os.path.join(workDir, 'haproxy.cfg'))
+            snapshot = OrderedDict([ ('skylr', sample_marathon_tasks), ('chronos', []) ])
+
+            softReload.side_effect = [1, 0]
+            self.assertEqual(system.refreshAndRestart(snapshot), 'reload_failed')
+            self.assertTrue(system.stats()['reload_pending'])
+            self.assertEqual(system.refreshAndRestart(snapshot), 'reloaded')
+            self.assertEqual(system.refreshAndRestart(snapshot), 'no_reload')
+            self.assertEqual(softReload.call_count, 2)
+        finally:
+            shutil.rmtree(workDir)
+
+    def test_summary(self):
+        old = membership(servers(sample_config_text))
+        self.assertEqual(old['www-skylr'], set(['10.17.1.15:31443', '10.17.1.16:31290']))
+
+        new = membership(servers(sample_config_text.replace('10.17.1.16:31290', '10.17.1.17:31000')))
+        self.assertEqual(summarizeChanges(old, new),
+            'websocket-skylr +[10.17.1.17:31000] -[10.17.1.16:31290]; '
+            'www-skylr +[10.17.1.17:31000] -[10.17.1.16:31290]')
+        self.assertEqual(summarizeChanges({}, new),
+            'backends added: websocket-skylr, www-skylr')
+
+
+# === SnapshotTestCase ===
+class SnapshotTestCase(unittest.TestCase):
+    """
+    The last known tasks should be kept on disk, and bring HAProxy up
+    without Marathon.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'haproxy.cfg.snapshot')
+        self.snapshot = OrderedDict([ ('skylr', sample_marathon_tasks), ('chronos', []) ])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def system(self):
+        system = ServiceOrchestrator('./etc/test_config.json')
+        system.config.update(config_destination=os.path.join(self.dir, 'haproxy.cfg'),
+            snapshot_path=self.path)
+        return system
+
+    def test_round_trip(self):
+        store = SnapshotStore(self.path)
+        self.assertEqual(store.load(), None)
+        self.assertTrue(store.save(self.snapshot, 'abc'))
+        self.assertFalse(store.save(self.snapshot, 'abc'))
+
+        snapshot, savedAt, digest = SnapshotStore(self.path).load()
+        self.assertEqual(snapshot.keys(), ['skylr', 'chronos'])
+        self.assertEqual(snapshot['skylr'][0], { 'id': sample_marathon_tasks[0]['id'],
+            'host': '10.17.1.15', 'ports': [ 31443 ] })
+        self.assertEqual(digest, 'abc')
+
+        with open(self.path, 'w') as stream:
+            stream.write('not a snapshot')
+        self.assertEqual(SnapshotStore(self.path).load(), None)
+
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.reconcile')
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.restartHAProxy')
+    def test_warm_start(self, restartHAProxy, reconcile):
+        first = self.system()
+        self.assertTrue(first.refreshSnapshot(self.snapshot))
+        os.unlink(first.configDest)
+
+        # A new orchestrator starts from the snapshot, without Marathon.
+        system = self.system()
+        with patch('orchestration.marathon.Marathon.getSnapshot') as getSnapshot:
+            system.warmStart().join()
+            self.assertFalse(getSnapshot.called)
+
+        with open(system.configDest) as stream:
+            self.assertEqual(stream.read(), first.render(self.snapshot))
+        self.assertEqual([task['host'] for task in system.index.snapshot()['skylr']],
+            ['10.17.1.15', '10.17.1.16'])
+        restartHAProxy.assert_called_once_with()
+        reconcile.assert_called_once_with()
+
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.haproxyRunning')
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.reconcile')
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.warmStart')
+    def test_warm_start_once(self, warmStart, reconcile, haproxyRunning):
+        # Only the first leader on the host warm starts, as long as HAProxy
+        # keeps running; the next one just reconciles.
+        haproxyRunning.return_value = True
+        self.system().warmStartOnce()
+        self.system().warmStartOnce()
+        self.assertEqual((warmStart.call_count, reconcile.call_count), (1, 1))
+
+        haproxyRunning.return_value = False
+        self.system().warmStartOnce()
+        self.assertEqual((warmStart.call_count, reconcile.call_count), (2, 1))
+
+
+# === FanoutTestCase ===
+class FanoutTestCase(unittest.TestCase):
+    """
+    A config should be pushed to every edge target at once, and only to
+    those that do not have it yet.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def edge(self, name):
+        if not os.path.isdir(os.path.join(self.dir, name)):
+            os.mkdir(os.path.join(self.dir, name))
+        return os.path.join(self.dir, name, 'haproxy.cfg')
+
+    def read(self, path):
+        with open(path) as stream:
+            return stream.read()
+
+    def test_quorum(self):
+        reloads = os.path.join(self.dir, 'reloads')
+        targets = [DirectoryTarget('edge1', self.edge('edge1'), ['sh', '-c', 'echo 1 >> ' + reloads]),
+            DirectoryTarget('edge2', self.edge('edge2')),
+            DirectoryTarget('edge3', self.edge('edge3'), ['sh', '-c', 'echo down; exit 3'])]
+        fanout = ConfigFanout(targets, quorum=2)
+
+        self.assertTrue(fanout.push(u'global\n', 'a'))
+        self.assertEqual(self.read(self.edge('edge1')),
+            'global\n')
+        self.assertEqual(self.read(reloads), '1\n')
+        self.assertEqual(fanout.stats()['targets']['edge3']['error'], 'sh exited 3: down')
+        self.assertEqual([target.name for target in fanout.behind('a')], ['edge3'])
+
+        # Only the target that missed the config is pushed to again.
+        self.assertTrue(fanout.push(u'global\n', 'a'))
+        self.assertEqual(self.read(reloads), '1\n')
+
+        self.assertFalse(ConfigFanout(targets).push(u'global\n', 'b'))
+
+    def test_command_timeout(self):
+        path = os.path.join(self.dir, 'piped.cfg')
+        fanout = ConfigFanout([CommandTarget('piped', ['sh', '-c', 'cat > ' + path]),
+            CommandTarget('hung', ['sleep', '5'])], quorum=1, timeout=0.2)
+
+        start = time.time()
+        self.assertTrue(fanout.push(u'global\n', 'a'))
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(self.read(path), 'global\n')
+        self.assertEqual(fanout.stats()['targets']['hung']['error'], 'sleep timed out after 0.2s')
+
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.restartHAProxy')
+    def test_refresh_pushes(self, restartHAProxy):
+        system = ServiceOrchestrator('./etc/test_config.json')
+        system.config.update(config_destination=os.path.join(self.dir, 'haproxy.cfg'),
+            fanout_targets=[{ 'name': 'edge1', 'path': self.edge('edge1') },
+                { 'name': 'edge2', 'type': 'command', 'command': ['sh', '-c', 'cat > ' + self.edge('edge2')] }])
+        snapshot = OrderedDict([ ('skylr', sample_marathon_tasks), ('chronos', []) ])
+
+        self.assertEqual(system.refreshAndRestart(snapshot), 'reloaded')
+        for edge in ('edge1', 'edge2'):
+            self.assertEqual(self.read(self.edge(edge)), self.read(system.configDest))
+        self.assertEqual(system.stats()['fanout']['quorum'], 2)
+
+        # New targets start out without the config.
+        system.config['fanout_targets'] = [{ 'name': 'edge3', 'type': 'command', 'command': ['false'] }]
+        self.assertEqual(system.refreshAndRestart(snapshot), 'no_reload, fanout_below_quorum')
+
+    def test_host_tuning(self):
+        # The edges would get this machine's thread count and fd limit.
+        with open('./etc/test_config.json') as stream:
+            config = json.load(stream)
+        config.update(fanout_targets=[{ 'name': 'edge1', 'path': self.edge('edge1') }],
+            nbthread='auto', maxconn='auto')
+        configFile = os.path.join(self.dir, 'config.json')
+        with open(configFile, 'w') as stream:
+            json.dump(config, stream)
+
+        with self.assertRaises(ValueError) as raised:
+            ServiceOrchestrator(configFile)
+        self.assertEqual(str(raised.exception),
+            'nbthread, maxconn, cpu_map must be set explicitly, not auto, with fanout_targets')
+
+        config.update(nbthread=4, maxconn=20000, cpu_map=False)
+        with open(configFile, 'w') as stream:
+            json.dump(config, stream)
+        self.assertEqual(ServiceOrchestrator(configFile).config['nbthread'], 4)
+
+
+# === FragmentCacheTestCase ===
+class FragmentCacheTestCase(unittest.TestCase):
+    """
+    Only the apps whose config or tasks changed should be rendered again.
+    """
+    def setUp(self):
+        self.system = ServiceOrchestrator('./etc/test_config.json')
+        self.snapshot = { 'skylr': sample_marathon_tasks, 'chronos': [] }
+
+    def test_reuse_and_evict(self):
+        first = self.system.render(self.snapshot)
+        self.assertEqual((self.system.fragmentHits, self.system.fragmentMisses), (0, 2))
+
+        moved = dict(sample_marathon_tasks[0], host='10.17.1.17')
+        self.system.render({ 'skylr': [moved, sample_marathon_tasks[1]], 'chronos': [] })
+        self.assertEqual((self.system.fragmentHits, self.system.fragmentMisses), (1, 3))
+
+        self.system.render({ 'skylr': sample_marathon_tasks })
+        self.assertEqual(sorted(self.system.fragments), ['skylr'])
+
+        self.assertEqual(self.system.render(self.snapshot), first)
+        self.assertEqual(self.system.stats()['fragments_cached'], 2)
+
+    def test_task_order(self):
+        first = self.system.render(self.snapshot)
+        reordered = { 'skylr': list(reversed(sample_marathon_tasks)), 'chronos': [] }
+
+        self.assertEqual(self.system.render(reordered), first)
+        self.assertEqual(self.system.fragmentHits, 2)
+
+    def test_service_change(self):
+        self.system.render(self.snapshot)
+        self.system.config['services']['skylr']['port'] = 4010
+
+        self.assertIn('bind :4010', self.system.render(self.snapshot))
+        self.assertEqual((self.system.fragmentHits, self.system.fragmentMisses), (1, 3))
+
+    def test_cache_off(self):
+        first = self.system.render(self.snapshot)
+        self.system.config['fragment_cache'] = False
+
+        self.assertEqual(self.system.render(self.snapshot), first)
+        self.assertEqual((self.system.fragmentHits, self.system.fragmentMisses), (0, 4))
+        self.assertEqual(self.system.fragments, {})
+
+
+# === RendererTestCase ===
+class RendererTestCase(unittest.TestCase):
+    """
+    The compiled, streaming renderer should write exactly the configs in the
+    golden files, and scan them the same way as the whole text.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.system = ServiceOrchestrator('./etc/test_config.json')
+        self.system.config['config_destination'] = os.path.join(self.dir, 'haproxy.cfg')
+        self.system.config['services']['legacy'] = {
+            'port': 4003, 'single_host': 'legacy.example.com', 'backend_port': 8080 }
+
+        def task(appId, n, host, port):
+            return { 'id': '%s.%s' % (appId, n), 'appId': '/' + appId, 'host': host, 'ports': [ port ] }
+
+        self.snapshot = OrderedDict([
+            ('skylr', [ task('skylr', 1, '10.17.1.16', 31290), task('skylr', 0, '10.17.1.15', 31443),
+                task('skylr', 2, '10.17.1.15', 31001) ]),
+            ('other', [ task('other', 0, '10.17.1.20', 31000) ]),
+            ('extension', [ task('extension', 0, '10.17.1.18', 31111),
+                task('extension', 1, '10.17.1.19', 31112) ]),
+            ('chronos', []),
+            ('legacy', [ task('legacy', 0, '10.17.1.21', 31000) ])
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def golden(self, name):
+        with open(os.path.join(os.path.dirname(__file__), 'data', name)) as stream:
+            return stream.read()
+
+    def test_golden(self):
+        self.assertEqual(self.system.render(self.snapshot), self.golden('golden_haproxy.cfg'))
+
+        self.assertTrue(self.system.refreshSnapshot(self.snapshot))
+        with open(self.system.configDest) as stream:
+            self.assertEqual(stream.read(), self.golden('golden_haproxy.cfg'))
+
+    @patch('orchestration.ServiceOrchestrator.logger')
+    def test_single_host_logged(self, logger):
+        # Rendering writes nothing to stdout, which gunicorn does not keep.
+        self.system.render(self.snapshot)
+        logger.warning.assert_called_once_with('Using single host for legacy')
+
+    def test_golden_runtime(self):
+        self.system.config.update(runtime_updates=True, master_worker=True, default_slots=4)
+        self.assertEqual(self.system.render(self.snapshot), self.golden('golden_haproxy_runtime.cfg'))
+
+    def test_session_stickiness(self):
+        self.system.config.update(nbthread=4, session_stickiness='appsession')
+        configText = self.system.render(self.snapshot)
+        self.assertIn('    appsession WEBSOCKETSERV', configText)
+        self.assertNotIn('stick-table', configText)
+
+        # Threads need a newer HAProxy, which has no appsession.
+        del self.system.config['session_stickiness']
+        configText = self.system.render(self.snapshot)
+        self.assertIn('    stick on req.cook(WEBSOCKETSERV)\n', configText)
+        self.assertNotIn('appsession', configText)
+        self.assertNotIn('forceclose', configText)
+
+    @unittest.skipIf(find_executable('haproxy') is None, 'needs an haproxy binary')
+    def test_haproxy_check(self):
+        # Only the lines that need the haproxy user and group are left out.
+        path = os.path.join(self.dir, 'golden.cfg')
+        with open(path, 'w') as stream:
+            stream.writelines(line for line in self.golden('golden_haproxy_runtime.cfg').splitlines(True)
+                if line.split()[:1] not in (['user'], ['group']))
+
+        check = subprocess.Popen([find_executable('haproxy'), '-c', '-f', path],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = check.communicate()[0]
+        self.assertEqual(check.returncode, 0, output)
+
+    @patch('socket.gethostbyname')
+    def test_resolved_hosts(self, gethostbyname):
+        gethostbyname.side_effect = lambda host: { 'legacy.example.com': '10.17.2.1',
+            'agent15': '10.17.1.15' }[host]
+        self.system.config['resolve_task_hosts'] = True
+        self.snapshot['skylr'][1]['host'] = 'agent15'
+
+        configText = self.system.render(self.snapshot)
+        self.assertIn('    server service-app-legacy 10.17.2.1:8080 # legacy.example.com\n', configText)
+        self.assertIn('    server service-skylr-1 10.17.1.15:31443 cookie service-skylr-1 '
+            'weight 1 maxconn 8192 check # agent15\n', configText)
+        self.assertIn('    server service-skylr-2 10.17.1.16:31290\n', configText)
+
+        self.assertEqual(servers(configText)['www-skylr']['service-skylr-1'], '10.17.1.15:31443')
+        self.assertEqual(layout(configText), layout(self.golden('golden_haproxy.cfg')))
+
+        # When the host stops resolving, the last known address is kept.
+        gethostbyname.side_effect = socket.gaierror('no such host')
+        self.system.hostCache.ttl = 0
+        self.assertEqual(self.system.render(self.snapshot), configText)
+
+    def test_scan(self):
+        configText = self.golden('golden_haproxy_runtime.cfg').decode('utf-8')
+        scanner = ConfigScanner()
+        for n in range(0, len(configText), 7):
+            scanner.write(configText[n:n + 7])
+        scanner.close()
+
+        self.assertEqual(scanner.digest(), digest(configText))
+        self.assertEqual(scanner.layout(), layout(configText))
+        self.assertEqual(scanner.servers['www-skylr']['service-skylr-3'], None)
+        self.assertEqual(scanner.servers, servers(configText))
+
+    def test_skip_leaves_no_files(self):
+        self.assertTrue(self.system.refreshSnapshot(self.snapshot))
+        self.assertFalse(self.system.refreshSnapshot(self.snapshot))
+        self.assertEqual(sorted(os.listdir(self.dir)), ['haproxy.cfg'])
+
+    def test_compile(self):
+        template = compileTemplate(Template('$$${a} 100% $b'))
+        self.assertEqual(template % { 'a': 1, 'b': 'x' }, '$1 100% x')
+
+
+# === TracingTestCase ===
+class TracingTestCase(unittest.TestCase):
+    """
+    Phases should be timed into the trace of their thread, and the last few
+    traces kept.
+    """
+    def test_spans(self):
+        tracer = Tracer(size=2)
+
+        def phase(name):
+            with span(name):
+                pass
+
+        with span('untraced'):
+            pass
+
+        for n in range(3):
+            with tracer.trace('events', [{ 'appId': '/skylr', 'taskId': 'skylr.%d' % n }]) as trace:
+                with span('resync'):
+                    pool = ThreadPool(2)
+                    pool.map(bind(phase), ['marathon a', 'marathon b'])
+                    pool.close()
+                with span('render'):
+                    pass
+                trace.outcome = 'reloaded'
+
+        traces = tracer.recent()
+        self.assertEqual([trace['id'] for trace in traces], [3, 2])
+        self.assertEqual(traces[0]['events'][0]['taskId'], 'skylr.2')
+        self.assertEqual(sorted((span['name'], span['depth']) for span in traces[0]['spans']),
+            [('marathon a', 1), ('marathon b', 1), ('render', 0), ('resync', 0)])
+        self.assertEqual(traces[0]['outcome'], 'reloaded')
+
+    def test_errors_and_profile(self):
+        tracer = Tracer(profileThreshold=0.05, profileInterval=0.005)
+
+        with self.assertRaises(ValueError):
+            with tracer.trace('resync'):
+                with span('reload'):
+                    time.sleep(0.1)
+                    raise ValueError('bad config')
+
+        trace = tracer.recent()[0]
+        self.assertEqual(trace['outcome'], 'error: bad config')
+        self.assertEqual(trace['spans'][0]['error'], 'ValueError')
+        self.assertTrue(trace['profile']['samples'] > 0)
+        self.assertIn('test_errors_and_profile', trace['profile']['stacks'][0]['stack'])
+
+
+# === TuningTestCase ===
+class TuningTestCase(unittest.TestCase):
+    """
+    Threads and connection limits should follow the machine, when asked.
+    """
+    def test_defaults(self):
+        tuning = Tuning({}, cpus=16, fds=65536)
+        self.assertEqual(tuning.context(),
+            { 'threads': '', 'maxconn': 4000, 'defaultMaxconn': 3000 })
+        self.assertEqual(tuning.bind({ 'port': 4000 }), '')
+
+    def test_auto(self):
+        tuning = Tuning({ 'nbthread': 'auto', 'maxconn': 'auto', 'default_maxconn': 'auto' },
+            cpus=16, fds=65536)
+
+        self.assertEqual(tuning.context(), {
+            'threads': '    nbthread 16\n    cpu-map auto:1/1-16 0-15\n',
+            'maxconn': 32268,
+            'defaultMaxconn': 24201
+        })
+
+    def test_overrides(self):
+        tuning = Tuning({ 'nbthread': 32, 'bind_options': 'thread all' }, cpus=16, fds=65536)
+        self.assertEqual(tuning.threads(), '    nbthread 32\n')
+        self.assertEqual(tuning.bind({}), ' thread all')
+        self.assertEqual(tuning.bind({ 'bind_options': 'thread 1-4' }), ' thread 1-4')
+
+        tuning = Tuning({ 'nbthread': 4, 'cpu_map': '1/all 0-3' }, cpus=16, fds=65536)
+        self.assertEqual(tuning.threads(), '    nbthread 4\n    cpu-map 1/all 0-3\n')
+
+    def test_render(self):
+        system = ServiceOrchestrator('./etc/test_config.json')
+        system.config.update(nbthread=2, maxconn=8000)
+        system.config['services']['skylr']['bind_options'] = 'thread 2'
+
+        configText = system.render({ 'skylr': sample_marathon_tasks })
+        self.assertIn('    daemon\n    nbthread 2\n', configText)
+        self.assertIn('    maxconn     8000\n', configText)
+        self.assertIn('    bind :4000 thread 2\n', configText)
+
+
+# === MetricsTestCase ===
+class MetricsTestCase(unittest.TestCase):
+    """
+    Metrics should be exposed in the Prometheus text format.
+    """
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_exposition(self):
+        counter = Counter('test_total', 'A counter', ('kind',), registry=self.registry)
+        counter.inc(kind='a')
+        counter.inc(2, kind='b "quoted"')
+        Gauge('test_gauge', 'A gauge', collect=lambda: 7, registry=self.registry)
+
+        histogram = Histogram('test_seconds', 'A histogram', buckets=(0.1, 1), registry=self.registry)
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        self.assertEqual(self.registry.exposition().splitlines(), [
+            '# HELP test_total A counter',
+            '# TYPE test_total counter',
+            'test_total{kind="a"} 1.0',
+            'test_total{kind="b \\"quoted\\""} 2.0',
+            '# HELP test_gauge A gauge',
+            '# TYPE test_gauge gauge',
+            'test_gauge 7.0',
+            '# HELP test_seconds A histogram',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1.0"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 3.65',
+            'test_seconds_count 4'])
+
+    def test_endpoints(self):
+        self.assertEqual(endpointOf('/apps'), '/apps')
+        self.assertEqual(endpointOf('/apps/skylr'), '/apps/{id}')
+        self.assertEqual(endpointOf('/apps/group/skylr/tasks'), '/apps/{id}/tasks')
+        self.assertEqual(endpointOf('/events?event_type=status_update_event'), '/events')
+
+    @patch('subprocess.call')
+    def test_reloads(self, subCall):
+        subCall.return_value = 0
+        system = ServiceOrchestrator('./etc/test_config.json')
+        before = reloadsTotal.value(outcome='ok')
+
+        self.assertTrue(system.restartHAProxy())
+        self.assertEqual(reloadsTotal.value(outcome='ok'), before + 1)
+        self.assertTrue(system.lastReloadAt is not None)
+
+
+# === PublisherTestCase ===
+class PublisherTestCase(unittest.TestCase):
+    """
+    Configs are published atomically, with history, and without subprocesses.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.dir, 'haproxy.cfg')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, path):
+        with open(path) as stream:
+            return stream.read()
+
+    @patch('subprocess.Popen')
+    @patch('subprocess.call')
+    def test_publish_and_rollback(self, subCall, popen):
+        publisher = ConfigPublisher(self.dest, keep=2)
+        for n in range(3):
+            publisher.publish(u'config %d\n' % n)
+
+        self.assertEqual(self.read(self.dest), 'config 2\n')
+        self.assertEqual([self.read(path) for path in publisher.history()],
+            ['config 1\n', 'config 0\n'])
+        self.assertEqual(sorted(os.listdir(self.dir)),
+            ['haproxy.cfg', 'haproxy.cfg.1', 'haproxy.cfg.2'])
+
+        publisher.rollback()
+        self.assertEqual(self.read(self.dest), 'config 1\n')
+        self.assertFalse(subCall.called or popen.called)
+
+    def test_read_pid(self):
+        pidFile = os.path.join(self.dir, 'haproxy.pid')
+        self.assertEqual(readPid(pidFile), None)
+
+        with open(pidFile, 'w') as stream:
+            stream.write('1234\n')
+        self.assertEqual(readPid(pidFile), 1234)
+
+
+# === RuntimeTestCase ===
+class RuntimeTestCase(unittest.TestCase):
+    """
+    Membership changes should go through the stats socket when the shape of
+    the config stays the same.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.socket = FakeStatsSocket(os.path.join(self.dir, 'stats'))
+
+        with open('./etc/test_config.json') as stream:
+            config = json.load(stream)
+        config.update({
+            'runtime_updates': True,
+            'stats_socket': self.socket.path,
+            'default_slots': 3,
+            'config_destination': os.path.join(self.dir, 'haproxy.cfg')
+        })
+        self.configFile = os.path.join(self.dir, 'config.json')
+        with open(self.configFile, 'w') as stream:
+            json.dump(config, stream)
+
+    def tearDown(self):
+        self.socket.close()
+        shutil.rmtree(self.dir)
+
+    def tasks(self, count):
+        return [{ 'id': 'skylr.%d' % i, 'host': '10.17.1.%d' % i, 'ports': [ 31000 + i ] }
+            for i in range(count)]
+
+    def test_runtime_update(self):
+        system = ServiceOrchestrator(self.configFile)
+
+        # The first config has to be loaded by a restart.
+        self.assertTrue(system.refreshConfig(system.render({ 'skylr': self.tasks(1) })))
+        self.assertEqual(self.socket.commands, [])
+
+        # A new task fills a free slot without a restart, enabled once it has
+        # its address.
+        self.assertFalse(system.refreshConfig(system.render({ 'skylr': self.tasks(2) })))
+        self.assertEqual(self.socket.commands, [
+            'set server websocket-skylr/service-skylr-1 addr 10.17.1.1 port 31001',
+            'set server www-skylr/service-skylr-1 addr 10.17.1.1 port 31001',
+            'set server websocket-skylr/service-skylr-1 state ready',
+            'set server www-skylr/service-skylr-1 state ready'
+        ])
+
+        # A departing task parks its slot.
+        del self.socket.commands[:]
+        self.assertFalse(system.refreshConfig(system.render({ 'skylr': self.tasks(2)[1:] })))
+        self.assertEqual(self.socket.commands, [
+            'set server websocket-skylr/service-skylr-0 state maint',
+            'set server www-skylr/service-skylr-0 state maint'
+        ])
+        self.assertEqual(system.runtimeCount, 2)
+
+        # Outgrowing the slots changes the layout, which needs a restart.
+        self.assertTrue(system.refreshConfig(system.render({ 'skylr': self.tasks(4) })))
+
+    def test_rejected_update_reloads(self):
+        system = ServiceOrchestrator(self.configFile)
+        system.refreshConfig(system.render({ 'skylr': self.tasks(1) }))
+
+        self.socket.response = 'No such server.\n'
+        self.assertTrue(system.refreshConfig(system.render({ 'skylr': self.tasks(2) })))
+
+    def test_unknown_reply_reloads(self):
+        system = ServiceOrchestrator(self.configFile)
+        system.refreshConfig(system.render({ 'skylr': self.tasks(1) }))
+
+        self.socket.response = "Invalid addr '10.17.1.1.5'\n"
+        self.assertTrue(system.refreshConfig(system.render({ 'skylr': self.tasks(2) })))
+        # Nothing is enabled once an address was refused.
+        self.assertFalse(any('state ready' in command for command in self.socket.commands))
+
+    def test_hostname_reloads(self):
+        system = ServiceOrchestrator(self.configFile)
+        system.refreshConfig(system.render({ 'skylr': self.tasks(1) }))
+
+        tasks = self.tasks(1) + [{ 'id': 'skylr.1', 'host': 'c4.skylr.renci.org', 'ports': [ 31001 ] }]
+        self.assertTrue(system.refreshConfig(system.render({ 'skylr': tasks })))
+        self.assertEqual(self.socket.commands, [])
+
+    def test_slots_are_sticky(self):
+        slots = SlotTable()
+        self.assertEqual(slots.assign('skylr', ['a', 'b', 'c'], 4), ['a', 'b', 'c', None])
+        self.assertEqual(slots.assign('skylr', ['d', 'b', 'c'], 4), ['d', 'b', 'c', None])
+        self.assertEqual(slots.assign('skylr', ['b'], 2), [None, 'b'])
+
+
+# === WeightsTestCase ===
+class WeightsTestCase(unittest.TestCase):
+    """
+    Server weights should follow the live statistics on the stats socket.
+    """
+    header = '# pxname,svname,qcur,scur,slim,stot,econ,eresp,status,weight,addr,rtime,hrsp_5xx,'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rows = {
+            'fast': 'www-skylr,service-skylr-0,0,2,,100,0,0,UP,100,10.17.1.15:31443,20,0,',
+            'slow': 'www-skylr,service-skylr-1,0,2,,100,0,0,UP,100,10.17.1.16:31290,180,0,',
+            'down': 'www-skylr,service-skylr-2,0,0,,0,0,0,MAINT,1,127.0.0.1:1,0,0,'
+        }
+        self.socket = FakeStatsSocket(os.path.join(self.dir, 'stats'), self.respond)
+
+    def tearDown(self):
+        self.socket.close()
+        shutil.rmtree(self.dir)
+
+    def respond(self, line):
+        if line != 'show stat':
+            return '\n'
+        return '\n'.join([self.header, 'www-skylr,FRONTEND,,,,,,,OPEN,,,,,'] +
+            [self.rows[name] for name in sorted(self.rows)]) + '\n'
+
+    def test_adjust(self):
+        weights = AdaptiveWeights(RuntimeAPI(self.socket.path), damping=0.5)
+        changes = weights.update()
+
+        # Mean cost 100: the fast server is pushed to the ceiling, the slow
+        # one half way to 56.
+        self.assertEqual(changes, {
+            ('www-skylr', 'service-skylr-0'): 256,
+            ('www-skylr', 'service-skylr-1'): 78
+        })
+        self.assertEqual(self.socket.commands[1:], [
+            'set weight www-skylr/service-skylr-0 256',
+            'set weight www-skylr/service-skylr-1 78'
+        ])
+
+    def test_errors_and_dry_run(self):
+        weights = AdaptiveWeights(RuntimeAPI(self.socket.path), smoothing=1.0, dryRun=True)
+        weights.update()
+
+        # Half the new requests to the fast server fail.
+        self.rows['fast'] = 'www-skylr,service-skylr-0,0,2,,200,0,50,UP,100,10.17.1.15:31443,20,0,'
+        changes = weights.update()
+
+        self.assertTrue(changes[('www-skylr', 'service-skylr-0')] <
+            changes[('www-skylr', 'service-skylr-1')])
+        self.assertEqual(self.socket.commands, ['show stat', 'show stat'])
+
+    def test_parse(self):
+        rows = parseStats(self.respond('show stat'))
+        self.assertEqual([row['svname'] for row in rows],
+            ['service-skylr-2', 'service-skylr-0', 'service-skylr-1'])
+        self.assertEqual(rows[1]['rtime'], '20')
+
+
+# === HAProxyTestCase ===
+class HAProxyTestCase(unittest.TestCase):
+    """
+    Reloads should soft-stop the old HAProxy, or go through the master.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.pidFile = os.path.join(self.dir, 'haproxy.pid')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    @patch('subprocess.call')
+    def test_soft_reload(self, subCall):
+        with open(self.pidFile, 'w') as stream:
+            stream.write('4321\n')
+
+        softReload(['/etc/haproxy/haproxy.cfg', '/etc/haproxy/users.cfg'], self.pidFile)
+        subCall.assert_called_once_with(['sudo', 'haproxy', '-f', '/etc/haproxy/haproxy.cfg',
+            '-f', '/etc/haproxy/users.cfg', '-p', self.pidFile, '-D', '-sf', '4321'])
+
+    def test_master_reload(self):
+        procs = { 'current': [101], 'old': [], 'polls': 0 }
+
+        def respond(line):
+            if line == 'reload':
+                procs['current'], procs['old'] = [procs['current'][0] + 1], procs['old'] + procs['current']
+                procs['polls'] = 0
+                return 'Success=1\n'
+
+            # The old worker finishes its connections after a few polls.
+            procs['polls'] += 1
+            if procs['old'] and procs['polls'] > 4:
+                procs['old'] = []
+
+            lines = ['#<PID>          <type>          <reloads>       <uptime>        <version>',
+                '100             master          0               0d00h01m00s     2.2.3',
+                '# workers']
+            lines += ['%d             worker          0               0d00h00m01s     2.2.3' % pid
+                for pid in procs['current']]
+            lines += ['# old workers']
+            lines += ['%d             worker          1               0d00h01m00s     2.2.3' % pid
+                for pid in procs['old']]
+            return '\n'.join(lines) + '\n'
+
+        cli = FakeStatsSocket(os.path.join(self.dir, 'master.sock'), respond)
+        try:
+            master = HAProxyMaster('/etc/haproxy/haproxy.cfg', self.pidFile,
+                cli.path + ',mode,600', pollInterval=0.01, drainInterval=0.01)
+            self.assertTrue(master.reload())
+            self.assertTrue(master.reload())
+
+            # One thread tracks every reload.
+            self.assertEqual(sum(1 for thread in threading.enumerate()
+                if thread.name == 'haproxy-tracker'), 1)
+
+            deadline = time.time() + 5
+            while master.tracker is not None and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            cli.close()
+
+        stats = master.stats()
+        self.assertEqual(stats['reloads'], 2)
+        self.assertEqual(master.tracked, [])
+        self.assertEqual(stats['old_workers'], 0)
+        self.assertTrue(stats['last_reload_seconds'] <= stats['last_drain_seconds'])
+
+    @patch('os.kill')
+    def test_master_signal_fails(self, kill):
+        # The CLI is gone and the pidfile is stale: the reload fails cleanly.
+        with open(self.pidFile, 'w') as stream:
+            stream.write('4321\n')
+        kill.side_effect = OSError(errno.ESRCH, 'No such process')
+
+        master = HAProxyMaster('/etc/haproxy/haproxy.cfg', self.pidFile,
+            os.path.join(self.dir, 'master.sock'))
+        master.procs = MagicMock(return_value=([101], []))
+        master.cli.send = MagicMock(side_effect=socket.error('connection reset'))
+
+        self.assertFalse(master.reload())
+        kill.assert_called_once_with(4321, signal.SIGUSR2)
+        self.assertEqual((master.stats()['failed'], master.stats()['reloads']), (1, 0))
+
+    @patch('subprocess.call')
+    def test_master_start(self, subCall):
+        subCall.return_value = 0
+        master = HAProxyMaster('/etc/haproxy/haproxy.cfg', self.pidFile,
+            os.path.join(self.dir, 'missing.sock'))
+
+        self.assertTrue(master.reload())
+        subCall.assert_called_once_with(['sudo', 'haproxy', '-W', '-S',
+            os.path.join(self.dir, 'missing.sock'), '-f', '/etc/haproxy/haproxy.cfg',
+            '-p', self.pidFile])
+
+
+# === EventStreamTestCase ===
+class EventStreamTestCase(unittest.TestCase):
+    """
+    Tracked status updates should come through Marathon's event stream.
+    """
+    def setUp(self):
+        self.marathon = FakeMarathon()
+        self.client = Marathon(self.marathon.url, retries=0)
+        self.events = []
+        self.reconnects = threading.Event()
+
+    def tearDown(self):
+        self.marathon.close()
+
+    def wait(self, predicate):
+        deadline = time.time() + 5
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_stream(self):
+        status = lambda appId, taskId: json.dumps({ 'eventType': 'status_update_event',
+            'appId': appId, 'taskId': taskId, 'taskStatus': 'TASK_RUNNING',
+            'host': '10.17.1.20', 'ports': [ 31500 ] })
+        self.marathon.stream = (
+            ': keepalive\n\n'
+            'event: api_post_event\ndata: {"eventType": "api_post_event", "appId": "/skylr"}\n\n'
+            'event: status_update_event\ndata: ' + status('/untracked', 'u.1') + '\n\n'
+            'event: status_update_event\ndata: ' + status('/skylr', 'skylr.1') + '\n\n')
+
+        stream = EventStream(self.client, self.events.append, lambda appId: 'skylr' in appId,
+            onReconnect=self.reconnects.set, backoff=0.01)
+        stream.start()
+        try:
+            # The fake closes each stream after writing it, so the
+            # subscriber reconnects and asks for a resync.
+            self.reconnects.wait(5)
+            self.wait(lambda: len(self.events) >= 2)
+        finally:
+            stream.stop()
+
+        self.assertTrue(self.reconnects.is_set())
+        self.assertEqual(self.events[0]['taskId'], 'skylr.1')
+        self.assertEqual(self.marathon.paths[0], '/v2/events?event_type=status_update_event')
+
+    def status(self, taskId):
+        return json.dumps({ 'eventType': 'status_update_event', 'appId': '/skylr',
+            'taskId': taskId, 'taskStatus': 'TASK_RUNNING', 'host': '10.17.1.20', 'ports': [ 31500 ] })
+
+    def test_chunked(self):
+        # An event is handled as soon as its chunk arrives, even when it is
+        # split across chunks, and a malformed one is skipped.
+        event = 'event: status_update_event\ndata: ' + self.status('skylr.2') + '\n\n'
+        self.marathon.stream = [
+            'event: status_update_event\r\ndata: ' + self.status('skylr.1') + '\r\n\r\n',
+            'event: status_update_event\ndata: {"appId": "/skylr", "eventType": "status_\n\n' +
+                event[:20], event[20:]]
+
+        stream = EventStream(self.client, self.events.append, lambda appId: 'skylr' in appId,
+            backoff=60)
+        stream.start()
+        try:
+            self.wait(lambda: self.events)
+            self.assertEqual([evt['taskId'] for evt in self.events], ['skylr.1'])
+
+            self.marathon.release.set()
+            self.wait(lambda: len(self.events) == 2)
+        finally:
+            stream.stop()
+
+        self.assertEqual([evt['taskId'] for evt in self.events], ['skylr.1', 'skylr.2'])
+        self.assertEqual((stream.connections, stream.malformed), (1, 1))
+
+
+# === CoordinatorTestCase ===
+class CoordinatorTestCase(unittest.TestCase):
+    """
+    One of several workers should lead, and the others hand events to it.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'haproxy.cfg')
+        self.leaderEvents = []
+        self.followerEvents = []
+        self.elected = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def wait(self, predicate):
+        deadline = time.time() + 5
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.01)
+
+    @patch.object(main, 'coordinator', None)
+    @patch.object(main, 'COORDINATE_WORKERS', True)
+    @patch('main.Coordinator')
+    def test_follower_chores(self, Coordinator):
+        # A follower still keeps its Marathon hosts resolved, but leaves the
+        # resyncs to the leader.
+        orchestrator = main.startSystem('./etc/test_config.json')
+        try:
+            self.assertTrue(orchestrator.hostRefresher.thread.is_alive())
+            self.assertEqual(orchestrator.resyncer.thread, None)
+        finally:
+            orchestrator.hostRefresher.stop()
+
+    @patch.object(main, 'coordinator', None)
+    @patch.object(main, 'COORDINATE_WORKERS', True)
+    @patch('main.lead')
+    @patch('main.Coordinator')
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.warmStartOnce')
+    def test_elected_warm_starts(self, warmStartOnce, Coordinator, lead):
+        # Under gunicorn, HAProxy comes up when a worker is elected.
+        orchestrator = main.startSystem('./etc/test_config.json')
+        try:
+            elected = Coordinator.call_args[0][2]
+            elected()
+            self.wait(lambda: warmStartOnce.called)
+            warmStartOnce.assert_called_once_with()
+            lead.assert_called_once_with(orchestrator)
+        finally:
+            orchestrator.hostRefresher.stop()
+
+    @patch.object(main, 'system', None)
+    @patch.object(main, 'coordinator', None)
+    @patch.object(main, 'COORDINATE_WORKERS', True)
+    @patch('main.lead')
+    @patch('main.Coordinator')
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.warmStartOnce')
+    def test_worker_boot(self, warmStartOnce, Coordinator, lead):
+        # A gunicorn worker elects and warm starts as it boots, before any request.
+        Coordinator.side_effect = lambda configDest, submit, elected: MagicMock(
+            start=lambda: elected())
+        self.bootWorker()
+        try:
+            self.wait(lambda: warmStartOnce.called)
+            warmStartOnce.assert_called_once_with()
+        finally:
+            main.system.hostRefresher.stop()
+
+    @patch.object(main, 'system', None)
+    @patch.object(main, 'coordinator', None)
+    @patch.object(main, 'COORDINATE_WORKERS', True)
+    @patch('main.Coordinator')
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.subscribe')
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.warmStartOnce')
+    def test_worker_boot_subscribes(self, warmStartOnce, subscribe, Coordinator):
+        # The elected worker holds the event stream without waiting for a request.
+        with open('./etc/test_config.json') as stream:
+            config = json.load(stream)
+        config['event_stream'] = True
+        configFile = os.path.join(self.dir, 'config.json')
+        with open(configFile, 'w') as stream:
+            json.dump(config, stream)
+
+        Coordinator.side_effect = lambda configDest, submit, elected: MagicMock(
+            start=lambda: elected())
+        with patch.object(main, 'CONFIG_FILE', configFile):
+            self.bootWorker()
+        try:
+            subscribe.assert_called_once_with(main.acceptStreamed)
+        finally:
+            for chore in (main.system.hostRefresher, main.system.resyncer,
+                    main.system.weighter, main.system.fanoutRetrier):
+                chore.stop()
+
+    @patch.object(main, 'system', None)
+    @patch.object(main, 'coordinator', None)
+    @patch.object(main, 'COORDINATE_WORKERS', True)
+    @patch('orchestration.ServiceOrchestrator.ServiceOrchestrator.warmStartOnce')
+    def test_worker_boot_elects(self, warmStartOnce):
+        # The first worker to boot leads, and resyncs, before any request.
+        with open('./etc/test_config.json') as stream:
+            config = json.load(stream)
+        config['config_destination'] = self.path
+        configFile = os.path.join(self.dir, 'config.json')
+        with open(configFile, 'w') as stream:
+            json.dump(config, stream)
+
+        with patch.object(main, 'CONFIG_FILE', configFile):
+            self.bootWorker()
+        try:
+            self.assertTrue(main.coordinator.isLeader)
+            self.assertTrue(main.system.resyncer.thread.is_alive())
+        finally:
+            main.coordinator.resign()
+            for chore in (main.system.hostRefresher, main.system.resyncer,
+                    main.system.weighter, main.system.fanoutRetrier):
+                chore.stop()
+
+    def bootWorker(self):
+        hooks = {}
+        execfile('./etc/gunicorn_config.py', hooks)
+        hooks['post_worker_init'](MagicMock())
+
+    def test_handoff(self):
+        leader = Coordinator(self.path, self.leaderEvents.append,
+            lambda: self.elected.append('leader')).start()
+        follower = Coordinator(self.path, self.followerEvents.append,
+            lambda: self.elected.append('follower'), interval=60).start()
+
+        self.assertTrue(leader.isLeader)
+        self.assertFalse(follower.isLeader)
+        self.assertEqual(self.elected, ['leader'])
+
+        self.assertTrue(follower.submit({ 'taskId': 'skylr.1' }))
+        self.assertTrue(leader.submit({ 'taskId': 'skylr.2' }))
+        self.wait(lambda: len(self.leaderEvents) == 2)
+
+        self.assertEqual(sorted(evt['taskId'] for evt in self.leaderEvents), ['skylr.1', 'skylr.2'])
+        self.assertEqual((follower.stats()['forwarded'], leader.stats()['received']), (1, 1))
+
+        # Once the leader is gone, the next event makes the follower take over.
+        leader.resign()
+        self.assertTrue(follower.submit({ 'taskId': 'skylr.3' }))
+        self.assertTrue(follower.isLeader)
+        self.assertEqual(self.followerEvents, [{ 'taskId': 'skylr.3' }])
+        self.assertEqual(self.elected, ['leader', 'follower'])
+        self.assertFalse(leader.elect())
+        follower.resign()
+
+    def test_takeover(self):
+        leader = Coordinator(self.path, self.leaderEvents.append).start()
+        follower = Coordinator(self.path, self.followerEvents.append, interval=0.05).start()
+
+        leader.resign()
+        self.wait(lambda: follower.isLeader)
+        self.assertTrue(follower.isLeader)
+        follower.resign()
+
+
+# === Test Case Support Classes ===
+class FakeMarathon(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local stand-in for Marathon's HTTP API.  GET /v2/events writes the
+    stream attribute as a server-sent event stream, or, if it is a list,
+    sends each item as an HTTP chunk, waiting for release before all but the
+    first.  Other requests are
+    answered with the JSON in the routes dictionary of path to response,
+    where paths other than GETs start with the method, e.g. "PUT /v2/apps/x".
+    A response may be a (status, response) pair, or a function returning
+    either.
+    """
+    daemon_threads = True
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.paths.append(self.path)
+            if self.path.startswith('/v2/events'):
+                if isinstance(self.server.stream, list):
+                    self.chunked(self.server.stream)
+                else:
+                    self.reply(200, self.server.stream, 'text/event-stream')
+            else:
+                self.route(self.path)
+
+        def do_PUT(self):
+            self.server.paths.append('PUT ' + self.path)
+            self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+            self.route('PUT ' + self.path)
+
+        def do_DELETE(self):
+            self.server.paths.append('DELETE ' + self.path)
+            self.route('DELETE ' + self.path)
+
+        def route(self, key):
+            response = self.server.routes.get(key)
+            if callable(response):
+                response = response()
+            status = 200 if response is not None else 404
+            if isinstance(response, tuple):
+                status, response = response
+            self.reply(status, json.dumps(response if response is not None else {}))
+
+        def reply(self, status, body, contentType='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', contentType)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def chunked(self, chunks):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for n, chunk in enumerate(chunks):
+                if n:
+                    self.server.release.wait(5)
+                self.wfile.write('{0:x}\r\n{1}\r\n'.format(len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write('0\r\n\r\n')
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self, routes=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), self.Handler)
+        self.routes = routes or {}
+        self.stream = ''
+        self.release = threading.Event()
+        self.paths = []
+        self.url = 'http://127.0.0.1:{0}/v2'.format(self.server_address[1])
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+class FakeStatsSocket(object):
+    """
+    A stand-in for the HAProxy stats socket that records the commands it is
+    sent, and answers each connection with a canned response.
+    """
+    def __init__(self, path, response='\n'):
+        self.path = path
+        self.response = response
+        self.commands = []
+        self.lines = []
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+
+            data = ''
+            while not data.endswith('\n'):
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+
+            line = data.strip()
+            self.lines.append(line)
+            self.commands.extend(line.split(';'))
+            response = self.response(line) if callable(self.response) else self.response
+            conn.sendall(response)
+            conn.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class MemoryConfig(object):
+    """
+    A stand-in for a PendingConfig that keeps the config in memory.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.committed = False
+
+    def write(self, text):
+        self.chunks.append(text)
+
+    def text(self):
+        return ''.join(self.chunks)
+
+    def commit(self):
+        self.committed = True
+
+    def discard(self):
+        pass
+
 
 # === Test Case Support Variables ===
 sample_marathon_apps = [ {
@@ -234,15 +2020,17 @@ defaults
     timeout check           10s
     maxconn                 3000
 
-listen stats *:8082
+listen stats :8082
+    mode http
     stats enable
+    stats hide-version
+    stats uri /
     stats auth     username:password
-    stats uri      /proxy_stats
     stats realm    PAGE TITLE
 
 frontend http-in-skylr
     bind :4000
-    reqadd X-Forwarded-Proto:\ https
+#    reqadd X-Forwarded-Proto:\ https
     acl is_websocket hdr(Connection)  -i Upgrade
     acl is_websocket path_beg /socket.io
     acl is_websocket hdr(Upgrade) -i WebSocket